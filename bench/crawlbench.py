@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Benchmark the crawler offline against a synthetic website.
+
+Starts the synthetic site, points WebCrawler at it with a SQLite database
+and an in-process broker standing in for RabbitMQ, runs page and link
+workers until every URL has been dealt with and reports, per worker and
+overall, pages/sec, links/sec, p50/p99 latency from picking a message up to
+having persisted its results, and peak RSS.
+
+    python3 bench/crawlbench.py --fanout 8 --depth 3 --hosts 4 --page-workers 2
+    python3 bench/crawlbench.py --fanout 8 --depth 3 --hosts 4 --page-workers 0 --link-workers 0 --pipeline-workers 2
+
+Any crawler setting can be tuned with --inifile, a webcrawler.ini style file
+whose [fetch], [cache], [mqueue], [politeness] ... sections are used as
+they are, as are the settings of its [db-bench] SQLite profile. Several hosts means binding 127.0.0.2 and up, which works out of
+the box on Linux but needs loopback aliases on macOS."""
+
+import argparse
+import configparser
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcrawler'))
+
+import standins
+
+from synthsite import SiteGraph, SyntheticSite
+from wclib import model as dm
+from wclib import crawler as wc
+from wclib.config import Configuration
+from wclib.frontier import frontiers
+from wclib.sqlitedb import CrawlerSqliteDatabase, SqliteWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline WebCrawler benchmark against a synthetic website.")
+
+    parser.add_argument("--fanout", type=int, default=5, help="Links from each page to pages one level down. [default=5]")
+    parser.add_argument("--depth", type=int, default=3, help="Levels below the home page. [default=3]")
+    parser.add_argument("--page-size", type=int, default=8192, help="Size of each page in bytes. [default=8192]")
+    parser.add_argument("--hosts", type=int, default=1, help="Number of hosts the pages are spread over. [default=1]")
+    parser.add_argument("--slow-hosts", type=int, default=0, help="Number of hosts that are slow to answer. [default=0]")
+    parser.add_argument("--slow-delay", type=float, default=0.2, help="Seconds a slow host takes to answer. [default=0.2]")
+    parser.add_argument("--error-hosts", type=int, default=0, help="Number of hosts answering some pages with a 500. [default=0]")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="Share of an erroring host's pages that fail. [default=0.2]")
+    parser.add_argument("--redirect-chain", type=int, default=0, help="Length of the redirect chain in front of some links. [default=0]")
+    parser.add_argument("--redirect-every", type=int, default=10, help="Put every Nth page behind a redirect chain. [default=10]")
+    parser.add_argument("--page-workers", type=int, default=1, help="Number of page worker processes. [default=1]")
+    parser.add_argument("--link-workers", type=int, default=1, help="Number of link worker processes. [default=1]")
+    parser.add_argument("--pipeline-workers", type=int, default=0, help="Number of pipeline worker processes, crawling pages and storing their links in one pass. [default=0]")
+    parser.add_argument("-f", "--fetch-mode", default="sync", choices=['sync', 'async'], help="Fetch mode of the page workers. [default=sync]")
+    parser.add_argument("-x", "--link-extractor", choices=['streaming', 'html5lib'], help="Parser used to pull links out of pages.")
+    parser.add_argument("--prefetch", type=int, help="Number of unacknowledged messages each worker may hold.")
+    parser.add_argument("-b", "--frontier", default="rabbitmq", choices=['rabbitmq', 'local'], help="Frontier backend; 'rabbitmq' runs MessageQueue over an in-process stand-in for the broker. [default=rabbitmq]")
+    parser.add_argument("--shards", type=int, default=0, help="Number of shards to split the page queue into, with the rabbitmq frontier. [default=0, unsharded]")
+    parser.add_argument("-i", "--inifile", help="webcrawler.ini style file with settings for the crawler.")
+    parser.add_argument("--db", help="SQLite database to create, kept after the run. [default=a temporary file]")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    parser.add_argument("-l", "--loglevel", default="CRITICAL", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Crawler logging level. [default=CRITICAL]")
+
+    return parser.parse_args()
+
+
+def write_inifile(path, args, dbpath, spool_dir):
+    ini = configparser.ConfigParser()
+    if args.inifile:
+        ini.read(args.inifile)
+
+    if not ini.has_section('frontier'):
+        ini.add_section('frontier')
+    ini['frontier']['spool_dir'] = spool_dir
+
+    if not ini.has_section('db-bench'):
+        ini.add_section('db-bench')
+    ini['db-bench']['type'] = 'sqlite'
+    ini['db-bench']['dbname'] = dbpath
+
+    # Connection settings are required but never used
+    if not ini.has_section('mqueue'):
+        ini.add_section('mqueue')
+    for key in ['host', 'port', 'user', 'password', 'vhost']:
+        ini['mqueue'].setdefault(key, '')
+    if args.shards:
+        ini['mqueue']['shards'] = str(args.shards)
+        ini['mqueue'].setdefault('rebalance_interval', '1')
+
+    with open(path, 'w') as out:
+        ini.write(out)
+
+
+def create_scan(graph, name, dbpath):
+    dm.database.initialize(CrawlerSqliteDatabase(dbpath))
+    dm.create_schema()
+
+    scan = dm.Scan.create(name=name, seed_url=graph.seed_url(), search_fqdn_re=r'^127\.0\.0\.\d+$', sub_path_re='^/')
+    for netloc in graph.netlocs:
+        fqdn, port = netloc.split(':')
+        dm.ScanRoot.insert(scan_id=scan.scan_id, fqdn=fqdn, port=port).execute()
+
+    # Every worker opens its own connection
+    dm.release()
+
+
+def run_worker(crawler, role, id, results):
+    standins.stats.instrument(crawler)
+    crawler._init_crawl_thread(id, role)
+    results.put(standins.stats.report(role, id))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(reports, wall):
+    rows = []
+    for r in reports:
+        elapsed = (r['last'] - r['first']) if r['first'] and r['last'] else 0
+        rows.append({
+            'worker': '%s-%d' % (r['role'], r['id']),
+            'messages': r['messages'],
+            'pages': r['pages'],
+            'links': r['links'],
+            'pages_per_sec': r['pages'] / elapsed if elapsed else 0.0,
+            'links_per_sec': r['links'] / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(r['latencies'], 50) * 1000,
+            'p99_ms': percentile(r['latencies'], 99) * 1000,
+            'peak_rss_mb': r['peak_rss'] / 2 ** 20
+        })
+
+    latencies = {}
+    for r in reports:
+        # A pipeline worker's latency covers what a page worker's does
+        latencies.setdefault('link' if r['role'] == 'link' else 'page', []).extend(r['latencies'])
+    for values in latencies.values():
+        values.sort()
+
+    pages = sum(r['pages'] for r in reports)
+    links = sum(r['links'] for r in reports)
+    totals = {
+        'wall_seconds': wall,
+        'pages': pages,
+        'links': links,
+        'pages_per_sec': pages / wall if wall else 0.0,
+        'links_per_sec': links / wall if wall else 0.0,
+        'page_p50_ms': percentile(latencies.get('page', []), 50) * 1000,
+        'page_p99_ms': percentile(latencies.get('page', []), 99) * 1000,
+        'link_p50_ms': percentile(latencies.get('link', []), 50) * 1000,
+        'link_p99_ms': percentile(latencies.get('link', []), 99) * 1000
+    }
+
+    return rows, totals
+
+
+def print_results(rows, totals, graph):
+    print("%-10s %9s %8s %9s %10s %10s %9s %9s %9s" % ('worker', 'messages', 'pages', 'links', 'pages/s', 'links/s', 'p50 ms', 'p99 ms', 'RSS MB'))
+    for row in rows:
+        print("%-10s %9d %8d %9d %10.1f %10.1f %9.1f %9.1f %9.1f" % (row['worker'], row['messages'], row['pages'], row['links'],
+              row['pages_per_sec'], row['links_per_sec'], row['p50_ms'], row['p99_ms'], row['peak_rss_mb']))
+
+    print()
+    print("Fetched %d responses for %d pages in %.2f seconds: %.1f pages/s, %.1f links/s." % (totals['pages'], graph.page_count(), totals['wall_seconds'],
+          totals['pages_per_sec'], totals['links_per_sec']))
+    print("Fetch to persist latency p50 %.1f ms, p99 %.1f ms; link batches p50 %.1f ms, p99 %.1f ms." % (totals['page_p50_ms'], totals['page_p99_ms'],
+          totals['link_p50_ms'], totals['link_p99_ms']))
+    print("Database: %(FoundURLs)d URLs, %(crawled)d crawled, %(Backlinks)d backlinks, %(PageLinks)d page links, %(ScanErrors)d errors." % totals['database'])
+
+
+def main():
+    args = parse_args()
+
+    graph = SiteGraph(fanout=args.fanout, depth=args.depth, page_size=args.page_size, hosts=args.hosts,
+                      slow_hosts=args.slow_hosts, slow_delay=args.slow_delay, error_hosts=args.error_hosts, error_rate=args.error_rate,
+                      redirect_chain=args.redirect_chain, redirect_every=args.redirect_every)
+
+    if args.db and os.path.exists(args.db):
+        sys.exit("The database %s already exists, not overwriting it." % args.db)
+
+    workdir = tempfile.mkdtemp(prefix='crawlbench-')
+    dbpath = args.db or os.path.join(workdir, 'bench.db')
+    site = SyntheticSite(graph).start()
+
+    try:
+        create_scan(graph, 'bench', dbpath)
+
+        inifile = os.path.join(workdir, 'bench.ini')
+        write_inifile(inifile, args, dbpath, os.path.join(workdir, 'frontier'))
+
+        # The crawler names its queues after the scan
+        ctx = multiprocessing.get_context('fork')
+        broker = standins.LocalBroker(ctx, ['bench_' + x + '_queue' for x in ['page', 'link']] + ['bench_page_queue_%d' % x for x in range(args.shards)])
+        standins.LocalMessageQueue.broker = broker
+        frontiers['rabbitmq'] = standins.LocalMessageQueue
+
+        options = argparse.Namespace(inifile=inifile, dbprofile='db-bench', processes=1, scan='bench', role='page',
+                                     fetch_mode=args.fetch_mode, link_extractor=args.link_extractor, prefetch=args.prefetch,
+                                     incremental=None, resume=None, frontier=args.frontier, shards=None, loglevel=args.loglevel, writelog=None, quiet=None)
+        config = Configuration(options)
+
+        # Set up the database writer and frontier and seed it the way WebCrawler.run() does, before the workers fork
+        db_writer = None
+        if config.dbconfig['use_writer']:
+            db_writer = SqliteWriter(config.dbname, config.dbconfig).start()
+            config.dbconfig['writer_address'] = db_writer.address
+
+        crawler = wc.WebCrawler(config)
+        crawler.mq = frontiers[config.frontierconfig['backend']](config)
+        crawler._config_mqueue('page')
+        crawler._config_mqueue('link')
+        crawler.push_page(urlparse(config.url_normalizer.normalize(graph.seed_url())[0]), 0)
+        dm.release()
+
+        results = ctx.Queue()
+        workers = [ctx.Process(target=run_worker, args=(crawler, 'page', x + 1, results)) for x in range(args.page_workers)]
+        workers += [ctx.Process(target=run_worker, args=(crawler, 'link', x + 1, results)) for x in range(args.link_workers)]
+        workers += [ctx.Process(target=run_worker, args=(crawler, 'pipeline', x + 1, results)) for x in range(args.pipeline_workers)]
+
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        reports = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        if db_writer:
+            db_writer.stop()
+            config.dbconfig['writer_address'] = None
+
+        # Wall time runs from the first message picked up to the last one acknowledged
+        firsts = [r['first'] for r in reports if r['first']]
+        lasts = [r['last'] for r in reports if r['last']]
+        wall = max(lasts) - min(firsts) if firsts and lasts else time.time() - start
+
+        rows, totals = summarize(sorted(reports, key=lambda r: (['page', 'link', 'pipeline'].index(r['role']), r['id'])), wall)
+
+        dm.init(config)
+        totals['database'] = {m._meta.table_name: m.select().count() for m in [dm.FoundURL, dm.Backlink, dm.PageLink, dm.ScanError]}
+        totals['database']['crawled'] = dm.FoundURL.select().where(dm.FoundURL.is_crawled == 1).count()
+        dm.release()
+
+        print_results(rows, totals, graph)
+
+        if args.json:
+            with open(args.json, 'w') as out:
+                json.dump({ 'args': vars(args), 'workers': rows, 'totals': totals }, out, indent=2)
+    finally:
+        site.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""Stand-ins letting WebCrawler run without RabbitMQ.
+
+RabbitMQ is replaced at the pika level: LocalConnection and LocalChannel provide the handful of
+BlockingConnection/BlockingChannel calls MessageQueue makes, on top of
+multiprocessing queues, so MessageQueue, BatchAcker and BufferedPublisher
+run unchanged. A consumer stops once every message published anywhere has
+been acknowledged, the way the local frontier's consumers do."""
+
+import collections
+import heapq
+import itertools
+import queue
+import resource
+import sys
+import time
+import types
+import zlib
+
+from wclib.mqueue import MessageQueue
+from wclib.metrics import metrics
+
+
+class WorkerStats:
+    """What one worker process did, measured from delivery to the crawler's
+    ack, i.e. from picking up a URL to having persisted what it found."""
+
+    def __init__(self):
+        self.latencies = []
+        self.first = None
+        self.last = None
+        self.started = {}
+
+    def instrument(self, crawler):
+        # Wraps the crawler's consumer callbacks and ack, whatever the frontier
+        def timed(callback):
+            def on_message(ch, method, properties, body):
+                # A message set aside for politeness is delivered again later under the same tag
+                self.started.setdefault(method.delivery_tag, time.perf_counter())
+                self.delivered()
+                return callback(ch, method, properties, body)
+            on_message.__name__ = callback.__name__
+            return on_message
+
+        crawler._mqueue_page_callback = timed(crawler._mqueue_page_callback)
+        crawler._mqueue_link_callback = timed(crawler._mqueue_link_callback)
+
+        ack = crawler.ack
+        def timed_ack(delivery_tag):
+            self.acked(time.perf_counter() - self.started.pop(delivery_tag))
+            ack(delivery_tag)
+        crawler.ack = timed_ack
+
+    def delivered(self):
+        if self.first is None:
+            self.first = time.time()
+
+    def acked(self, latency):
+        self.latencies.append(latency)
+        self.last = time.time()
+
+    def report(self, role, id):
+        # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak_rss *= 1024
+
+        return {
+            'role': role,
+            'id': id,
+            'messages': len(self.latencies),
+            'pages': counter_total('webcrawler_fetch_responses_total'),
+            'links': counter_total('webcrawler_links_total'),
+            'first': self.first,
+            'last': self.last,
+            'latencies': sorted(self.latencies),
+            'peak_rss': peak_rss
+        }
+
+
+def counter_total(name):
+    return sum(value for (key, labels), value in list(metrics.counters.items()) if key == name)
+
+
+# One per worker process
+stats = WorkerStats()
+
+
+class LocalBroker:
+    """Named queues shared by the worker processes. Must be created before
+    they are started, as must any exchanges. outstanding counts messages
+    published but not yet acknowledged, across all processes.
+
+    Exchanges stand in for consistent hash exchanges: a message goes to the
+    bound queue its routing key hashes to."""
+
+    def __init__(self, ctx, queue_names):
+        self.queues = {name: ctx.Queue() for name in queue_names}
+        self.exchanges = {}
+        self.outstanding = ctx.Value('l', 0)
+
+    def bind(self, exchange, queue_name):
+        bound = self.exchanges.setdefault(exchange, [])
+        if queue_name not in bound:
+            bound.append(queue_name)
+
+    def route(self, exchange, routing_key):
+        bound = self.exchanges[exchange]
+        return bound[zlib.crc32(routing_key.encode()) % len(bound)]
+
+    def publish(self, queue_name, body):
+        if isinstance(body, str):
+            body = body.encode()
+        with self.outstanding.get_lock():
+            self.outstanding.value += 1
+        self.queues[queue_name].put(body)
+
+    def purge(self, queue_name):
+        purged = 0
+        while True:
+            try:
+                self.queues[queue_name].get_nowait()
+            except queue.Empty:
+                break
+            purged += 1
+        self.acked(purged)
+        return purged
+
+    def acked(self, count):
+        with self.outstanding.get_lock():
+            self.outstanding.value -= count
+
+    def is_drained(self):
+        return self.outstanding.value == 0
+
+
+class LocalConnection:
+    """Timers and thread safe callbacks, run by whichever channel is consuming."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.timers = []
+        self.sequence = itertools.count()
+        self.callbacks = queue.SimpleQueue()
+
+    def channel(self):
+        return LocalChannel(self)
+
+    def call_later(self, delay, callback):
+        timer = [time.monotonic() + delay, next(self.sequence), callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        timer[2] = None
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def process_events(self):
+        while True:
+            try:
+                self.callbacks.get_nowait()()
+            except queue.Empty:
+                break
+
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            callback = heapq.heappop(self.timers)[2]
+            if callback:
+                callback()
+
+    def process_data_events(self, time_limit=0):
+        self.process_events()
+        wait = self.next_timer()
+        time.sleep(max(min(wait, time_limit) if wait is not None else time_limit, 0))
+        self.process_events()
+
+    def next_timer(self):
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        return self.timers[0][0] - time.monotonic() if self.timers else None
+
+    def close(self):
+        pass
+
+
+class LocalChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.transactional = False
+        self.pending = []
+
+        self.consumers = {}
+        self.consumer_tags = itertools.count(1)
+        self.prefetch_count = 1
+        self.global_qos = False
+        self.delivery_tags = itertools.count(1)
+        self.unacked = {}
+
+    def queue_declare(self, queue, durable=True, arguments=None):
+        # Priority queues are accepted, but deliver first in, first out all the same
+        return types.SimpleNamespace(method=types.SimpleNamespace(message_count=self.broker.queues[queue].qsize()))
+
+    def queue_purge(self, queue):
+        return types.SimpleNamespace(method=types.SimpleNamespace(message_count=self.broker.purge(queue)))
+
+    def exchange_declare(self, exchange, exchange_type, durable=True):
+        self.broker.exchanges.setdefault(exchange, [])
+
+    def queue_bind(self, queue, exchange, routing_key):
+        self.broker.bind(exchange, queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if exchange:
+            routing_key = self.broker.route(exchange, routing_key)
+        if self.transactional:
+            self.pending.append((routing_key, body))
+        else:
+            self.broker.publish(routing_key, body)
+
+    def tx_select(self):
+        self.transactional = True
+
+    def tx_commit(self):
+        for routing_key, body in self.pending:
+            self.broker.publish(routing_key, body)
+        self.pending = []
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        # Like RabbitMQ, the limit is per consumer unless it is global to the channel
+        self.prefetch_count = prefetch_count or sys.maxsize
+        self.global_qos = global_qos
+
+    def basic_consume(self, queue, on_message_callback):
+        consumer_tag = 'ctag%d' % next(self.consumer_tags)
+        self.consumers[consumer_tag] = (queue, on_message_callback)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        del self.consumers[consumer_tag]
+        return []
+
+    def _ready(self):
+        # Consumers the prefetch limit lets have another message
+        if self.global_qos:
+            return list(self.consumers.items()) if len(self.unacked) < self.prefetch_count else []
+        held = collections.Counter(self.unacked.values())
+        return [x for x in self.consumers.items() if held[x[0]] < self.prefetch_count]
+
+    def _get(self, consumers):
+        # Block on a lone consumer's queue for a while, take turns polling several
+        if len(consumers) == 1:
+            consumer_tag, (queue_name, callback) = consumers[0]
+            wait = self.connection.next_timer()
+            try:
+                return (consumer_tag, callback, self.broker.queues[queue_name].get(timeout=min(wait, 0.05) if wait is not None else 0.05))
+            except queue.Empty:
+                return None
+
+        for consumer_tag, (queue_name, callback) in consumers:
+            try:
+                return (consumer_tag, callback, self.broker.queues[queue_name].get_nowait())
+            except queue.Empty:
+                pass
+        time.sleep(0.005)
+        return None
+
+    def start_consuming(self):
+        # Like pika, only consumes while there are consumers to consume for
+        while self.consumers:
+            self.connection.process_events()
+
+            consumers = self._ready()
+            if consumers:
+                message = self._get(consumers)
+                if message is not None:
+                    tag = next(self.delivery_tags)
+                    self.unacked[tag] = message[0]
+                    message[1](self, types.SimpleNamespace(delivery_tag=tag), None, message[2])
+                    continue
+            else:
+                time.sleep(0.001)
+
+            # Timers may be pending forever, e.g. shard rebalancing, and anything a timer still has to do holds back an ack
+            if not self.unacked and self.broker.is_drained():
+                return
+
+    def stop_consuming(self):
+        self.consumers.clear()
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if multiple:
+            tags = [x for x in self.unacked if x <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        for tag in tags:
+            del self.unacked[tag]
+        self.broker.acked(len(tags))
+
+    def close(self):
+        pass
+
+
+class LocalMessageQueue(MessageQueue):
+    """MessageQueue over a LocalBroker, which has to be assigned to the
+    class before the crawler creates any."""
+
+    broker = None
+
+    drains = True
+
+    def __init__(self, config):
+        self.mq_conn = LocalConnection(self.broker)
+        super().__init__(config)
+
+    def wait_for_shards(self):
+        # Once the crawl is done no rebalance is coming to wait for
+        if self.broker.is_drained():
+            return False
+        self.mq_conn.process_data_events(time_limit=0.05)
+        return True
@@ -0,0 +1,154 @@
+"""A synthetic website for benchmarking the crawler offline.
+
+Pages form a tree: the page at /d<depth>/p<index>.html links to fanout
+children at the next depth, back to its parent and back to the home page,
+so link workers see plenty of URLs they already know. Pages are spread over
+several hosts, each one a separate loopback address (127.0.0.1, 127.0.0.2,
+...) with its own server, so per host politeness applies as it would on the
+web. Some hosts can be made slow or erratic, and some links can go through a
+chain of redirects first."""
+
+import hashlib
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SiteGraph:
+
+    page_re = re.compile(r'^/d(\d+)/p(\d+)\.html$')
+    redirect_re = re.compile(r'^/redirect/(\d+)(/d\d+/p\d+\.html)$')
+
+    def __init__(self, fanout=5, depth=3, page_size=8192, hosts=1, slow_hosts=0, slow_delay=0.2,
+                 error_hosts=0, error_rate=0.2, redirect_chain=0, redirect_every=10):
+        self.fanout = fanout
+        self.depth = depth
+        self.page_size = page_size
+        self.hosts = hosts
+        self.slow_hosts = slow_hosts
+        self.slow_delay = slow_delay
+        self.error_hosts = error_hosts
+        self.error_rate = error_rate
+        self.redirect_chain = redirect_chain
+        self.redirect_every = redirect_every
+
+        # Filled in once the servers are listening
+        self.netlocs = []
+
+    def page_count(self):
+        return sum(self.fanout ** d for d in range(self.depth + 1))
+
+    def host_of(self, depth, index):
+        return index % self.hosts if depth else 0
+
+    def url(self, depth, index):
+        return 'http://%s/d%d/p%d.html' % (self.netlocs[self.host_of(depth, index)], depth, index)
+
+    def seed_url(self):
+        return self.url(0, 0)
+
+    def is_slow(self, host):
+        return host < self.slow_hosts
+
+    def is_erroring(self, host, path):
+        # Hosts at the end of the list fail a fixed share of their pages, the same ones every run
+        if host < self.hosts - self.error_hosts:
+            return False
+        return int(hashlib.md5(path.encode()).hexdigest()[:8], 16) % 1000 < self.error_rate * 1000
+
+    def link(self, depth, index):
+        url = self.url(depth, index)
+        if self.redirect_chain and index % self.redirect_every == 0:
+            netloc, path = url[len('http://'):].split('/', 1)
+            return 'http://%s/redirect/%d/%s' % (netloc, self.redirect_chain, path)
+        return url
+
+    def page(self, depth, index):
+        links = []
+        if depth < self.depth:
+            links.extend(self.link(depth + 1, index * self.fanout + k) for k in range(self.fanout))
+        if depth > 0:
+            links.append(self.url(depth - 1, index // self.fanout))
+            links.append(self.url(0, 0))
+
+        body = ['<!DOCTYPE html>\n<html><head><title>Page %d at depth %d</title></head><body>\n' % (index, depth)]
+        body.extend('<p><a href="%s">link %d</a></p>\n' % (x, n) for n, x in enumerate(links))
+
+        # Pad the page out to the requested size with text the link extractor has to wade through
+        size = sum(len(x) for x in body) + len('<p></p></body></html>\n')
+        filler = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+        if size < self.page_size:
+            body.append('<p>%s</p>' % (filler * (self.page_size // len(filler) + 1))[:self.page_size - size])
+        body.append('</body></html>\n')
+
+        return ''.join(body).encode()
+
+    def handler(self, host):
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            # Headers and body go out in separate writes; don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if graph.is_slow(host):
+                    time.sleep(graph.slow_delay)
+
+                match = graph.redirect_re.match(self.path)
+                if match:
+                    remaining = int(match.group(1)) - 1
+                    location = '/redirect/%d%s' % (remaining, match.group(2)) if remaining else match.group(2)
+                    return self.respond(301, b'', location=location)
+
+                match = graph.page_re.match(self.path)
+                if not match:
+                    return self.respond(404, b'Not found')
+
+                depth, index = int(match.group(1)), int(match.group(2))
+                if depth > graph.depth or index >= graph.fanout ** depth or graph.host_of(depth, index) != host:
+                    return self.respond(404, b'Not found')
+
+                if graph.is_erroring(host, self.path):
+                    return self.respond(500, b'Internal server error')
+
+                self.respond(200, graph.page(depth, index), content_type='text/html; charset=utf-8')
+
+            def respond(self, status, body, content_type='text/plain', location=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if location:
+                    self.send_header('Location', location)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class SyntheticSite:
+    """Serves a SiteGraph, one threaded HTTP server per host."""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.servers = []
+
+    def start(self):
+        for host in range(self.graph.hosts):
+            server = ThreadingHTTPServer(('127.0.0.%d' % (host + 1), 0), self.graph.handler(host))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+            self.graph.netlocs.append('%s:%d' % server.server_address)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
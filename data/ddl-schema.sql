@@ -52,11 +52,16 @@ CREATE TABLE IF NOT EXISTS `webcrawler`.`FoundURLs` (
   `is_crawled` TINYINT(4) NULL DEFAULT NULL,
   `is_blacklisted` TINYINT(4) NULL DEFAULT NULL,
   `next_url_id` INT(11) NULL DEFAULT NULL,
+  `final_url_id` INT(11) NULL DEFAULT NULL,
+  `depth` INT(11) NULL DEFAULT NULL,
   `status_code` VARCHAR(3) NULL DEFAULT NULL,
   `content_type` VARCHAR(128) NULL DEFAULT NULL,
   `page_title` TEXT NULL DEFAULT NULL,
   `created_timestamp` DATETIME NULL DEFAULT NULL,
   `crawled_timestamp` DATETIME NULL DEFAULT NULL,
+  `etag` VARCHAR(255) NULL DEFAULT NULL,
+  `last_modified` VARCHAR(64) NULL DEFAULT NULL,
+  `content_digest` VARCHAR(64) NULL DEFAULT NULL,
   PRIMARY KEY (`url_id`),
   UNIQUE INDEX `UNIQUE-scan_id-url_hash` (`scan_id` ASC, `url_hash` ASC),
   INDEX `INDEX-scan_id-url_hash` (`scan_id` ASC, `url_hash` ASC),
@@ -65,6 +70,7 @@ CREATE TABLE IF NOT EXISTS `webcrawler`.`FoundURLs` (
   INDEX `idx_FoundURLs_root_stem` (`root_stem` ASC),
   INDEX `idx_FoundURLs_status_code` (`status_code` ASC),
   INDEX `fk_FoundURLs-next_url_id_idx` (`next_url_id` ASC),
+  INDEX `idx_scan_id_final_url_id` (`scan_id` ASC, `final_url_id` ASC),
   CONSTRAINT `fk_FoundURLs_PK`
     FOREIGN KEY (`scan_id`)
     REFERENCES `webcrawler`.`Scans` (`scan_id`)
@@ -189,6 +195,27 @@ DEFAULT CHARACTER SET = utf8mb4
 COLLATE = utf8mb4_unicode_ci;
 
 
+-- -----------------------------------------------------
+-- Table `webcrawler`.`ScanWorkers`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `webcrawler`.`ScanWorkers` ;
+
+CREATE TABLE IF NOT EXISTS `webcrawler`.`ScanWorkers` (
+  `scan_id` INT(11) NOT NULL,
+  `worker_id` VARCHAR(255) NOT NULL,
+  `shards` TEXT NULL DEFAULT NULL,
+  `heartbeat_timestamp` DATETIME NULL DEFAULT NULL,
+  UNIQUE INDEX `idx_ScanWorkers_UNIQUE` (`scan_id` ASC, `worker_id` ASC),
+  CONSTRAINT `fk_ScanWorkers-scan_id`
+    FOREIGN KEY (`scan_id`)
+    REFERENCES `webcrawler`.`Scans` (`scan_id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = utf8mb4
+COLLATE = utf8mb4_unicode_ci;
+
+
 SET SQL_MODE=@OLD_SQL_MODE;
 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS;
 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS;
@@ -0,0 +1,52 @@
+-- -----------------------------------------------------
+-- Upgrades for an existing `webcrawler` schema created from
+-- an older ddl-schema.sql. Apply the sections added since
+-- the schema was created, oldest first.
+-- -----------------------------------------------------
+
+USE `webcrawler` ;
+
+-- -----------------------------------------------------
+-- Conditional re-crawl (--incremental)
+-- -----------------------------------------------------
+ALTER TABLE `webcrawler`.`FoundURLs`
+  ADD COLUMN `etag` VARCHAR(255) NULL DEFAULT NULL AFTER `crawled_timestamp`,
+  ADD COLUMN `last_modified` VARCHAR(64) NULL DEFAULT NULL AFTER `etag`,
+  ADD COLUMN `content_digest` VARCHAR(64) NULL DEFAULT NULL AFTER `last_modified`;
+
+-- -----------------------------------------------------
+-- Final target of every redirect chain
+--
+-- Redirects logged before the upgrade have no final_url_id;
+-- the first edge export of their scan fills it in.
+-- -----------------------------------------------------
+ALTER TABLE `webcrawler`.`FoundURLs`
+  ADD COLUMN `final_url_id` INT(11) NULL DEFAULT NULL AFTER `next_url_id`,
+  ADD INDEX `idx_scan_id_final_url_id` (`scan_id` ASC, `final_url_id` ASC);
+
+-- -----------------------------------------------------
+-- Page workers sharing a sharded page queue
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `webcrawler`.`ScanWorkers` (
+  `scan_id` INT(11) NOT NULL,
+  `worker_id` VARCHAR(255) NOT NULL,
+  `shards` TEXT NULL DEFAULT NULL,
+  `heartbeat_timestamp` DATETIME NULL DEFAULT NULL,
+  UNIQUE INDEX `idx_ScanWorkers_UNIQUE` (`scan_id` ASC, `worker_id` ASC),
+  CONSTRAINT `fk_ScanWorkers-scan_id`
+    FOREIGN KEY (`scan_id`)
+    REFERENCES `webcrawler`.`Scans` (`scan_id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB
+DEFAULT CHARACTER SET = utf8mb4
+COLLATE = utf8mb4_unicode_ci;
+
+-- -----------------------------------------------------
+-- Depth of every URL let onto the page queue ([budget])
+--
+-- URLs queued before the upgrade have none and do not
+-- count against the page limits.
+-- -----------------------------------------------------
+ALTER TABLE `webcrawler`.`FoundURLs`
+  ADD COLUMN `depth` INT(11) NULL DEFAULT NULL AFTER `final_url_id`;
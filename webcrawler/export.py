@@ -0,0 +1,41 @@
+"""This is the entry point for exporting a scan's edges."""
+
+import sys
+
+from wclib import model as dm
+from wclib.options import ExportOptions
+from wclib.export import ExportConfiguration, EdgeExporter, edge_writers
+
+
+def launch_export():
+    """ Actual point of execution for exporting the edges of a scan."""
+    options = ExportOptions().params
+    config = ExportConfiguration(options)
+
+    dm.init(config)
+    scan = dm.Scan.get_or_none(dm.Scan.name == options.scan)
+    if scan is None:
+        config.logger.error("There is no scan named %s.", options.scan)
+        sys.exit(255)
+
+    exporter = EdgeExporter(config, scan, options.chunk_size)
+    if options.repair_redirects:
+        config.logger.info("Repaired the final target of %s redirects.", str(exporter.repair_final_targets()))
+
+    output = options.output or '%s-edges.%s' % (options.scan, options.format)
+    try:
+        writer = edge_writers[options.format](output)
+    except ImportError as ie:
+        config.logger.error("The %s format is not available: %s", options.format, ie)
+        sys.exit(255)
+
+    try:
+        edges = exporter.export(writer)
+    finally:
+        writer.close()
+
+    config.logger.info("Wrote %s edges to %s.", str(edges), output)
+
+
+if __name__ == '__main__':
+    launch_export()
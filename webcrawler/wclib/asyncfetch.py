@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+
+from urllib.parse import urljoin
+
+import aiohttp
+import requests
+
+from .mediatype import sniff_html
+from .metrics import metrics
+
+
+class AsyncFetcher:
+    """Runs page fetches on an asyncio event loop in a background thread so
+    that a single worker process can keep many requests in flight. A global
+    semaphore caps the total number of concurrent requests and a semaphore per
+    hostname keeps us from piling onto a single server."""
+
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, config, wants_links):
+        self.config = config
+        self.logger = config.logger
+        self.wants_links = wants_links
+
+        self.concurrency = config.fetchconfig['concurrency']
+        self.per_host_concurrency = config.fetchconfig['per_host_concurrency']
+        self.timeout = config.fetchconfig['timeout']
+        self.max_bytes = config.fetchconfig['max_bytes']
+        self.deadline = config.fetchconfig['deadline']
+        self.media_types = config.media_types
+
+        self.host_limits = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='webcrawler-fetch', daemon=True)
+        self.thread.start()
+
+        asyncio.run_coroutine_threadsafe(self._init_session(), self.loop).result()
+
+    async def _init_session(self):
+        self.global_limit = asyncio.Semaphore(self.concurrency)
+
+        # Lookups go through the worker's DNSCache when there is one, aiohttp's own cache only saves the trip to its thread pool
+        connector = aiohttp.TCPConnector(ssl=False, limit=self.concurrency, limit_per_host=self.per_host_concurrency,
+                                         ttl_dns_cache=self.config.fetchconfig['dns_ttl'] if self.config.fetchconfig['dns_cache'] else 10)
+
+        # Same connect and time to first byte timings as the requests sessions report
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_connection_create_start.append(self._on_connection_create_start)
+        trace.on_connection_create_end.append(self._on_connection_create_end)
+        trace.on_request_end.append(self._on_request_end)
+
+        # Like requests' timeout, the limit is per connect and per read; the deadline bounds a whole response
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.config.sessionconfig['headers'],
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+            trace_configs=[trace])
+
+    async def _on_request_start(self, session, context, params):
+        context.started = time.perf_counter()
+        context.scheme = params.url.scheme
+
+    async def _on_connection_create_start(self, session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def _on_connection_create_end(self, session, context, params):
+        metrics.observe('webcrawler_connect_seconds', time.perf_counter() - context.connect_started, scheme=context.scheme)
+        metrics.inc('webcrawler_connections_total', scheme=context.scheme)
+
+    async def _on_request_end(self, session, context, params):
+        metrics.observe('webcrawler_ttfb_seconds', time.perf_counter() - context.started, host=params.url.host)
+
+    def submit(self, url, callback, headers=None):
+        """Schedule a fetch of the parsed url. The callback receives the
+        concurrent.futures.Future once the fetch completes and is run on the
+        event loop thread, so it must hand any further work back to the caller's
+        own thread."""
+        future = asyncio.run_coroutine_threadsafe(self.fetch(url, headers), self.loop)
+        future.add_done_callback(callback)
+        return future
+
+    def _host_limit(self, hostname):
+        if hostname not in self.host_limits:
+            self.host_limits[hostname] = asyncio.Semaphore(self.per_host_concurrency)
+        return self.host_limits[hostname]
+
+    async def fetch(self, url, headers=None):
+        async with self.global_limit, self._host_limit(url.hostname):
+            self.logger.info('Evaluating URL %s', url.geturl())
+            start = time.perf_counter()
+            deadline = time.monotonic() + self.deadline
+            async with self.session.get(url.geturl(), headers=headers, allow_redirects=False) as r:
+                content_type = r.headers.get('Content-Type')
+
+                # Read up to max_bytes of the body, until the deadline; it gets decoded and parsed back on the consumer's thread
+                body = None
+                if self.wants_links(url, r.status, content_type):
+                    body = []
+                    received = 0
+                    truncated = None
+                    async for chunk in r.content.iter_chunked(65536):
+                        # Without a telling Content-Type the first chunk has to show it is HTML
+                        if not body and self.media_types.needs_sniffing(content_type):
+                            is_html = sniff_html(chunk)
+                            metrics.inc('webcrawler_fetch_sniffed_total', result='html' if is_html else 'other')
+                            if not is_html:
+                                body = None
+                                break
+                        body.append(chunk)
+                        received += len(chunk)
+                        if received >= self.max_bytes:
+                            truncated = 'size'
+                            break
+                        if time.monotonic() >= deadline:
+                            truncated = 'deadline'
+                            break
+                    metrics.inc('webcrawler_fetch_bytes_total', received)
+                    if truncated:
+                        self.logger.debug("Stopped reading %s after %s bytes (%s).", url.geturl(), str(received), truncated)
+                        metrics.inc('webcrawler_fetch_truncated_total', reason=truncated)
+
+                metrics.observe('webcrawler_fetch_seconds', time.perf_counter() - start, host=url.hostname)
+                metrics.inc('webcrawler_fetch_responses_total', status=r.status)
+
+                # Mirror requests' Response.next so log_url() can treat both the same
+                redirect_next = None
+                if r.status in self.redirect_codes and 'Location' in r.headers:
+                    redirect_next = requests.Request('GET', urljoin(url.geturl(), r.headers['Location'])).prepare()
+
+                return { 'status_code': r.status, 'content_type': content_type, 'body': body, 'encoding': self.media_types.charset(content_type), 'redirect_next': redirect_next, 'retry_after': r.headers.get('Retry-After'),
+                         'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified') }
+
+    async def _close_session(self):
+        await self.session.close()
+
+    def close(self):
+        self.logger.debug('Shutting down the async fetcher.')
+        asyncio.run_coroutine_threadsafe(self._close_session(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
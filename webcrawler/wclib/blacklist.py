@@ -0,0 +1,88 @@
+import re
+
+
+class PrefixTrie:
+    """Character trie answering "does the string start with any of the
+    stored prefixes" in O(len(string)), regardless of how many are stored."""
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = True
+
+    def matches(self, text):
+        node = self.root
+        if None in node:
+            return True
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+def _alternation(patterns, escape=False):
+    if not patterns:
+        return None
+    if escape:
+        patterns = [re.escape(x) for x in patterns]
+    return re.compile('|'.join('(?:' + x + ')' for x in patterns))
+
+
+class HostRules:
+
+    def __init__(self, rules):
+        # A host listed without any rules is blacklisted outright
+        self.everything = rules == {}
+        self.schemes = frozenset(rules.get('scheme', []))
+        self.netlocs = frozenset(rules.get('netloc', []))
+        self.paths = PrefixTrie(rules['path']) if 'path' in rules else None
+        self.query = _alternation(rules.get('query'), escape=True)
+
+
+class URLFilter:
+    """The scan blacklist and the httpconfig token/scheme rules compiled once
+    per process. Per host rules are keyed on the hostname; paths go into a
+    prefix trie and query fragments into one combined regex, so a check
+    costs O(len(url)) rather than O(number of rules)."""
+
+    def __init__(self, blacklist, httpconfig):
+        self.hosts = {fqdn: HostRules(rules) for fqdn, rules in blacklist.items()}
+        self.invalid_tokens = _alternation(httpconfig['invalid_tokens'])
+        self.schemes = frozenset(httpconfig['schemes'])
+        self.invalid_schemes = _alternation(httpconfig['invalid_schemes'])
+
+    def is_blacklisted(self, url):
+        rules = self.hosts.get(url.hostname)
+        if rules is not None:
+            if rules.everything:
+                return True
+            if url.scheme in rules.schemes:
+                return True
+            if rules.paths is not None and rules.paths.matches(url.path):
+                return True
+            if rules.query is not None and rules.query.search(url.query):
+                return True
+            if url.netloc in rules.netlocs:
+                return True
+
+        # Check for other bad situations (e.g. links with malformed mailto:, etc.)
+        if self.invalid_tokens is not None and self.invalid_tokens.search(url.geturl()):
+            return True
+
+        return False
+
+    def is_valid_scheme(self, scheme):
+        return scheme in self.schemes
+
+    def has_invalid_scheme(self, path):
+        # A scheme embedded at the start of the path (e.g. a relative "mailto:...")
+        return self.invalid_schemes is not None and self.invalid_schemes.match(path) is not None
@@ -0,0 +1,68 @@
+import time
+
+from . import model as dm
+from .metrics import metrics
+
+
+class CrawlBudget:
+    """Limits on how far a scan's frontier grows: how many links deep from
+    the seed it goes (redirects do not count) and how many pages it lets
+    onto the page queue per root stem and per hostname. A limit of 0 is no
+    limit.
+
+    Every URL let onto the page queue has its depth recorded in FoundURLs,
+    and what counts against a limit is the URLs recorded there, by all
+    workers together. Each worker reads a count from the database at most
+    every refresh_interval seconds and adds what it lets in itself until
+    the next read, so the workers of a scan can overshoot a limit by what
+    they let in between two reads."""
+
+    def __init__(self, config):
+        self.logger = config.logger
+        self.scan_id = config.scan.scan_id
+        self.max_depth = config.budgetconfig['max_depth']
+        self.max_pages = {
+            'root_stem': config.budgetconfig['max_pages_per_root_stem'],
+            'host': config.budgetconfig['max_pages_per_host']
+        }
+        self.refresh_interval = config.budgetconfig['refresh_interval']
+
+        # (limit, key) -> [pages, when they were last counted]
+        self.counts = {}
+
+    def _query(self, limit, key):
+        query = dm.FoundURL.select().where((dm.FoundURL.scan_id == self.scan_id) & dm.FoundURL.depth.is_null(False))
+        if limit == 'root_stem':
+            return query.where(dm.FoundURL.root_stem == key)
+
+        # A host's root stems are the hostname itself and, for the scan's roots, hostname/first-path-segment
+        return query.where((dm.FoundURL.root_stem == key) | dm.FoundURL.root_stem.startswith(key + '/'))
+
+    def pages(self, limit, key):
+        now = time.monotonic()
+        count = self.counts.get((limit, key))
+        if count is None or now - count[1] >= self.refresh_interval:
+            with metrics.timer('webcrawler_db_seconds', statement='budget_count'):
+                count = [self._query(limit, key).count(), now]
+            self.counts[(limit, key)] = count
+        return count[0]
+
+    def admit(self, url, root_stem, depth):
+        """Whether url, not let onto the page queue before, may go on it at
+        depth. If so it counts against its root stem's and host's limits."""
+        if self.max_depth and depth > self.max_depth:
+            metrics.inc('webcrawler_budget_rejected_total', limit='depth')
+            self.logger.debug("Not queueing URL %s, at depth %s.", url.geturl(), str(depth))
+            return False
+
+        keys = {'root_stem': root_stem, 'host': url.hostname}
+        for limit, key in keys.items():
+            if self.max_pages[limit] and key and self.pages(limit, key) >= self.max_pages[limit]:
+                metrics.inc('webcrawler_budget_rejected_total', limit=limit)
+                self.logger.debug("Not queueing URL %s, %s %s is out of budget.", url.geturl(), limit, key)
+                return False
+
+        for limit, key in keys.items():
+            if self.max_pages[limit] and key:
+                self.counts[(limit, key)][0] += 1
+        return True
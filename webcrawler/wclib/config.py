@@ -4,6 +4,12 @@ import sys
 import os
 
 from . import model as dm
+from .linkextract import extractors
+from .blacklist import URLFilter
+from .urlnorm import URLNormalizer
+from .mediatype import MediaTypeClassifier
+from .frontier import frontiers
+from .sharding import parse_shards
 
 class Configuration:
 
@@ -11,11 +17,20 @@ class Configuration:
         self.options = options
         self.logger = self._init_logging()
         self.ini = self._init_inifile()
-        self.dbname, self.dbconfig = self._init_dbconfig()
+        self.dbtype, self.dbname, self.dbconfig = self._init_dbconfig()
+        self.frontierconfig = self._init_frontierconfig()
         self.mqueue = self._init_mqueueconfig()
         self.root_fqdns, self.blacklist, self.scan = self._init_scanconfig()
         self.httpconfig = self._init_httpconfig()
+        self.url_filter = URLFilter(self.blacklist, self.httpconfig)
+        self.url_normalizer = self._init_urlnormalizer()
+        self.media_types = self._init_mediatypes()
         self.sessionconfig = self._init_sessionconfig()
+        self.fetchconfig = self._init_fetchconfig()
+        self.cacheconfig = self._init_cacheconfig()
+        self.politeconfig = self._init_politeconfig()
+        self.budgetconfig = self._init_budgetconfig()
+        self.metricsconfig = self._init_metricsconfig()
 
     def _init_logging(self):
         # Set up logging
@@ -66,6 +81,15 @@ class Configuration:
             self.logger.error("The ini file %s does not contain database configuration section %s.", self.options.inifile, self.options.dbprofile)
             sys.exit(255)
         
+        # A profile of type sqlite is a file on this machine, anything else a MySQL server
+        db_type = self.ini.get(self.options.dbprofile, 'type', fallback='mysql')
+        if db_type not in ('mysql', 'sqlite'):
+            self.logger.error("Invalid configuration for profile %s: unknown type %s, must be mysql or sqlite.", self.options.dbprofile, db_type)
+            sys.exit(255)
+
+        if db_type == 'sqlite':
+            return (db_type,) + self._init_sqliteconfig()
+
         try:
             db_name = self.ini[self.options.dbprofile]['dbname']
             db_config = {
@@ -73,11 +97,46 @@ class Configuration:
                 'use_unicode': True, 
                 'host': self.ini[self.options.dbprofile]['host'], 
                 'user': self.ini[self.options.dbprofile]['user'], 
-                'password': self.ini[self.options.dbprofile]['password']
+                'password': self.ini[self.options.dbprofile]['password'],
+
+                # Each process keeps a pool of its own, so the server sees at most processes times max_connections
+                'max_connections': self.ini.getint(self.options.dbprofile, 'max_connections', fallback=4),
+                'stale_timeout': self.ini.getint(self.options.dbprofile, 'stale_timeout', fallback=300),
+                'reconnect_attempts': self.ini.getint(self.options.dbprofile, 'reconnect_attempts', fallback=10),
+                'reconnect_delay': self.ini.getfloat(self.options.dbprofile, 'reconnect_delay', fallback=1.0)
             }
         except KeyError as ke:
             self.logger.error("Invalid configuration for profile %s. Configuration is missing %s.", self.options.dbprofile, ke)
             sys.exit(255)
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for profile %s: %s", self.options.dbprofile, ve)
+            sys.exit(255)
+
+        return (db_type, db_name, db_config)
+
+    def _init_sqliteconfig(self):
+        try:
+            db_name = self.ini[self.options.dbprofile]['dbname']
+            db_config = {
+                # Readers never block the writer, nor it them; only a crash of the machine can lose the last commits
+                'pragmas': {
+                    'journal_mode': 'wal',
+                    'synchronous': 'normal',
+                    'cache_size': -1024 * self.ini.getint(self.options.dbprofile, 'cache_mb', fallback=64)
+                },
+                'timeout': self.ini.getint(self.options.dbprofile, 'timeout', fallback=30),
+                'use_writer': self.ini.getboolean(self.options.dbprofile, 'writer', fallback=True),
+                'writer_batch_size': self.ini.getint(self.options.dbprofile, 'writer_batch_size', fallback=200),
+
+                # Filled in once the writer process is up
+                'writer_address': None
+            }
+        except KeyError as ke:
+            self.logger.error("Invalid configuration for profile %s. Configuration is missing %s.", self.options.dbprofile, ke)
+            sys.exit(255)
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for profile %s: %s", self.options.dbprofile, ve)
+            sys.exit(255)
 
         return (db_name, db_config)
 
@@ -85,6 +144,8 @@ class Configuration:
 
         # Bootstrap the database session
         dm.init(self)
+        if self.dbtype == 'sqlite':
+            dm.create_schema()
 
         scan, created = dm.Scan.get_or_create(name=self.options.scan)
 
@@ -116,23 +177,100 @@ class Configuration:
                     blacklist[bl.fqdn]['query'] = []
                 blacklist[bl.fqdn]['query'].append(bl.query)
 
+        # The workers are forked after this and open their own connections; one shared with them corrupts the session
+        dm.release()
+
         return (root_fqdns, blacklist, scan)
 
+    def _init_frontierconfig(self):
+        # The [frontier] section is optional; by default the crawl goes through RabbitMQ
+        try:
+            frontierconfig = {
+                'backend': self.ini.get('frontier', 'backend', fallback='rabbitmq'),
+                'spool_dir': self.ini.get('frontier', 'spool_dir', fallback='frontier'),
+                'memory_size': self.ini.getint('frontier', 'memory_size', fallback=10000),
+                'link_processes': self.ini.getint('frontier', 'link_processes', fallback=1),
+                'priorities': self.ini.getint('frontier', 'priorities', fallback=0)
+            }
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'frontier', ve)
+            sys.exit(255)
+
+        if self.options.frontier:
+            frontierconfig['backend'] = self.options.frontier
+
+        if frontierconfig['backend'] not in frontiers:
+            self.logger.error("Unknown frontier backend %s, must be one of %s.", frontierconfig['backend'], ', '.join(frontiers))
+            sys.exit(255)
+
+        # Same limit as RabbitMQ's x-max-priority; 0 keeps the page queue first in, first out
+        if not 0 <= frontierconfig['priorities'] <= 255:
+            self.logger.error("Invalid configuration for section %s: priorities must be between 0 and 255.", 'frontier')
+            sys.exit(255)
+
+        # A local frontier runs page and link workers together, with RabbitMQ each invocation plays one role
+        if frontierconfig['backend'] == 'rabbitmq' and not self.options.role:
+            self.logger.error("A role is required when crawling through RabbitMQ.")
+            sys.exit(255)
+
+        return frontierconfig
+
     def _init_mqueueconfig(self):
-        if not 'mqueue' in self.ini.sections():
-            self.logger.error("The ini file %s does not contain message queue configuration section 'mqueue'.", self.options.inifile)
+        queue_config = {}
+
+        # Only the RabbitMQ frontier needs to know where the broker is
+        if self.frontierconfig['backend'] == 'rabbitmq':
+            if not 'mqueue' in self.ini.sections():
+                self.logger.error("The ini file %s does not contain message queue configuration section 'mqueue'.", self.options.inifile)
+                sys.exit(255)
+
+            try:
+                queue_config = {
+                    'host': self.ini['mqueue']['host'],
+                    'port': self.ini['mqueue']['port'],
+                    'user': self.ini['mqueue']['user'],
+                    'password': self.ini['mqueue']['password'],
+                    'vhost': self.ini['mqueue']['vhost']
+                }
+            except KeyError as ke:
+                self.logger.error("Invalid configuration for profile %s. Configuration is missing %s.", 'mqueue', ke)
+                sys.exit(255)
+
+        # Optional tuning of consumers and of the buffered publisher used by link workers
+        try:
+            queue_config['prefetch_count'] = self.ini.getint('mqueue', 'prefetch_count', fallback=None)
+            queue_config['ack_batch_size'] = self.ini.getint('mqueue', 'ack_batch_size', fallback=1)
+            queue_config['ack_batch_delay'] = self.ini.getfloat('mqueue', 'ack_batch_delay', fallback=0.1)
+            queue_config['buffered_publish'] = self.ini.getboolean('mqueue', 'buffered_publish', fallback=True)
+            queue_config['publish_batch_size'] = self.ini.getint('mqueue', 'publish_batch_size', fallback=100)
+            queue_config['publish_batch_delay'] = self.ini.getfloat('mqueue', 'publish_batch_delay', fallback=0.25)
+            queue_config['shards'] = self.ini.getint('mqueue', 'shards', fallback=0)
+            queue_config['rebalance_interval'] = self.ini.getfloat('mqueue', 'rebalance_interval', fallback=30.0)
+            queue_config['link_encoding'] = self.ini.get('mqueue', 'link_encoding', fallback='msgpack')
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'mqueue', ve)
             sys.exit(255)
-        
+
+        # Link workers read either; json is for link workers from before the packed payloads
+        if queue_config['link_encoding'] not in ('msgpack', 'json'):
+            self.logger.error("Invalid configuration for section %s: link_encoding must be msgpack or json.", 'mqueue')
+            sys.exit(255)
+
+        if self.options.prefetch:
+            queue_config['prefetch_count'] = self.options.prefetch
+
+        # Page queue shards are spread over the nodes by RabbitMQ, the local frontier has nowhere to spread them
+        if queue_config['shards'] and self.frontierconfig['backend'] != 'rabbitmq':
+            self.logger.error("Sharding the page queue needs the rabbitmq frontier.")
+            sys.exit(255)
+        if self.options.shards and not queue_config['shards']:
+            self.logger.error("--shards needs shards set in [mqueue].")
+            sys.exit(255)
+
         try:
-            queue_config = {
-                'host': self.ini['mqueue']['host'],
-                'port': self.ini['mqueue']['port'],
-                'user': self.ini['mqueue']['user'],
-                'password': self.ini['mqueue']['password'],
-                'vhost': self.ini['mqueue']['vhost']
-            }
-        except KeyError as ke:
-            self.logger.error("Invalid configuration for profile %s. Configuration is missing %s.", 'mqueue', ke)
+            queue_config['eligible_shards'] = parse_shards(self.options.shards, queue_config['shards'])
+        except ValueError as ve:
+            self.logger.error("Invalid --shards: %s", ve)
             sys.exit(255)
 
         queue_config['queues'] = {}
@@ -145,7 +283,6 @@ class Configuration:
         httpconfig['schemes'] = ['http', 'https']
         httpconfig['invalid_tokens'] = ['http[s]?://mailto:', 'mail to:']
         httpconfig['invalid_schemes'] = ['tel:', 'mailto:', 'mail to:']
-        httpconfig['allowed_content_types'] = ['text/html', 'text/html; charset=UTF-8', 'text/html; charset=utf-8']
 
         return httpconfig
 
@@ -160,6 +297,141 @@ class Configuration:
         sessionconfig['headers']['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8'
         sessionconfig['headers']['Accept-Encoding'] = 'gzip, deflate, br'
         sessionconfig['headers']['Accept-Language'] = 'en-US,en;q=0.9'
-        sessionconfig['headers']['Range'] = 'bytes=0-1000000'
 
-        return sessionconfig
\ No newline at end of file
+        return sessionconfig
+
+    def _init_fetchconfig(self):
+        # The [fetch] section is optional; fall back to sane defaults
+        try:
+            fetchconfig = {
+                'timeout': self.ini.getint('fetch', 'timeout', fallback=10),
+                'concurrency': self.ini.getint('fetch', 'concurrency', fallback=200),
+                'pipeline_threads': self.ini.getint('fetch', 'pipeline_threads', fallback=16),
+                'per_host_concurrency': self.ini.getint('fetch', 'per_host_concurrency', fallback=4),
+                'max_bytes': self.ini.getint('fetch', 'max_bytes', fallback=1000000),
+                'deadline': self.ini.getfloat('fetch', 'deadline', fallback=30.0),
+                'pool_connections': self.ini.getint('fetch', 'pool_connections', fallback=100),
+                'pool_maxsize': self.ini.getint('fetch', 'pool_maxsize', fallback=4),
+                'retries': self.ini.getint('fetch', 'retries', fallback=0),
+                'retry_backoff': self.ini.getfloat('fetch', 'retry_backoff', fallback=0.5),
+                'dns_cache': self.ini.getboolean('fetch', 'dns_cache', fallback=True),
+                'dns_ttl': self.ini.getint('fetch', 'dns_ttl', fallback=60),
+                'tls_session_reuse': self.ini.getboolean('fetch', 'tls_session_reuse', fallback=True),
+                'link_extractor': self.ini.get('fetch', 'link_extractor', fallback='streaming')
+            }
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'fetch', ve)
+            sys.exit(255)
+
+        if self.options.link_extractor:
+            fetchconfig['link_extractor'] = self.options.link_extractor
+
+        if fetchconfig['link_extractor'] not in extractors:
+            self.logger.error("Unknown link extractor %s, must be one of %s.", fetchconfig['link_extractor'], ', '.join(extractors))
+            sys.exit(255)
+
+        return fetchconfig
+
+    def _init_cacheconfig(self):
+        # The [cache] section is optional; fall back to sane defaults
+        try:
+            cacheconfig = {
+                'lru_size': self.ini.getint('cache', 'lru_size', fallback=100000),
+                'bloom': self.ini.getboolean('cache', 'bloom', fallback=False),
+                'bloom_error_rate': self.ini.getfloat('cache', 'bloom_error_rate', fallback=0.001)
+            }
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'cache', ve)
+            sys.exit(255)
+
+        return cacheconfig
+
+    def _init_urlnormalizer(self):
+        # The [urls] section is optional; by default query strings are left as they are
+        try:
+            sort_query = self.ini.getboolean('urls', 'sort_query', fallback=False)
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'urls', ve)
+            sys.exit(255)
+
+        drop_params = [x.strip() for x in self.ini.get('urls', 'drop_query_params', fallback='').split(',') if x.strip()]
+
+        return URLNormalizer(sort_query=sort_query, drop_params=drop_params)
+
+    def _init_mediatypes(self):
+        # The [content_types] section is optional; by default HTML and XHTML are parsed and nothing is sniffed
+        def types(option, fallback):
+            return [x.strip() for x in self.ini.get('content_types', option, fallback=fallback).split(',') if x.strip()]
+
+        try:
+            sniff = self.ini.getboolean('content_types', 'sniff', fallback=False)
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'content_types', ve)
+            sys.exit(255)
+
+        return MediaTypeClassifier(allow=types('allow', 'text/html, application/xhtml+xml'), deny=types('deny', ''), sniff=sniff,
+                                   sniff_types=types('sniff_types', 'application/octet-stream, text/plain'))
+
+    def _init_politeconfig(self):
+        # The [politeness] section is optional and per host scheduling is off unless enabled
+        try:
+            politeconfig = {
+                'enabled': self.ini.getboolean('politeness', 'enabled', fallback=False),
+                'requests_per_second': self.ini.getfloat('politeness', 'requests_per_second', fallback=1.0),
+                'burst': self.ini.getint('politeness', 'burst', fallback=2),
+                'robots': self.ini.getboolean('politeness', 'robots', fallback=True),
+                'robots_user_agent': self.ini.get('politeness', 'robots_user_agent', fallback='webcrawler'),
+                'robots_ttl': self.ini.getint('politeness', 'robots_ttl', fallback=3600),
+                'max_backoff': self.ini.getint('politeness', 'max_backoff', fallback=300),
+                'max_retries': self.ini.getint('politeness', 'max_retries', fallback=3),
+
+                # Messages a sync page worker holds by default, so URLs set aside for one host leave room for others
+                'prefetch_count': self.ini.getint('politeness', 'prefetch_count', fallback=16)
+            }
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'politeness', ve)
+            sys.exit(255)
+
+        if politeconfig['requests_per_second'] <= 0:
+            self.logger.error("Invalid configuration for section %s: requests_per_second must be positive.", 'politeness')
+            sys.exit(255)
+
+        if politeconfig['prefetch_count'] < 1:
+            self.logger.error("Invalid configuration for section %s: prefetch_count must be at least 1.", 'politeness')
+            sys.exit(255)
+
+        return politeconfig
+
+    def _init_budgetconfig(self):
+        # The [budget] section is optional; by default nothing limits how far the crawl goes
+        try:
+            budgetconfig = {
+                'max_depth': self.ini.getint('budget', 'max_depth', fallback=0),
+                'max_pages_per_root_stem': self.ini.getint('budget', 'max_pages_per_root_stem', fallback=0),
+                'max_pages_per_host': self.ini.getint('budget', 'max_pages_per_host', fallback=0),
+                'refresh_interval': self.ini.getfloat('budget', 'refresh_interval', fallback=30.0)
+            }
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'budget', ve)
+            sys.exit(255)
+
+        if min(budgetconfig['max_depth'], budgetconfig['max_pages_per_root_stem'], budgetconfig['max_pages_per_host']) < 0:
+            self.logger.error("Invalid configuration for section %s: limits must not be negative.", 'budget')
+            sys.exit(255)
+
+        return budgetconfig
+
+    def _init_metricsconfig(self):
+        # The [metrics] section is optional; nothing is exposed unless a port or textfile is given
+        try:
+            metricsconfig = {
+                'host': self.ini.get('metrics', 'host', fallback='127.0.0.1'),
+                'port': self.ini.getint('metrics', 'port', fallback=0),
+                'textfile': self.ini.get('metrics', 'textfile', fallback=''),
+                'textfile_interval': self.ini.getint('metrics', 'textfile_interval', fallback=15)
+            }
+        except ValueError as ve:
+            self.logger.error("Invalid configuration for section %s: %s", 'metrics', ve)
+            sys.exit(255)
+
+        return metricsconfig
@@ -1,25 +1,47 @@
 from . import model as dm
-from .mqueue import MessageQueue
+from .frontier import frontiers
+from .asyncfetch import AsyncFetcher
+from .seen import SeenURLCache
+from .linkextract import extractors, iter_decoded, iter_raw, read_capped
+from .linkcodec import pack_links, unpack_links
+from .mediatype import sniff_html
+from .politeness import HostScheduler
+from .pipeline import PagePipeline
+from .sqlitedb import SqliteWriter
+from .transport import CrawlerHTTPAdapter, DNSCache, ResumingSSLContext
+from .sharding import ShardAssigner
+from .budget import CrawlBudget
+from .resume import FrontierRebuilder
+from .metrics import metrics, serve_metrics, write_textfile
 
 from urllib.parse import urlparse, urlunparse
-from bs4 import BeautifulSoup
 from multiprocessing import Process
+from functools import partial
 
 from playhouse.shortcuts import model_to_dict
+from peewee import chunked
 
+import os
 import sys
+import time
 import hashlib
+import itertools
 import json
 import re
-import posixpath
 import traceback
 import urllib3
 import requests
 import datetime
 import pika
 
+# Sizes of the link payloads page workers send, in bytes
+payload_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
 class WebCrawler:
 
+    # Seconds between reads of the start of the incremental pass
+    pass_refresh_interval = 60
+
     def __init__(self, config):
         self.config = config
         self.logger = config.logger
@@ -27,6 +49,33 @@ class WebCrawler:
 
         self.logger.debug("Hello from webcrawler... Starting up.")
 
+        # Only set up for page workers running with --fetch-mode async
+        self.fetcher = None
+
+        # Only set up for link workers with buffered publishing enabled
+        self.publisher = None
+
+        # Only set up for page workers with [politeness] enabled
+        self.scheduler = None
+
+        # Only set up for pipeline workers
+        self.pipeline = None
+
+        # Only set up for workers fetching pages, shared by all their sessions
+        self.ssl_context = None
+
+        # Only set up for page and pipeline workers when the page queue is sharded
+        self.shard_assigner = None
+
+        # Set up for every worker, as they all put URLs on the page queue
+        self.budget = None
+
+        # Set up for every worker
+        self.seen = None
+
+        # When the start of the incremental pass was last read from the database
+        self.pass_checked = None
+
         # Fugly workaround to stop SSL errors (not checking for valid certs...)
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -37,7 +86,6 @@ class WebCrawler:
         # Not sure if this is best here, but we'll go with it for now
         self.path_match = re.compile('^/([^/]+)/?')
         self.sub_path_match = re.compile(self.scan.sub_path_re)
-        self.fp_match = re.compile('^(.*[/])')
         self.search_fqdn = self.scan.search_fqdn_re
 
     # def __del__(self):
@@ -47,13 +95,37 @@ class WebCrawler:
 
         processes = []
 
+        # With SQLite, one process does the writing for all the workers
+        db_writer = None
+        if self.config.dbtype == 'sqlite' and self.config.dbconfig['use_writer']:
+            db_writer = SqliteWriter(self.config.dbname, self.config.dbconfig).start()
+            self.config.dbconfig['writer_address'] = db_writer.address
+            dm.init(self.config)
+
+        # Bootstrap the interface to the frontier
+        self.mq = frontiers[self.config.frontierconfig['backend']](self.config)
+
         # Start up both queues
         self._config_mqueue('page')
         self._config_mqueue('link')
 
 
-        if self.mq.queue_length(self.config.mqueue['queues']['page']) == 0:
-            self.mq.queue_push(self.config.mqueue['queues']['page'], url)
+        # The database knows what is left to crawl, whatever became of the queue
+        republished = 0
+        if self.config.options.resume:
+            republished = FrontierRebuilder(self).rebuild()
+
+        if not republished and self.mq.queue_length(self.config.mqueue['queues']['page']) == 0:
+            if not self.config.options.incremental:
+                self.push_page(urlparse(self.config.url_normalizer.normalize(url)[0]), 0)
+            elif self.start_pass():
+                self.logger.info("Starting an incremental pass over scan %s at %s.", self.scan.name, str(self.scan.start_timestamp))
+                self.push_page(urlparse(self.config.url_normalizer.normalize(url)[0]), 0)
+            else:
+                self.logger.info("Joining the incremental pass over scan %s started at %s.", self.scan.name, str(self.scan.start_timestamp))
+
+        # The workers open connections of their own
+        dm.release()
                 
         # Start up a set of crawler sub processes
         self.logger.debug("Instantiating %s worker processes.", self.config.options.processes)
@@ -61,83 +133,356 @@ class WebCrawler:
             self.logger.debug("Instantiating the worker process %s.", str(p+1))
             processes.append(Process(target=self._init_crawl_thread, args=(p+1,)))
 
+        # Only processes started from here can share a local frontier, so this invocation parses the links too,
+        # unless its workers do so themselves
+        if self.config.frontierconfig['backend'] == 'local' and self.config.options.role != 'pipeline':
+            for p in range(self.config.frontierconfig['link_processes']):
+                self.logger.debug("Instantiating the link worker process %s.", str(p+1))
+                processes.append(Process(target=self._init_crawl_thread, args=(p+1, 'link')))
+
         # Start the processes
         [x.start() for x in processes]
 
+        if db_writer:
+            [x.join() for x in processes]
+            db_writer.stop()
+
     def _config_mqueue(self, queue_name):
         # Configure the message queue name
         self.config.mqueue['queues'][queue_name] = self.config.scan.name + "_" + queue_name + "_queue"
 
-        # Bootstrap the interface to the message queue
-        self.mq = MessageQueue(self.config)
-        self.mq.create_queue(self.config.mqueue['queues'][queue_name])
+        # Both queues share the connection set up by the caller, so that callbacks scheduled
+        # on it run on the thread consuming either queue
+        if queue_name == 'page':
+            self.mq.create_queue(self.config.mqueue['queues'][queue_name], shards=self.config.mqueue['shards'], priorities=self.config.frontierconfig['priorities'])
+        else:
+            self.mq.create_queue(self.config.mqueue['queues'][queue_name])
 
     def _mqueue_page_callback(self, ch, method, properties, body):
-        url = urlparse(body.decode())
+        url_text, depth = self.parse_page_payload(body)
+        canonical, url_hash = self.config.url_normalizer.normalize(url_text)
+        if canonical is None:
+            self.logger.error("SKIPPING URL %s that is not absolute.", url_text)
+            self.ack(method.delivery_tag)
+            return
+
+        url = urlparse(canonical)
 
         # Look up the URL. If it's not alrady crawled and not blacklisted
         # then go ahead and crawl it. Else skip it.
+        if self.seen.is_crawled(url_hash):
+            self.logger.debug("SKIPPING URL %s already known to be crawled.", url.geturl())
+            self.ack(method.delivery_tag)
+            return
+
+        if self.scheduler:
+            wait = self.scheduler.wait_time(url)
+            if wait > 0:
+                # Set the message aside and get on with other hosts in the meantime
+                self.logger.debug("Holding on to URL %s for %s seconds.", url.geturl(), str(wait))
+                self.call_later(wait, partial(self._mqueue_page_callback, ch, method, properties, body))
+                return
+
         url_record = self.instantiate_url(url)
-        if not url_record.is_crawled and not url_record.is_blacklisted:
-            self.logger.debug("In the callback, calling to crawl_page for url %s.", url.geturl())
-            result = self.crawl_page(input_url=url, url_record=url_record)
 
-            # Take the crawl result and log the URL
-            self.log_url(**result)
+        # The links on the page are one deeper than the shortest way we know to it
+        if url_record.depth is None or depth < url_record.depth:
+            url_record.depth = depth
 
-            # If there are links, post that to the links queue
-            if 'pagelinks' in result and result['pagelinks']:
-                link_payload = json.dumps({ 'links': [x.geturl() for x in result['pagelinks']], 'url': url.geturl() })
-                self.mq.queue_push(self.config.mqueue['queues']['link'], link_payload)
+        if not self.crawled_in_pass(url_record.is_crawled, url_record.crawled_timestamp) and not url_record.is_blacklisted:
+            if self.pipeline and not self.is_blacklisted(url):
+                # Fetched and parsed on the pipeline's threads, then logged and acked back on this one
+                self.logger.debug("In the callback, handing url %s to the pipeline.", url.geturl())
+                self.pipeline.fetch(method.delivery_tag, url, url_record)
+                return
+
+            if self.fetcher and not self.is_blacklisted(url):
+                # Hand the fetch off to the event loop; the message gets acked once it completes
+                self.logger.debug("In the callback, submitting url %s to the async fetcher.", url.geturl())
+                self.fetcher.submit(url, partial(self._async_fetch_done, ch, method.delivery_tag, url, url_record), self.conditional_headers(url_record))
+                return
+
+            self.logger.debug("In the callback, calling to crawl_page for url %s.", url.geturl())
+            self.log_page(self.crawl_page(input_url=url, url_record=url_record))
 
         else:
             self.logger.debug("SKIPPING already crawled or blacklisted URL %s.", url.geturl())
     
-        self.logger.debug("Acknowledging the receipt of url %s", body.decode())
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.logger.debug("Acknowledging the receipt of url %s", url_text)
+        self.ack(method.delivery_tag)
+
+    def _async_fetch_done(self, ch, delivery_tag, url, url_record, future):
+        # Runs on the fetcher's event loop thread, so bounce back to the connection's thread
+        try:
+            self.mq.call_threadsafe(partial(self._async_page_callback, ch, delivery_tag, url, url_record, future))
+        except pika.exceptions.AMQPError as err:
+            # The message will be redelivered once the consumer reconnects
+            self.logger.error("Could not hand back fetch result for url %s: %s", url.geturl(), err)
+
+    def _async_page_callback(self, ch, delivery_tag, url, url_record, future):
+        self.log_page(self.finish_page(url, url_record, future))
+
+        self.logger.debug("Acknowledging the receipt of url %s", url.geturl())
+        self.ack(delivery_tag)
+
+    def _mqueue_pipeline_callback(self, ch, method, properties, body):
+        # Everything but talking to the frontier happens on the pipeline's threads
+        self.pipeline.submit(partial(self._mqueue_page_callback, ch, method, properties, body))
+
+    def _pipeline_page_done(self, delivery_tag, result):
+        self.log_page(result)
+
+        self.logger.debug("Acknowledging the receipt of url %s", result['url'].geturl())
+        self.ack(delivery_tag)
+
+    def log_page(self, result):
+        # A host asking us to slow down gets the URL again later rather than a logged 429/503
+        retry_after = result.pop('retry_after', None)
+        depth = (result['record'].depth if result['record'] is not None else None) or 0
+        if self.scheduler and self.scheduler.should_retry(result['url'], result.get('status_code'), retry_after):
+            self.push_page(result['url'], depth)
+            return
+
+        # Take the crawl result and log the URL
+        self.log_url(**result)
+
+        # If there are links, post that to the links queue
+        links = None
+        if 'pagelinks' in result and result['pagelinks']:
+            links = result['pagelinks']
+        elif result.get('not_modified') and result['record'] is not None:
+            # An unchanged page still has to lead us to whatever it links to
+            links = [urlparse(x.link) for x in dm.PageLink.select(dm.PageLink.link).where(dm.PageLink.url_id == result['record'].url_id)]
+
+        if links:
+            if self.pipeline:
+                # A pipeline worker is its own link worker
+                self.crawl_links(links=links, url=result['url'], depth=depth + 1)
+            elif self.config.mqueue['link_encoding'] == 'json':
+                link_payload = json.dumps({ 'links': [x.geturl() for x in links], 'url': result['url'].geturl(), 'depth': depth + 1 })
+                self.queue_push('link', link_payload)
+            else:
+                # Only what the link worker will store goes across, once per page
+                resolved = self.prefilter_links(links, result['url'])
+                if resolved:
+                    link_payload = pack_links(result['url'].geturl(), depth + 1, resolved)
+                    metrics.observe('webcrawler_link_payload_bytes', len(link_payload), buckets=payload_buckets)
+                    self.queue_push('link', link_payload)
+
+    def queue_push(self, queue_role, payload, key=None, priority=None):
+        queue_name = self.config.mqueue['queues'][queue_role]
+
+        if self.publisher:
+            self.publisher.push(queue_name, payload, key, priority)
+        elif self.pipeline:
+            # Only the consumer's thread may talk to the frontier
+            self.mq.call_threadsafe(partial(self.mq.queue_push, queue_name, payload, key, priority))
+        else:
+            self.mq.queue_push(queue_name, payload, key, priority)
+
+    def push_page(self, url, depth, in_scope=None):
+        # A sharded page queue keeps each host's URLs on one shard
+        key = url.hostname if self.config.mqueue['shards'] else None
+
+        priority = None
+        if self.config.frontierconfig['priorities']:
+            priority = self.page_priority(url, depth, in_scope)
+
+        self.queue_push('page', json.dumps({ 'url': url.geturl(), 'depth': depth }), key, priority)
+
+    def parse_page_payload(self, body):
+        # Pages queued before they carried their depth are nothing but the URL
+        text = body.decode()
+        if not text.startswith('{'):
+            return (text, 0)
+
+        page_payload = json.loads(text)
+        return (page_payload['url'], page_payload['depth'])
+
+    def page_priority(self, url, depth, in_scope=None):
+        # Pages we are here for come before external ones, and the shallower the sooner
+        if in_scope is None:
+            in_scope = self.is_in_scope(url)
+        if not in_scope:
+            return 0
+        return max(self.config.frontierconfig['priorities'] - depth, 1)
+
+    def admit(self, url, root_stem, depth, queued_depth=None):
+        """Depth at which url goes on the page queue, or None if the budget
+        keeps it off. A URL let on before, at queued_depth, keeps the
+        shallowest depth it was reached at and is not counted again."""
+        if queued_depth is not None:
+            return min(depth, queued_depth)
+        if self.budget.admit(url, root_stem, depth):
+            return depth
+        return None
+
+    def ack(self, delivery_tag):
+        if self.pipeline:
+            self.mq.call_threadsafe(partial(self.mq.queue_ack, delivery_tag))
+        else:
+            self.mq.queue_ack(delivery_tag)
+
+    def _rebalance_shards(self):
+        # Runs on the consumer's thread, which owns the channel
+        self.mq.consume_shards(self.config.mqueue['queues']['page'], self.shard_assigner.assign())
+        self.mq.call_later(self.config.mqueue['rebalance_interval'], self._rebalance_shards)
+
+    def call_later(self, delay, callback):
+        # Timers run on whichever thread handles deliveries
+        if self.pipeline:
+            self.pipeline.call_later(delay, callback)
+        else:
+            self.mq.call_later(delay, callback)
+
+    def _flush_publisher(self):
+        # Anything published on behalf of a message has to reach the broker before we let go of it
+        if self.publisher:
+            self.publisher.flush()
 
     def _mqueue_link_callback(self, ch, method, properties, body):
-        link_payload = json.loads(body.decode())
-        self.logger.debug("In the callback, calling to crawl_page for url %s.", link_payload['url'])
-        self.crawl_links(links=[urlparse(x) for x in link_payload['links']], url=urlparse(link_payload['url']))
-    
-        self.logger.debug("Acknowledging the receipt of url %s", body.decode())
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        if body[:1] == b'{':
+            # Links as found on the page, still to be resolved
+            link_payload = json.loads(body.decode())
+            url = link_payload['url']
+            self.logger.debug("In the callback, calling to crawl_page for url %s.", url)
+            self.crawl_links(links=[urlparse(x) for x in link_payload['links']], url=urlparse(url), depth=link_payload.get('depth', 1))
+        else:
+            url, depth, links = unpack_links(body)
+            self.logger.debug("In the callback, logging %s resolved links for url %s.", str(len(links)), url)
+            self.log_resolved_links(links, urlparse(url), depth)
 
-    def _init_crawl_thread(self, id):
+        self.logger.debug("Acknowledging the receipt of url %s", url)
+        self.ack(method.delivery_tag)
+
+    def _init_crawl_thread(self, id, role=None):
+
+        # Without RabbitMQ there may be no --role; the workers started by run() are page workers unless told otherwise
+        role = role or self.config.options.role or 'page'
 
         dm.init(self.config)
 
+        # Whichever invocation started the current pass, it is the one in the database
+        if self.config.options.incremental:
+            self.refresh_pass(force=True)
+
+        # Remember which URLs this worker has already resolved against the database
+        self.seen = SeenURLCache(self.config)
+
+        # Whichever role it plays, a worker only lets onto the page queue what the budget allows
+        self.budget = CrawlBudget(self.config)
+
+        # Each worker exposes its own metrics, on consecutive ports and/or its own textfile
+        if self.config.metricsconfig['port']:
+            serve_metrics(self.config.metricsconfig['host'], self.config.metricsconfig['port'] + id - 1)
+        if self.config.metricsconfig['textfile']:
+            write_textfile(self.config.metricsconfig['textfile'].format(id=id, pid=os.getpid()), self.config.metricsconfig['textfile_interval'])
+
+        # Pipeline workers crawl pages off the page queue too
+        queue_role = 'link' if role == 'link' else 'page'
+
+        # Whatever fetches pages in this process resolves hostnames once per TTL and resumes TLS sessions
+        if queue_role == 'page':
+            if self.config.fetchconfig['dns_cache']:
+                DNSCache(self.config.fetchconfig['dns_ttl']).install()
+            if self.config.fetchconfig['tls_session_reuse']:
+                self.ssl_context = ResumingSSLContext()
+
+        if queue_role == 'page' and self.config.politeconfig['enabled']:
+            self.scheduler = HostScheduler(self.config)
+
+        if queue_role == 'page' and self.config.mqueue['shards']:
+            self.shard_assigner = ShardAssigner(self.config, self.config.mqueue['eligible_shards'])
+
+        # In async mode all fetches for this process share one event loop
+        self.fetcher = None
+        if queue_role == 'page' and self.config.options.fetch_mode == 'async':
+            self.fetcher = AsyncFetcher(self.config, self.wants_links)
+
+        # Unless told otherwise, let the broker hand us enough messages to keep the fetcher busy
+        prefetch_count = self.config.mqueue['prefetch_count']
+        if not prefetch_count:
+            if self.fetcher:
+                prefetch_count = self.config.fetchconfig['concurrency']
+            elif role == 'pipeline':
+                prefetch_count = self.config.fetchconfig['pipeline_threads']
+            elif self.scheduler:
+                prefetch_count = self.config.politeconfig['prefetch_count']
+            else:
+                prefetch_count = 1
+
+        # A URL set aside for a host holds on to its delivery, and with only one there is nothing else to get on with
+        if self.scheduler and prefetch_count == 1:
+            self.logger.warning("Politeness is enabled with a prefetch count of 1, page worker %s will wait out every host it holds back.", str(id))
+
+        # Like the fetcher, the pipeline's threads carry on across reconnects
+        self.pipeline = None
+        if role == 'pipeline':
+            self.pipeline = PagePipeline(self, prefetch_count, self.config.fetchconfig['pipeline_threads'])
+
         while(True):
             try:                
-                # Bootstrap the interface to the message queue
-                self.mq = MessageQueue(self.config)
+                # Bootstrap the interface to the frontier
+                self.mq = frontiers[self.config.frontierconfig['backend']](self.config)
 
                 # Start up both queues
                 self._config_mqueue('page')
                 self._config_mqueue('link')
 
-                self.logger.info('Instantiated new crawler sub process %s for queue %s...', str(id), self.config.options.role)
+                self.logger.info('Instantiated new crawler sub process %s for queue %s...', str(id), role)
 
-                if self.config.options.role == 'page':
+                if role == 'page':
                     target_callback = self._mqueue_page_callback
 
                     # Because we are launching a page crawler, we want to launch and configure a persistent 
                     # request session
-                    self.session = requests.Session()
-                    self.session.headers.update(self.config.sessionconfig['headers'])
-                    self.session.max_redirects = self.config.sessionconfig['sessionopts']['max_redirects']
+                    self.session = self.new_session()
+
+                elif role == 'pipeline':
+                    # Fetch threads each have a session of their own
+                    target_callback = self._mqueue_pipeline_callback
 
                 else:
                     target_callback = self._mqueue_link_callback
-                    
+
+                    if self.config.mqueue['buffered_publish']:
+                        self.publisher = self.mq.buffered_publisher()
+
+                # Take our share of the page queue's shards, and keep it up to date as workers come and go
+                shards = None
+                if self.shard_assigner:
+                    shards = self.shard_assigner.assign()
+                    self.mq.call_later(self.config.mqueue['rebalance_interval'], self._rebalance_shards)
+
                 # Start listening for the specified queue role
                 try:
-                    self.mq.queue_consume(self.config.mqueue['queues'][self.config.options.role], target_callback)
+                    self.mq.queue_consume(self.config.mqueue['queues'][queue_role], target_callback,
+                                          prefetch_count=prefetch_count,
+                                          ack_batch_size=self.config.mqueue['ack_batch_size'],
+                                          ack_batch_delay=self.config.mqueue['ack_batch_delay'],
+                                          before_ack=self._flush_publisher,
+                                          shards=shards)
                 except KeyboardInterrupt:
-                    self.mq.queue_stop_consuming(self.config.mqueue['queues'][self.config.options.role])
-                    self.mq.destroy_conn()
-                    break
+                    self.mq.queue_stop_consuming(self.config.mqueue['queues'][queue_role])
+                else:
+                    # Only a frontier that drains returns because the crawl is done, anything else gets reconnected
+                    if not self.mq.drains:
+                        continue
+
+                if self.pipeline:
+                    self.pipeline.close()
+                self.mq.acker.flush()
+                if self.publisher:
+                    self.publisher.close()
+                if self.fetcher:
+                    self.fetcher.close()
+                if self.scheduler:
+                    self.scheduler.close()
+                if self.shard_assigner:
+                    self.shard_assigner.leave()
+                self.mq.destroy_conn()
+                self.logger.info("Seen URL cache statistics for sub process %s: %s", str(id), self.seen.stats())
+                break
             except pika.exceptions.ConnectionClosedByBroker:
                 continue
             except pika.exceptions.AMQPChannelError as err:
@@ -147,19 +492,65 @@ class WebCrawler:
                 print("Connection was closed, retrying...")
                 continue
 
-    def resolveComponents(self, url):
-        orig_url = url
-        if url.path:
-            url = url._replace(path=posixpath.normpath(url.path))
-
-        self.logger.debug("resolveComponents(): OLD PATH: " + orig_url.path + " NEW PATH: " + url.path)
-        return url
+    def start_pass(self):
+        """Start a new incremental pass over the scan, unless another
+        invocation has started one since we read the scan. Returns whether
+        we did; either way self.scan has the start of the current pass."""
+        started = self.scan.start_timestamp
+        query = (dm.Scan
+                 .update(start_timestamp=datetime.datetime.now().replace(microsecond=0), end_timestamp=None)
+                 .where(dm.Scan.scan_id == self.scan.scan_id))
+        if started is None:
+            query = query.where(dm.Scan.start_timestamp.is_null())
+        else:
+            query = query.where(dm.Scan.start_timestamp.is_null() | (dm.Scan.start_timestamp <= started))
+
+        started_here = query.execute() > 0
+        self.refresh_pass(force=True)
+        return started_here
+
+    def refresh_pass(self, force=False):
+        # Another invocation may start a new pass at any time, so the start of it is read again every pass_refresh_interval seconds
+        now = time.monotonic()
+        if not force and self.pass_checked is not None and now - self.pass_checked < self.pass_refresh_interval:
+            return
+
+        self.pass_checked = now
+        started = dm.Scan.select(dm.Scan.start_timestamp).where(dm.Scan.scan_id == self.scan.scan_id).scalar()
+        if started != self.scan.start_timestamp:
+            self.scan.start_timestamp = started
+
+            # What the seen URL cache holds was crawled in the pass before
+            if self.seen:
+                self.seen.reset()
+
+    def crawled_in_pass(self, is_crawled, crawled_timestamp):
+        # In incremental mode anything crawled before the current pass started is due again
+        if not is_crawled:
+            return False
+        if self.config.options.incremental:
+            self.refresh_pass()
+            if self.scan.start_timestamp:
+                return crawled_timestamp is not None and crawled_timestamp >= self.scan.start_timestamp
+        return True
+
+    def url_hash(self, url):
+        return hashlib.sha256(url.geturl().encode()).hexdigest()
+
+    def resolve_url_id(self, url):
+        # Cheap lookup of a url_id, only going to the database on a cache miss
+        cached = self.seen.get(self.url_hash(url))
+        if cached:
+            return cached[0]
+
+        return self.instantiate_url(url).url_id
 
     def instantiate_url(self, url):
 
-        hashed_url = hashlib.sha256(url.geturl().encode()).hexdigest()
+        hashed_url = self.url_hash(url)
 
-        (found_url, created) = dm.FoundURL.get_or_create(scan_id=self.scan.scan_id, url_hash=hashed_url)
+        with metrics.timer('webcrawler_db_seconds', statement='get_or_create'):
+            (found_url, created) = dm.get_or_create_found_url(self.scan.scan_id, hashed_url)
 
         if created:
             self.logger.debug("URL '%s' was NOT FOUND in the database, creating...", url.geturl())
@@ -179,15 +570,18 @@ class WebCrawler:
             found_url.is_new = True
             
             self.logger.debug("Saving new URL '%s'... with scan_id of %s and url_id of %s.", found_url.url_text, str(found_url.scan_id), str(found_url.url_id))
-            found_url.save()
+            with metrics.timer('webcrawler_db_seconds', statement='update_url'):
+                dm.save_found_url(found_url)
         else:
             found_url.is_new = False
             self.logger.debug("URL '%s' (%s) FOUND in the database, returning...", found_url.url_text, str(found_url.url_id))
     
+        self.seen.add(hashed_url, found_url.url_id, self.crawled_in_pass(found_url.is_crawled, found_url.crawled_timestamp))
 
         return found_url
 
-    def log_url(self, url=None, record=None, backlink=None, pagelinks=None, content_type=None, status_code=None, error=None, is_blacklisted=False, redirect_next=None, is_crawled=False):
+    def log_url(self, url=None, record=None, backlink=None, pagelinks=None, content_type=None, status_code=None, error=None, is_blacklisted=False, redirect_next=None, is_crawled=False,
+                etag=None, last_modified=None, content_digest=None, not_modified=False, depth=None):
         self.logger.debug("Entering log_url() for URL %s.", url.geturl())
 
         if record:
@@ -198,37 +592,44 @@ class WebCrawler:
         if not found_url.url_text:
             found_url.url_text = url.geturl()
 
-        # For grouping purposes, add the FQDN (or a fqdn/something)
-        if not found_url.root_stem and url.hostname in self.config.root_fqdns and self.path_match.match(url.path):
-            found_url.root_stem = url.hostname + self.path_match.match(url.path).group(0)
-        else:
-            found_url.root_stem = url.hostname
+        if not found_url.root_stem:
+            found_url.root_stem = self.root_stem(url)
 
         # Attach the status code
         if status_code:
             found_url.status_code = status_code
 
         # If this is a redirect, log its parent so we can retrace later
+        next_canonical = None
         if redirect_next:
-            next_url = urlparse(redirect_next.url)
+            next_canonical = self.config.url_normalizer.normalize(redirect_next.url)[0]
+
+        if next_canonical:
+            next_url = urlparse(next_canonical)
 
             # Go look up (or create) the identifier for the backlinked URL
             redirect = self.instantiate_url(next_url)
 
-            # Associate the redirect page ID to the URL
+            # Associate the redirect page ID to the URL, and the end of its redirect chain
             found_url.next_url_id = redirect.url_id
+            with metrics.timer('webcrawler_db_seconds', statement='link_redirect'):
+                dm.link_redirect(found_url, redirect)
 
             # Mark the URL as crawled since we can't do anything else with it.
             found_url.is_crawled = True
             found_url.crawled_timestamp = datetime.datetime.now()
 
-            # Put the redirect URL on the pile to be scanned.
-            if not redirect.is_crawled:
-                self.mq.queue_push(self.config.mqueue['queues']['page'], next_url.geturl())
+            # Put the redirect URL on the pile to be scanned, at the depth of the URL redirecting to it.
+            if not self.crawled_in_pass(redirect.is_crawled, redirect.crawled_timestamp):
+                redirect_depth = self.admit(next_url, self.root_stem(next_url), found_url.depth or 0, redirect.depth)
+                if redirect_depth is not None:
+                    with metrics.timer('webcrawler_db_seconds', statement='record_depth'):
+                        dm.record_depth([redirect.url_id], redirect_depth)
+                    self.push_page(next_url, redirect_depth)
 
         # If backlink is None, that means we are logging an actual page crawl.
         if backlink is None:
-            self.logger.debug("Logging that " + url.geturl() + " has been crawled.")
+            self.logger.debug("Logging that %s has been crawled.", url.geturl())
 
             # Set the status
             found_url.is_crawled = True
@@ -237,26 +638,38 @@ class WebCrawler:
             # Set the crawled timestamp
             found_url.crawled_timestamp = datetime.datetime.now()
 
-            if pagelinks and dm.PageLink.select().where(dm.PageLink.url_id == found_url.url_id).count() == 0:
-                pagelinks_set = [{'url_id': found_url.url_id, 'link': urlunparse(z)} for z in pagelinks]
-                dm.PageLink.insert_many(pagelinks_set).execute()
+            with metrics.timer('webcrawler_db_seconds', statement='pagelinks'):
+                # A page that changed since the last pass gets its stored links replaced
+                if pagelinks and self.config.options.incremental:
+                    dm.PageLink.delete().where(dm.PageLink.url_id == found_url.url_id).execute()
+
+                if pagelinks and dm.PageLink.select().where(dm.PageLink.url_id == found_url.url_id).count() == 0:
+                    pagelinks_set = [{'url_id': found_url.url_id, 'link': urlunparse(z)} for z in pagelinks]
+                    dm.PageLink.insert_many(pagelinks_set).execute()
 
             # Attach the HTTP status code and content type for the crawled web page.
             found_url.content_type = content_type
             found_url.is_blacklisted = is_blacklisted
 
+            # Keep what we need to ask for the page conditionally next time around
+            if etag:
+                found_url.etag = etag
+            if last_modified:
+                found_url.last_modified = last_modified
+            if content_digest:
+                found_url.content_digest = content_digest
+
         # If backlink contains a value, that means we are writing a backlink to a different URL.
         else:
             self.logger.debug("Logging that URL %s backlinks to %s", url.geturl(), backlink.geturl())
 
-            # Go look up (or create) the identifier for the backlinked URL
-            backlink_instance = self.instantiate_url(backlink)
-
-            dm.Backlink.create(**{
-                'url_id': found_url.url_id,
-                'backlink_url_id': backlink_instance.url_id,
-                'backlink_timestamp': datetime.datetime.now()
-            })
+            backlink_url_id = self.resolve_url_id(backlink)
+            with metrics.timer('webcrawler_db_seconds', statement='insert_backlink'):
+                dm.Backlink.create(**{
+                    'url_id': found_url.url_id,
+                    'backlink_url_id': backlink_url_id,
+                    'backlink_timestamp': datetime.datetime.now()
+                })
 
             if is_crawled:
                 found_url.is_crawled = True
@@ -273,153 +686,400 @@ class WebCrawler:
         if error:
             found_url.is_crawled = True
             found_url.crawled_timestamp = datetime.datetime.now()
-            dm.ScanError.create(**{
-                'url_id': found_url.url_id,
-                'error_text': error
-            })
+            with metrics.timer('webcrawler_db_seconds', statement='insert_error'):
+                dm.ScanError.create(**{
+                    'url_id': found_url.url_id,
+                    'error_text': error
+                })
+
+        # Anything still to be crawled goes on the page queue, budget permitting, with its depth recorded
+        is_crawled = self.crawled_in_pass(found_url.is_crawled, found_url.crawled_timestamp)
+        queued_depth = None
+        if not is_crawled:
+            queued_depth = self.admit(url, found_url.root_stem, depth or 0, found_url.depth)
+            if queued_depth is not None:
+                found_url.depth = queued_depth
 
         # Write the instance back to the database
-        found_url.save()
+        with metrics.timer('webcrawler_db_seconds', statement='update_url'):
+            dm.save_found_url(found_url)
+        self.seen.add(found_url.url_hash, found_url.url_id, is_crawled)
 
         # Throw it on the pile to be crawled later.
-        if not found_url.is_crawled:
-            self.mq.queue_push(self.config.mqueue['queues']['page'], url.geturl())
+        if queued_depth is not None:
+            self.push_page(url, queued_depth)
+
+        return is_crawled
+
+    def root_stem(self, url):
+        # For grouping purposes, add the FQDN (or a fqdn/something)
+        if url.hostname in self.config.root_fqdns and self.path_match.match(url.path):
+            return url.hostname + self.path_match.match(url.path).group(0)
 
-        return found_url.is_crawled
+        return url.hostname
 
-    def crawl_links(self, links=None, url=None):
+    def log_backlinks(self, links, backlink, hashes=None, depth=1, scopes=None):
+        # Batch counterpart of log_backlink() for every link found on one page
+        try:
+            with metrics.timer('webcrawler_db_seconds', statement='backlink_batch'), dm.database.atomic():
+                found_urls = self._write_backlinks(links, backlink, hashes)
+                queued = self._admit_links(found_urls, depth, scopes)
+        except Exception as error:
+            metrics.inc('webcrawler_errors_total', stage='persist', type=type(error).__name__)
+            self.logger.error("Batch logging of links from %s failed, logging them one at a time: %s", backlink.geturl(), error)
+            for uri in links:
+                self.log_backlink(uri, backlink, depth)
+            return
+
+        for url_hash, (uri, url_id, is_crawled, _) in found_urls.items():
+            self.seen.add(url_hash, url_id, is_crawled)
+
+        # Only now that the rows are committed, throw the new ones on the pile to be crawled later.
+        for uri, queued_depth, in_scope in queued:
+            self.push_page(uri, queued_depth, in_scope)
+
+    def _admit_links(self, found_urls, depth, scopes=None):
+        # The links not crawled yet that the budget lets onto the page queue, with their depths recorded
+        queued = []
+        deeper = []
+        for url_hash, (uri, url_id, is_crawled, queued_depth) in found_urls.items():
+            if is_crawled:
+                continue
+            new_depth = self.admit(uri, self.root_stem(uri), depth, queued_depth)
+            if new_depth is None:
+                continue
+            queued.append((uri, new_depth, scopes.get(url_hash) if scopes else None))
+            if queued_depth is None or queued_depth > depth:
+                deeper.append(url_id)
+
+        for batch in chunked(deeper, 500):
+            with metrics.timer('webcrawler_db_seconds', statement='record_depth'):
+                dm.record_depth(batch, depth)
+
+        return queued
+
+    def _select_found_urls(self, batch, urls, found_urls):
+        query = (dm.FoundURL
+                 .select(dm.FoundURL.url_id, dm.FoundURL.url_hash, dm.FoundURL.is_crawled, dm.FoundURL.crawled_timestamp, dm.FoundURL.depth)
+                 .where((dm.FoundURL.scan_id == self.scan.scan_id) & (dm.FoundURL.url_hash.in_(batch))))
+        with metrics.timer('webcrawler_db_seconds', statement='select_urls'):
+            for url_id, url_hash, is_crawled, crawled_timestamp, depth in query.tuples():
+                found_urls[url_hash] = (urls[url_hash], url_id, self.crawled_in_pass(is_crawled, crawled_timestamp), depth)
+
+    def _write_backlinks(self, links, backlink, hashes=None):
+        now = datetime.datetime.now()
+        backlink_url_id = self.resolve_url_id(backlink)
+
+        if hashes is None:
+            hashes = [self.url_hash(uri) for uri in links]
+        urls = dict(zip(hashes, links))
+
+        # Links to URLs we know are crawled only need their backlink
+        found_urls = {}
+        for url_hash, uri in urls.items():
+            cached = self.seen.get(url_hash)
+            if cached and cached[1]:
+                found_urls[url_hash] = (uri, cached[0], True, None)
+
+        # Links the Bloom filter takes for crawled most likely have their row
+        # already, so look those up first and only write the ones that do not
+        probable = [x for x in urls if x not in found_urls and self.seen.probably_crawled(x)]
+        for batch in chunked(probable, 500):
+            self._select_found_urls(batch, urls, found_urls)
+
+        missing = [x for x in urls if x not in found_urls]
+        for batch in chunked(missing, 500):
+            with metrics.timer('webcrawler_db_seconds', statement='upsert_urls'):
+                dm.upsert_found_urls([{
+                    'scan_id': self.scan.scan_id,
+                    'url_hash': url_hash,
+                    'url_text': urls[url_hash].geturl(),
+                    'root_stem': self.root_stem(urls[url_hash]),
+                    'is_crawled': False,
+                    'is_blacklisted': False,
+                    'created_timestamp': now
+                } for url_hash in batch])
+
+            self._select_found_urls(batch, urls, found_urls)
+
+        # One Backlinks row per link on the page, duplicates included
+        for batch in chunked(hashes, 500):
+            with metrics.timer('webcrawler_db_seconds', statement='insert_backlinks'):
+                dm.Backlink.insert_many([{
+                    'url_id': found_urls[url_hash][1],
+                    'backlink_url_id': backlink_url_id,
+                    'backlink_timestamp': now
+                } for url_hash in batch]).execute()
+
+        return found_urls
+
+    def log_backlink(self, url, backlink, depth=1):
+        # A link to something we already know is crawled only needs its backlink recorded
+        cached = self.seen.get(self.url_hash(url))
+        if cached and cached[1]:
+            self.logger.debug("Logging that already crawled URL %s backlinks to %s", url.geturl(), backlink.geturl())
+            backlink_url_id = self.resolve_url_id(backlink)
+            with metrics.timer('webcrawler_db_seconds', statement='insert_backlink'):
+                dm.Backlink.create(**{
+                    'url_id': cached[0],
+                    'backlink_url_id': backlink_url_id,
+                    'backlink_timestamp': datetime.datetime.now()
+                })
+            return True
+
+        return self.log_url(url=url, backlink=backlink, depth=depth)
+
+    def crawl_links(self, links=None, url=None, depth=1):
 
         self.logger.info("Crawling links from URL: %s", url.geturl())
+        resolved = self.resolve_links(links, url)
+
+        metrics.inc('webcrawler_links_total', len(links))
+        if resolved:
+            self.log_backlinks([urlparse(x[0]) for x in resolved], url, [x[1] for x in resolved], depth)
+
+        self.logger.debug("Seen URL cache statistics: %s", self.seen.stats())
+
+    def resolve_links(self, links, url):
+        """Turn the links found on url into the canonical URLs we store,
+        skipping those that are no use. Returns (canonical url, hash) for
+        each, duplicates included."""
         # Scrape all of the links in the document and try to crawl them
         glob_uri = None
+        resolved = []
         for uri in links:
             glob_uri = uri
             try:
-                self.logger.debug("Crawling link <" + str(uri.geturl()) + "> for parent URL " + str(url.geturl()))
-
-                if uri.netloc or (not uri.netloc and uri.path):
-                    self.logger.debug(uri.geturl() + " has a netloc and matches search_fqdn OR no netloc and a path.")
-
-                    # 0 - scheme
-                    # 1 - netloc
-                    # 2 - path
-                    # 3 - params
-                    # 4 - query
-                    # 5 - fragment (#)
-                    uri_parts = list(uri)
-
-                    # If we have a scheme, make sure it's one we care about
-                    if uri.scheme and uri.scheme not in self.config.httpconfig['schemes']:
-                        self.logger.debug("Not a valid scheme, skipping: " + uri.geturl())
-                        continue
-
-                    # If we have a scheme embedded at the start of the path, something is wrong.
-                    if (not uri.scheme and uri.path) and any([re.search("^" + x, uri.path) for x in self.config.httpconfig['invalid_schemes']]):
-                        self.logger.debug("Skipping due to invalid scheme detected in the path " + url.geturl())
-                        continue
-
-                    # Test for obscure use case and try to patch it over.
-                    if uri.netloc and not uri.scheme:
-                        self.logger.debug("Handling odd case where no scheme was specified.")
-                        # It should be reasonable to adopt the parent's scheme
-                        uri_parts[0] = url.scheme
-
-                    # If we have a relative url only (e.g. /foo/bar) make it
-                    # an absolute so we can attempt to crawl it...
-                    if not uri.scheme and not uri.netloc:
-                        # A full (/foo/bar) path was specified
-                        self.logger.debug("Converting relative URL " + uri.geturl() + " to absolute.")
-                        uri_parts[0] = url.scheme
-                        if uri.path[0] == "/" or not self.fp_match.match(url.path):
-                            uri_parts[1] = url.netloc
-                        else:
-                            # Localized path (baz/bep), so we need the parent's path
-                            uri_parts[1] = url.netloc
-                            uri_parts[2] = self.fp_match.match(url.path).group(0) + uri.path
+                self.logger.debug("Crawling link <%s> for parent URL %s", uri.geturl(), url.geturl())
 
-                    # Reassemble the URL after the futzing we just did...
-                    uri = urlparse(urlunparse(uri_parts))
+                # An empty or fragment only link just points back at the page itself
+                if not (uri.netloc or uri.path or uri.query):
+                    continue
 
-                    # Filter out and handle stupid shit like .. and . (WARNING: BIG FAT KLUDGE)
-                    uri = self.resolveComponents(uri)
+                # If we have a scheme, make sure it's one we care about
+                if uri.scheme and not self.config.url_filter.is_valid_scheme(uri.scheme):
+                    self.logger.debug("Not a valid scheme, skipping: %s", uri.geturl())
+                    continue
 
-                    self.logger.debug("New absolute URL is " + uri.geturl())
+                # If we have a scheme embedded at the start of the path, something is wrong.
+                if (not uri.scheme and uri.path) and self.config.url_filter.has_invalid_scheme(uri.path):
+                    self.logger.debug("Skipping due to invalid scheme detected in the path %s", url.geturl())
+                    continue
 
-                    if not re.search(self.search_fqdn, str(uri.hostname)) and not url:
-                        self.logger.info("Crawling link <" + str(uri.geturl()) + "> for parent URL " + str(url.geturl()))
+                # Resolve against the parent and reduce to the one spelling we hash and store
+                canonical, url_hash = self.config.url_normalizer.normalize(uri.geturl(), url.geturl())
+                if canonical is None:
+                    self.logger.debug("Could not make an absolute URL out of %s, skipping.", uri.geturl())
+                    continue
 
-                    self.log_url(url=uri, backlink=url)
+                self.logger.debug("New absolute URL is %s", canonical)
+                resolved.append((canonical, url_hash))
 
             except Exception as error:
+                metrics.inc('webcrawler_errors_total', stage='links', type=type(error).__name__)
                 self.log_url(url=url, error=str(error), status_code=909)
                 self.logger.error("Error trying to crawl " + glob_uri.geturl())
                 self.logger.error("Crawling on behalf of URL " + url.geturl())
                 self.logger.error(error)
                 self.logger.error(traceback.format_exc())
                 pass
-           
+
+        return resolved
+
+    def prefilter_links(self, links, url):
+        """What a page worker sends to the link workers: every link found on
+        url that resolves, once, as (canonical url, in scope, times found)."""
+        resolved = self.resolve_links(links, url)
+
+        counts = {}
+        for canonical, url_hash in resolved:
+            if url_hash in counts:
+                counts[url_hash][2] += 1
+            else:
+                counts[url_hash] = [canonical, self.is_in_scope(urlparse(canonical)), 1]
+
+        metrics.inc('webcrawler_links_dropped_total', len(links) - len(resolved))
+        return [tuple(x) for x in counts.values()]
+
+    def log_resolved_links(self, links, url, depth):
+        # Counterpart of crawl_links() for links a page worker resolved already
+        resolved = []
+        hashes = []
+        scopes = {}
+        for link, in_scope, count in links:
+            uri = urlparse(link)
+            url_hash = self.url_hash(uri)
+            resolved.extend([uri] * count)
+            hashes.extend([url_hash] * count)
+            scopes[url_hash] = in_scope
+
+        metrics.inc('webcrawler_links_total', len(resolved))
+        if resolved:
+            self.log_backlinks(resolved, url, hashes, depth, scopes)
+
+        self.logger.debug("Seen URL cache statistics: %s", self.seen.stats())
+
+    def is_blacklisted(self, input_url):
+        if self.config.url_filter.is_blacklisted(input_url):
+            return True
+
+        # robots.txt Disallow rules act as one more blacklist
+        return self.scheduler is not None and not self.scheduler.is_allowed(input_url)
+
+    def wants_links(self, url, status_code, content_type):
+        # Decide, based on the response headers alone, whether the body is worth parsing
+        if status_code not in range(300, 599) and self.config.media_types.wants_body(content_type):
+            # We only want to crawl things that haven't been crawled and only sites ending in our root stem
+            if self.is_in_scope(url):
+                return True
+            else:
+                self.logger.info("Logging, but not crawling, external site: %s STATUS CODE %s", url.geturl(), status_code)
+        else:
+            self.logger.debug("Not crawling for links in URL: %s STATUS CODE %s", url.geturl(), status_code)
+
+        return False
+
+    def is_in_scope(self, url):
+        return bool(re.search(self.search_fqdn, url.hostname) and self.sub_path_match.match(url.path))
+
+    def extract_links(self, url, chunks):
+        self.logger.debug('Extracting links from URL: %s', url.geturl())
+        extractor = extractors[self.config.fetchconfig['link_extractor']](url.geturl())
+        for text in chunks:
+            extractor.feed(text)
+        return [urlparse(x) for x in extractor.links()]
+
+    def conditional_headers(self, url_record):
+        # In incremental mode let the server tell us nothing has changed since the last pass
+        headers = {}
+        if self.config.options.incremental and url_record is not None:
+            if url_record.etag:
+                headers['If-None-Match'] = url_record.etag
+            if url_record.last_modified:
+                headers['If-Modified-Since'] = url_record.last_modified
+        return headers
+
+    def unchanged_result(self, url, url_record, etag=None, last_modified=None):
+        # The page is what it was last time, and so are its links
+        self.logger.info("URL %s has not changed since the last crawl.", url.geturl())
+        return { 'url': url, 'record': url_record, 'not_modified': True, 'content_type': url_record.content_type, 'status_code': url_record.status_code, 'etag': etag, 'last_modified': last_modified }
+
+    def parse_body(self, url, url_record, body, encoding):
+        """Digest the (capped) body and extract its links, unless in
+        incremental mode the digest shows it is unchanged. Returns
+        (links, digest, unchanged)."""
+        digest = hashlib.sha256()
+        for chunk in body:
+            digest.update(chunk)
+        digest = digest.hexdigest()
+
+        if self.config.options.incremental and url_record is not None and url_record.content_digest == digest:
+            return (None, digest, True)
+
+        chunks = iter_decoded(body, encoding, self.config.fetchconfig['max_bytes'], self.logger)
+        with metrics.timer('webcrawler_parse_seconds'):
+            links = self.extract_links(url, chunks)
+        return (links, digest, False)
+
+    def new_session(self):
+        # A persistent request session for crawling pages
+        session = requests.Session()
+        session.headers.update(self.config.sessionconfig['headers'])
+        session.max_redirects = self.config.sessionconfig['sessionopts']['max_redirects']
+
+        adapter = CrawlerHTTPAdapter(self.config.fetchconfig['pool_connections'], self.config.fetchconfig['pool_maxsize'],
+                                     self.config.fetchconfig['retries'], self.config.fetchconfig['retry_backoff'], self.ssl_context)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
     def crawl_page(self, input_url, url_record=None):
 
-        # Check our blacklist
-        is_blacklisted = False
-        if input_url.hostname in self.config.blacklist:
-            # If empty, the entire server is is_blacklisted
-            if self.config.blacklist[input_url.hostname] == {}:
-                is_blacklisted=True
-            # Check to see if the scheme is blocked
-            if 'scheme' in self.config.blacklist[input_url.hostname]:
-                if input_url.scheme == self.config.blacklist[input_url.hostname]['scheme']:
-                    is_blacklisted = True
-            # Check to see if the path is blocked
-            if 'path' in self.config.blacklist[input_url.hostname]:
-                if True in [input_url.path.startswith(x) for x in self.config.blacklist[input_url.hostname]['path']]:
-                    is_blacklisted = True
-            # Check to see something in the query string is blocked
-            if 'query' in self.config.blacklist[input_url.hostname]:
-                if True in [x in input_url.query for x in self.config.blacklist[input_url.hostname]['query']]:
-                    is_blacklisted = True
-            # Check to see if the netloc is blocked
-            if 'netloc' in self.config.blacklist[input_url.hostname]:
-                if input_url.path == self.config.blacklist[input_url.hostname]['netloc']:
-                    is_blacklisted = True
-
-        # Check for other bad situations (e.g. links with malformed mailto:, etc.)
-        if [invalid_token for invalid_token in self.config.httpconfig['invalid_tokens'] if re.search(invalid_token, input_url.geturl())]:
-            is_blacklisted = True
-
-        if is_blacklisted:
-            self.logger.info("Logging and disqualifying is_blacklisted URL: " + input_url.geturl())
+        if self.is_blacklisted(input_url):
+            self.logger.info("Logging and disqualifying is_blacklisted URL: %s", input_url.geturl())
             return { 'url': input_url, 'record': url_record, 'is_blacklisted': True}
 
         # Try to fetch the URL in question
         try:
-            with self.session.get(input_url.geturl(), verify=False, timeout=10, allow_redirects=False) as r:
-                # url = urlparse(r.url)
-                url = input_url
-                self.logger.info('Evaluating URL %s', url.geturl())
-                links = None
-                content_type = None
-                if 'Content-Type' in r.headers:
-                    content_type = r.headers['Content-Type']
-
-                if r.status_code not in range(300, 599) and content_type in self.config.httpconfig['allowed_content_types']:
-                    # We only want to crawl things that haven't been crawled and only sites ending in our root stem
-                    if re.search(self.search_fqdn, url.hostname) and self.sub_path_match.match(url.path):
-                        self.logger.debug('Extracting links from URL: ' + url.geturl())
-                        soup = BeautifulSoup(r.text, features="html5lib")
-                        links = [urlparse(str(x.get('href'))) for x in soup.find_all('a') if x is not None]
-                    else:
-                        self.logger.info("Logging, but not crawling, external site: " + url.geturl() + " STATUS CODE " + str(r.status_code))
-
-                else:
-                    self.logger.debug("Not crawling for links in URL: " + url.geturl() + " STATUS CODE " + str(r.status_code))
-                    
-            return { 'url': url, 'record': url_record, 'pagelinks': links, 'content_type': content_type, 'redirect_next': r.next, 'status_code': r.status_code }
+            response = self.fetch_page(input_url, url_record, self.session)
 
         except Exception as error:
+            metrics.inc('webcrawler_errors_total', stage='fetch', type=type(error).__name__)
+
             # Add the URL to the list of found urls with a 0 value
             # so that we don't keep trying...
             self.logger.error("Error trying to crawl " + input_url.geturl())
             self.logger.error(error)
             self.logger.error(traceback.format_exc())
             return { 'url': input_url, 'record': url_record, 'error': str(error), 'status_code': 909 }
+
+        return self.finish_response(input_url, url_record, response)
+
+    def fetch_page(self, url, url_record, session):
+        """Fetch url with session, reading the (capped) body only if it is
+        worth parsing. Returns the response the way AsyncFetcher.fetch()
+        does."""
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.config.fetchconfig['deadline']
+        with session.get(url.geturl(), headers=self.conditional_headers(url_record), verify=False, timeout=self.config.fetchconfig['timeout'], allow_redirects=False, stream=True) as r:
+            self.logger.info('Evaluating URL %s', url.geturl())
+            content_type = None
+            if 'Content-Type' in r.headers:
+                content_type = r.headers['Content-Type']
+
+            metrics.observe('webcrawler_fetch_seconds', time.perf_counter() - start, host=url.hostname)
+            metrics.observe('webcrawler_ttfb_seconds', r.elapsed.total_seconds(), host=url.hostname)
+            metrics.inc('webcrawler_fetch_responses_total', status=r.status_code)
+
+            # Read no more than we are willing to parse, for no longer than we are willing to wait, and hang up on the rest
+            body = None
+            if not (r.status_code == 304 and url_record is not None) and self.wants_links(url, r.status_code, content_type):
+                chunks = iter_raw(r.raw, self.config.fetchconfig['timeout'], deadline)
+
+                # Without a telling Content-Type the first chunk has to show it is HTML
+                if self.config.media_types.needs_sniffing(content_type):
+                    first = next(chunks, b'')
+                    chunks = itertools.chain([first], chunks) if sniff_html(first) else None
+                    metrics.inc('webcrawler_fetch_sniffed_total', result='html' if chunks is not None else 'other')
+
+                if chunks is not None:
+                    body, truncated = read_capped(chunks, self.config.fetchconfig['max_bytes'], deadline)
+                    metrics.inc('webcrawler_fetch_bytes_total', sum(len(x) for x in body))
+                    if truncated:
+                        self.logger.debug("Stopped reading %s after %s bytes (%s).", url.geturl(), str(sum(len(x) for x in body)), truncated)
+                        metrics.inc('webcrawler_fetch_truncated_total', reason=truncated)
+
+            return { 'status_code': r.status_code, 'content_type': content_type, 'body': body, 'encoding': self.config.media_types.charset(content_type), 'redirect_next': r.next, 'retry_after': r.headers.get('Retry-After'),
+                     'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified') }
+
+    def finish_page(self, input_url, url_record, future):
+        # Counterpart of crawl_page() for responses fetched elsewhere, by the AsyncFetcher or a pipeline's fetch threads
+        try:
+            response = future.result()
+        except Exception as error:
+            metrics.inc('webcrawler_errors_total', stage='fetch', type=type(error).__name__)
+            self.logger.error("Error trying to crawl " + input_url.geturl())
+            self.logger.error(error)
+            return { 'url': input_url, 'record': url_record, 'error': str(error), 'status_code': 909 }
+
+        return self.finish_response(input_url, url_record, response)
+
+    def finish_response(self, input_url, url_record, response):
+        if response['status_code'] == 304 and url_record is not None:
+            return self.unchanged_result(input_url, url_record, response['etag'], response['last_modified'])
+
+        links = None
+        digest = None
+        if response['body'] is not None:
+            try:
+                links, digest, unchanged = self.parse_body(input_url, url_record, response['body'], response['encoding'])
+            except Exception as error:
+                metrics.inc('webcrawler_errors_total', stage='parse', type=type(error).__name__)
+                self.logger.error("Error trying to parse " + input_url.geturl())
+                self.logger.error(traceback.format_exc())
+                return { 'url': input_url, 'record': url_record, 'error': str(error), 'status_code': 909 }
+            if unchanged:
+                return self.unchanged_result(input_url, url_record, response['etag'], response['last_modified'])
+
+        return { 'url': input_url, 'record': url_record, 'pagelinks': links, 'content_type': response['content_type'], 'redirect_next': response['redirect_next'], 'status_code': response['status_code'], 'retry_after': response['retry_after'],
+                 'etag': response['etag'], 'last_modified': response['last_modified'], 'content_digest': digest }
@@ -0,0 +1,220 @@
+import csv
+import sys
+
+from peewee import JOIN, chunked
+
+from . import model as dm
+from .config import Configuration
+
+
+class ExportConfiguration(Configuration):
+    """The logging and database settings of a Configuration, all an export
+    needs."""
+
+    def __init__(self, options):
+        self.options = options
+        self.logger = self._init_logging()
+        self.ini = self._init_inifile()
+        self.dbtype, self.dbname, self.dbconfig = self._init_dbconfig()
+
+
+class RedirectResolver:
+    """Final target of URLs of a scan that redirect, worked out for a batch
+    of them at a time. Every chain is followed by its next_url_id pointers,
+    with one query per step for the whole batch, except that a final_url_id
+    pointing at a URL that does not redirect any further ends it right away.
+    Nothing but the batch at hand and the chains it is on is ever held in
+    memory. A URL caught in a redirect loop is its own target, and a URL
+    leading into one has the first URL of the loop it gets to."""
+
+    def _step(self, url_ids):
+        # url_id -> (next_url_id, final_url_id, next_url_id of the final target)
+        Final = dm.FoundURL.alias()
+        steps = {}
+        for batch in chunked(url_ids, 500):
+            query = (dm.FoundURL
+                     .select(dm.FoundURL.url_id, dm.FoundURL.next_url_id, dm.FoundURL.final_url_id, Final.next_url_id)
+                     .join(Final, JOIN.LEFT_OUTER, on=(dm.FoundURL.final_url_id == Final.url_id))
+                     .where(dm.FoundURL.url_id.in_(batch))
+                     .tuples())
+            for url_id, next_id, final_id, final_next in query:
+                steps[url_id] = (next_id, final_id, final_next)
+        return steps
+
+    def resolve(self, url_ids):
+        """Return {url_id: final target} for the given url_ids."""
+        targets = {}
+        paths = {x: [x] for x in url_ids}
+        current = {x: x for x in url_ids}
+        while current:
+            steps = self._step(list(set(current.values())))
+            following = {}
+            for url_id, at in current.items():
+                next_id, final_id, final_next = steps.get(at, (None, None, None))
+                if next_id is None:
+                    targets[url_id] = at
+                elif next_id in paths[url_id]:
+                    targets[url_id] = next_id
+                elif final_id is not None and (final_next is None or final_id == at):
+                    targets[url_id] = final_id
+                else:
+                    paths[url_id].append(next_id)
+                    following[url_id] = next_id
+            current = following
+        return targets
+
+
+class DelimitedEdgeWriter:
+
+    def __init__(self, path, delimiter):
+        self.out = sys.stdout if path == '-' else open(path, 'w', newline='')
+        self.writer = csv.writer(self.out, delimiter=delimiter, quotechar='"', lineterminator="\n", quoting=csv.QUOTE_ALL)
+
+    def write_header(self, columns):
+        self.writer.writerow(columns)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        if self.out is not sys.stdout:
+            self.out.close()
+
+
+class ParquetEdgeWriter:
+    """Writes every chunk as a row group of its own, so nothing but the
+    current chunk is ever held in memory."""
+
+    def __init__(self, path):
+        # pyarrow is only needed for this format
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.path = path
+        self.writer = None
+
+    def write_header(self, columns):
+        self.columns = columns
+        self.schema = self.pyarrow.schema([(x, self.pyarrow.string()) for x in columns])
+        self.writer = self.pyarrow.parquet.ParquetWriter(self.path, self.schema)
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        self.writer.write_table(self.pyarrow.Table.from_arrays([self.pyarrow.array(x, type=self.pyarrow.string()) for x in columns], schema=self.schema))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+edge_writers = {
+    'csv': lambda path: DelimitedEdgeWriter(path, ','),
+    'tsv': lambda path: DelimitedEdgeWriter(path, '\t'),
+    'parquet': ParquetEdgeWriter
+}
+
+
+class EdgeExporter:
+    """Streams a scan's link graph out of FoundURLs and Backlinks, one edge
+    per backlink: the page linked to (followed to the end of any redirect
+    chain) with its root stem, content type and status code, and the page
+    linking to it. URLs are read in chunks of chunk_size, each picking up
+    where the last one stopped, together with the final target the crawler
+    recorded for them, so memory use only depends on the chunk size. The
+    export only ever reads from the database."""
+
+    columns = ['Target', 'Root Stem', 'Content-Type', 'Status Code', 'Source']
+
+    def __init__(self, config, scan, chunk_size=10000):
+        self.logger = config.logger
+        self.scan = scan
+        self.chunk_size = chunk_size
+
+    def _stale(self):
+        # Redirects logged before the crawler kept track of their final target, and those two workers raced on
+        Final = dm.FoundURL.alias()
+        return (dm.FoundURL
+                .select(dm.FoundURL.url_id)
+                .join(Final, JOIN.LEFT_OUTER, on=(dm.FoundURL.final_url_id == Final.url_id))
+                .where((dm.FoundURL.scan_id == self.scan.scan_id) & dm.FoundURL.next_url_id.is_null(False) &
+                       (dm.FoundURL.final_url_id.is_null() |
+                        (Final.next_url_id.is_null(False) & (Final.final_url_id.is_null() | (Final.final_url_id != Final.url_id))))))
+
+    def count_stale(self):
+        return self._stale().count()
+
+    def repair_final_targets(self):
+        """Fill in the final target of every redirect that is missing one
+        or has a stale one, chunk_size redirects at a time. Returns how many
+        were repaired."""
+        redirects = RedirectResolver()
+        repaired = 0
+        last_id = 0
+        while True:
+            stale = [x[0] for x in self._stale().where(dm.FoundURL.url_id > last_id).order_by(dm.FoundURL.url_id).limit(self.chunk_size).tuples()]
+            if not stale:
+                break
+            last_id = stale[-1]
+
+            targets = {}
+            for url_id, target in redirects.resolve(stale).items():
+                targets.setdefault(target, []).append(url_id)
+            for target, url_ids in targets.items():
+                for batch in chunked(url_ids, 1000):
+                    dm.FoundURL.update(final_url_id=target).where(dm.FoundURL.url_id.in_(batch)).execute()
+
+            repaired += len(stale)
+            self.logger.info("Repaired the final target of %s redirects, up to url_id %s.", str(repaired), str(last_id))
+
+        return repaired
+
+    def export(self, writer):
+        # Read only; repair_final_targets() is a step of its own
+        stale = self.count_stale()
+        if stale:
+            self.logger.warning("%s redirects of scan %s have no final target or a stale one and are exported as they are; run the export with --repair-redirects to fix them first.", str(stale), self.scan.name)
+
+        writer.write_header(self.columns)
+
+        Final = dm.FoundURL.alias()
+        Source = dm.FoundURL.alias()
+
+        edges = 0
+        last_id = 0
+        while True:
+            # A URL that redirects stands for the last one in its chain
+            query = (dm.FoundURL
+                     .select(dm.FoundURL.url_id, dm.FoundURL.url_text, dm.FoundURL.root_stem, dm.FoundURL.content_type, dm.FoundURL.status_code,
+                             Final.url_id, Final.url_text, Final.root_stem, Final.content_type, Final.status_code)
+                     .join(Final, JOIN.LEFT_OUTER, on=(dm.FoundURL.final_url_id == Final.url_id))
+                     .where((dm.FoundURL.scan_id == self.scan.scan_id) & (dm.FoundURL.url_id > last_id))
+                     .order_by(dm.FoundURL.url_id)
+                     .limit(self.chunk_size)
+                     .tuples())
+            targets = {x[0]: (x[6:] if x[5] is not None else x[1:5]) for x in query}
+            if not targets:
+                break
+            first_id = min(targets)
+            last_id = max(targets)
+
+            # Backlinks have no key of their own, but follow the FoundURLs they point at
+            query = (dm.Backlink
+                     .select(dm.Backlink.url_id, Source.url_text)
+                     .join(Source, on=(dm.Backlink.backlink_url_id == Source.url_id))
+                     .where(dm.Backlink.url_id.between(first_id, last_id))
+                     .tuples())
+
+            rows = []
+            for url_id, source in query.iterator():
+                if url_id not in targets:
+                    continue
+                rows.append(targets[url_id] + (source,))
+            writer.write_rows(rows)
+
+            edges += len(rows)
+            self.logger.info("Exported %s edges, up to url_id %s.", str(edges), str(last_id))
+
+        return edges
@@ -0,0 +1,401 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import queue
+import struct
+import time
+import types
+
+from .mqueue import MessageQueue, BatchAcker
+from .metrics import metrics
+
+
+class Journal:
+    """Append-only file of every message pushed onto one local queue, plus a
+    file of the ids of the messages acknowledged since. On startup the
+    messages that were never acknowledged are carried over into a fresh
+    journal, so a crawl stopped or killed at any point resumes with whatever
+    it had not finished.
+
+    The journal doubles as the queue's spill area. Messages are handed over
+    through a bounded multiprocessing queue while there is room in it; once
+    it is full they are only written to disk and read back from there, in
+    order, as it drains. Writes go straight to the OS, which survives the
+    crawler crashing but not the machine."""
+
+    record = struct.Struct('>QI')
+    ack_record = struct.Struct('>Q')
+
+    def __init__(self, path, memory_size, outstanding):
+        self.path = path
+        self.ack_path = path + '.acks'
+        self.outstanding = outstanding
+
+        self.lock = multiprocessing.Lock()
+        self.memory = multiprocessing.Queue(memory_size)
+        self.next_id = multiprocessing.RawValue('Q', 1)
+        self.write_offset = multiprocessing.RawValue('Q', 0)
+        self.spill_offset = multiprocessing.RawValue('Q', 0)
+        self.spilled = multiprocessing.RawValue('Q', 0)
+
+        self.recovered = self._recover()
+
+        self.fd = os.open(self.path, os.O_RDWR)
+        self.ack_fd = os.open(self.ack_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+
+    def _records(self, journal):
+        while True:
+            header = journal.read(self.record.size)
+            if len(header) < self.record.size:
+                return
+            message_id, length = self.record.unpack(header)
+            payload = journal.read(length)
+            if len(payload) < length:
+                # Torn write at the very end
+                return
+            yield message_id, payload
+
+    def _load_acks(self):
+        # Message ids are handed out sequentially, so a bitmap is the cheap way to hold millions of them
+        acked = bytearray()
+        if not os.path.exists(self.ack_path):
+            return acked
+
+        with open(self.ack_path, 'rb') as acks:
+            while True:
+                data = acks.read(self.ack_record.size * 8192)
+                data = data[:len(data) - len(data) % self.ack_record.size]
+                if not data:
+                    return acked
+                for (message_id,) in self.ack_record.iter_unpack(data):
+                    if message_id >> 3 >= len(acked):
+                        acked.extend(bytes(max((message_id >> 3) + 1, 2 * len(acked)) - len(acked)))
+                    acked[message_id >> 3] |= 1 << (message_id & 7)
+
+    def _recover(self):
+        acked = self._load_acks()
+
+        # Keep the ids as they were, so the old acks stay valid should we die halfway through
+        pending = 0
+        last_id = 0
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as out:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as journal:
+                    for message_id, payload in self._records(journal):
+                        last_id = max(last_id, message_id)
+                        if message_id >> 3 < len(acked) and acked[message_id >> 3] & (1 << (message_id & 7)):
+                            continue
+                        out.write(self.record.pack(message_id, len(payload)))
+                        out.write(payload)
+                        pending += 1
+            out.flush()
+            os.fsync(out.fileno())
+            size = out.tell()
+
+        os.replace(tmp, self.path)
+        open(self.ack_path, 'wb').close()
+
+        # Everything carried over is read back from disk
+        self.next_id.value = last_id + 1
+        self.write_offset.value = size
+        self.spill_offset.value = 0
+        self.spilled.value = pending
+        with self.outstanding.get_lock():
+            self.outstanding.value += pending
+
+        return pending
+
+    def push(self, payload, priority=None):
+        # Everything on a plain journal has the same priority
+        with self.lock:
+            message_id = self.next_id.value
+            self.next_id.value += 1
+
+            entry = self.record.pack(message_id, len(payload)) + payload
+            os.pwrite(self.fd, entry, self.write_offset.value)
+            self.write_offset.value += len(entry)
+
+            with self.outstanding.get_lock():
+                self.outstanding.value += 1
+
+            # Once anything is on disk only, everything after it has to queue up behind it
+            if not self.spilled.value:
+                try:
+                    self.memory.put_nowait((message_id, payload))
+                    self.spill_offset.value = self.write_offset.value
+                    return
+                except queue.Full:
+                    pass
+
+            self.spilled.value += 1
+
+    def get(self, timeout):
+        """Return the next (message_id, payload), or None if there was
+        nothing within timeout seconds."""
+        try:
+            if self.spilled.value:
+                return self.memory.get_nowait()
+            return self.memory.get(timeout=timeout)
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if not self.spilled.value:
+                return None
+
+            offset = self.spill_offset.value
+            message_id, length = self.record.unpack(os.pread(self.fd, self.record.size, offset))
+            payload = os.pread(self.fd, length, offset + self.record.size)
+
+            self.spill_offset.value = offset + self.record.size + length
+            self.spilled.value -= 1
+
+        return (message_id, payload)
+
+    def purge(self):
+        """Acknowledge every message not handed out yet, returning how
+        many there were."""
+        message_ids = []
+        with self.lock:
+            # What was just put may take a moment to come through
+            while self.memory.qsize():
+                try:
+                    message_ids.append(self.memory.get(timeout=1)[0])
+                except queue.Empty:
+                    break
+
+            offset = self.spill_offset.value
+            while offset < self.write_offset.value:
+                message_id, length = self.record.unpack(os.pread(self.fd, self.record.size, offset))
+                message_ids.append(message_id)
+                offset += self.record.size + length
+            self.spill_offset.value = offset
+            self.spilled.value = 0
+
+        if message_ids:
+            self.ack(message_ids)
+        return len(message_ids)
+
+    def ack(self, message_ids):
+        os.write(self.ack_fd, b''.join(self.ack_record.pack(x) for x in message_ids))
+        with self.outstanding.get_lock():
+            self.outstanding.value -= len(message_ids)
+
+    def length(self):
+        return self.memory.qsize() + self.spilled.value
+
+
+class PriorityJournal:
+    """The journals of a local queue with priorities, one per priority from
+    0 to max_priority, handing out the highest priority messages first.
+    Priority 0 keeps the queue's plain journal, so that turning priorities on
+    carries over whatever it still holds. Message ids are (priority, id)
+    pairs."""
+
+    def __init__(self, path, max_priority, memory_size, outstanding):
+        base, extension = os.path.splitext(path)
+        self.journals = [Journal(path if x == 0 else '%s.p%d%s' % (base, x, extension), memory_size, outstanding) for x in range(max_priority + 1)]
+        self.recovered = sum(x.recovered for x in self.journals)
+
+    def push(self, payload, priority=None):
+        self.journals[min(priority or 0, len(self.journals) - 1)].push(payload)
+
+    def get(self, timeout):
+        for priority in range(len(self.journals) - 1, -1, -1):
+            message = self.journals[priority].get(0)
+            if message is not None:
+                return ((priority, message[0]), message[1])
+
+        # There is no waiting on several queues at once, so look again a little later
+        time.sleep(min(timeout, 0.005))
+        return None
+
+    def ack(self, message_ids):
+        by_priority = {}
+        for priority, message_id in message_ids:
+            by_priority.setdefault(priority, []).append(message_id)
+        for priority, ids in by_priority.items():
+            self.journals[priority].ack(ids)
+
+    def purge(self):
+        return sum(x.purge() for x in self.journals)
+
+    def length(self):
+        return sum(x.length() for x in self.journals)
+
+
+class LocalQueue:
+    """A worker's handle on a journal; tracks which messages it has been
+    given and acknowledges them the way BatchAcker asks a pika channel to."""
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.delivery_tags = itertools.count(1)
+        self.unacked = {}
+
+    def deliver(self, message_id):
+        delivery_tag = next(self.delivery_tags)
+        self.unacked[delivery_tag] = message_id
+        return delivery_tag
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if multiple:
+            tags = [x for x in self.unacked if x <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        self.journal.ack([self.unacked.pop(x) for x in tags])
+
+    def close(self):
+        pass
+
+
+class LocalFrontier:
+    """Frontier kept on this machine, for crawls that don't need a broker.
+    Offers the same calls as MessageQueue, the RabbitMQ frontier, with each
+    queue a Journal under the configured spool directory.
+
+    The journals live in the processes forked after the first LocalFrontier
+    is created, so a crawl using it has to start its page and link workers
+    from the same invocation. queue_consume() returns once every message
+    pushed by any of them has been acknowledged, i.e. the crawl is done.
+    Queues are never sharded; there is only the one machine to spread them
+    over. A queue with priorities is a PriorityJournal."""
+
+    journals = {}
+    outstanding = None
+
+    drains = True
+
+    def __init__(self, config):
+        self.config = config
+        self.spool_dir = config.frontierconfig['spool_dir']
+        self.memory_size = config.frontierconfig['memory_size']
+
+        if LocalFrontier.outstanding is None:
+            LocalFrontier.outstanding = multiprocessing.Value('q', 0)
+            os.makedirs(self.spool_dir, exist_ok=True)
+
+        self.queues = {}
+        self.acker = None
+        self.consuming = False
+
+        self.timers = []
+        self.sequence = itertools.count()
+        self.callbacks = queue.SimpleQueue()
+
+    def create_queue(self, queue_name, durable=True, shards=0, priorities=0):
+        self.config.logger.debug('Opening local queue %s.', queue_name)
+        if queue_name not in self.journals:
+            path = os.path.join(self.spool_dir, queue_name + '.journal')
+            if priorities:
+                journal = PriorityJournal(path, priorities, self.memory_size, self.outstanding)
+            else:
+                journal = Journal(path, self.memory_size, self.outstanding)
+            if journal.recovered:
+                self.config.logger.info('Resuming %s unfinished messages on queue %s.', str(journal.recovered), queue_name)
+            self.journals[queue_name] = journal
+
+        self.queues[queue_name] = LocalQueue(self.journals[queue_name])
+        return self.queues[queue_name]
+
+    def destroy_conn(self):
+        self.queues = {}
+
+    def destroy_queue(self, queue_name):
+        del self.queues[queue_name]
+
+    def queue_length(self, queue_name, durable=True):
+        return self.journals[queue_name].length()
+
+    def queue_purge(self, queue_name):
+        return self.journals[queue_name].purge()
+
+    def queue_push(self, queue_name, payload, key=None, priority=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.journals[queue_name].push(payload, priority)
+        metrics.inc('webcrawler_messages_published_total', queue=queue_name)
+
+    def queue_consume(self, queue_name, callback, prefetch_count=1, ack_batch_size=1, ack_batch_delay=0.1, before_ack=None, shards=None):
+        self.config.logger.debug("Starting consumer '%s' for local queue '%s' with prefetch %s.", callback.__name__, queue_name, str(prefetch_count))
+
+        channel = self.queues[queue_name]
+        self.acker = BatchAcker(self, channel, min(ack_batch_size, prefetch_count), ack_batch_delay, before_ack)
+
+        self.consuming = True
+        while self.consuming:
+            self._run_events()
+
+            if len(channel.unacked) < prefetch_count:
+                # Don't sit on the queue while there are fetches to hand back
+                message = channel.journal.get(0 if self.acker.outstanding else self._timeout())
+                if message is not None:
+                    delivery_tag = channel.deliver(message[0])
+                    metrics.inc('webcrawler_messages_consumed_total', queue=queue_name)
+                    self.acker.received(delivery_tag)
+                    callback(channel, types.SimpleNamespace(delivery_tag=delivery_tag), None, message[1])
+                    continue
+
+            if not channel.unacked and self._next_timer() is None and self.outstanding.value == 0:
+                self.config.logger.info("Local frontier is empty, stopping consumer for queue '%s'.", queue_name)
+                break
+
+            if self.acker.outstanding or len(channel.unacked) >= prefetch_count:
+                try:
+                    self.callbacks.get(timeout=self._timeout())()
+                except queue.Empty:
+                    pass
+
+    def queue_ack(self, delivery_tag):
+        self.acker.done(delivery_tag)
+
+    def call_later(self, delay, callback):
+        timer = [time.monotonic() + delay, next(self.sequence), callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        timer[2] = None
+
+    def call_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def _next_timer(self):
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        return self.timers[0][0] if self.timers else None
+
+    def _timeout(self):
+        due = self._next_timer()
+        if due is None:
+            return 0.05
+        return min(max(due - time.monotonic(), 0), 0.05)
+
+    def _run_events(self):
+        while True:
+            try:
+                self.callbacks.get_nowait()()
+            except queue.Empty:
+                break
+
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            callback = heapq.heappop(self.timers)[2]
+            if callback:
+                callback()
+
+    def queue_stop_consuming(self, queue_name):
+        self.config.logger.debug("Stopping consumer for local queue '%s'.", queue_name)
+        self.consuming = False
+
+    def buffered_publisher(self):
+        # Pushing is a local write already, there is no round trip to save by batching
+        return None
+
+
+frontiers = {
+    'rabbitmq': MessageQueue,
+    'local': LocalFrontier
+}
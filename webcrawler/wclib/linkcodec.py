@@ -0,0 +1,51 @@
+import zlib
+
+import msgpack
+
+
+# First byte of a packed link payload. JSON payloads, from page workers
+# sending link_encoding = json, start with '{'.
+PACKED = b'\x01'
+DEFLATED = b'\x02'
+
+
+def _origin(url):
+    # Canonical URLs always have a path, so the origin ends at its first slash
+    end = url.find('/', url.find('://') + 3)
+    if end < 0:
+        return (url, '')
+    return (url[:end], url[end:])
+
+
+def pack_links(url, depth, links, compress_over=512):
+    """Encode the links found on url, a list of (canonical url, in scope,
+    times found) for a page at depth, as msgpack. Links are grouped by origin,
+    so that each scheme and host is spelled out once, and payloads over
+    compress_over bytes are deflated on top, which mostly takes care of
+    the paths the links share."""
+    origins = {}
+    for link, in_scope, count in links:
+        origin, rest = _origin(link)
+        origins.setdefault(origin, []).append((rest, count << 1 | bool(in_scope)))
+
+    packed = msgpack.packb((url, depth, [(origin, [x for pair in rests for x in pair]) for origin, rests in origins.items()]))
+    if len(packed) > compress_over:
+        return DEFLATED + zlib.compress(packed, 1)
+    return PACKED + packed
+
+
+def unpack_links(payload):
+    """Reverse of pack_links(). Returns (url, depth, links)."""
+    if payload[:1] == DEFLATED:
+        packed = zlib.decompress(payload[1:])
+    elif payload[:1] == PACKED:
+        packed = payload[1:]
+    else:
+        raise ValueError("not a packed link payload")
+
+    url, depth, origins = msgpack.unpackb(packed)
+    links = []
+    for origin, rests in origins:
+        for index in range(0, len(rests), 2):
+            links.append((origin + rests[index], bool(rests[index + 1] & 1), rests[index + 1] >> 1))
+    return (url, depth, links)
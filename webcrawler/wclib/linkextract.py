@@ -0,0 +1,159 @@
+import codecs
+import time
+
+from abc import ABC, abstractmethod
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+from urllib3.exceptions import ReadTimeoutError
+
+
+def read_capped(chunks, max_bytes, deadline=None):
+    """Collect byte chunks until max_bytes have been read or the
+    time.monotonic() deadline has passed, leaving the rest of the body on the
+    wire. Returns the chunks and why reading stopped early, 'size' or
+    'deadline', or None if the body was read to the end."""
+    body = []
+    received = 0
+    for chunk in chunks:
+        body.append(chunk)
+        received += len(chunk)
+        if received >= max_bytes:
+            return (body, 'size')
+        if deadline is not None and time.monotonic() >= deadline:
+            return (body, 'deadline')
+
+    # Chunks that stop coming at the deadline (see iter_raw()) end early as well
+    if deadline is not None and time.monotonic() >= deadline:
+        return (body, 'deadline')
+    return (body, None)
+
+
+def iter_raw(raw, timeout, deadline, chunk_size=65536):
+    """Yield the body of a streamed urllib3 response as it arrives, content
+    decoded, in chunks of up to chunk_size bytes. No single read waits longer
+    than timeout seconds or past the time.monotonic() deadline, so a server
+    trickling the body cannot hold on to us; the chunks just stop coming at
+    the deadline. A read timing out before it is passed on as usual."""
+    sock = getattr(raw.connection, 'sock', None)
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if sock is not None:
+            sock.settimeout(min(timeout, remaining))
+        try:
+            chunk = raw.read1(chunk_size, decode_content=True)
+        except ReadTimeoutError:
+            if remaining > timeout:
+                raise
+            return
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_decoded(chunks, encoding, max_bytes, logger=None):
+    """Incrementally decode an iterable of byte chunks, stopping once
+    max_bytes have been consumed so the caller can drop the connection."""
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    received = 0
+    for chunk in chunks:
+        received += len(chunk)
+        yield decoder.decode(chunk)
+        if received >= max_bytes:
+            if logger:
+                logger.debug("Stopped reading body after %s bytes.", str(received))
+            break
+
+    yield decoder.decode(b'', final=True)
+
+
+class LinkExtractor(ABC):
+    """Collects the href of every <a> in a document fed to it in pieces.
+    Links are resolved against <base href> when the document has one and
+    otherwise returned as found, for crawl_links() to resolve."""
+
+    def __init__(self, url):
+        self.url = url
+        self.base = None
+        self.hrefs = []
+
+    @abstractmethod
+    def feed(self, text):
+        pass
+
+    def _finish(self):
+        pass
+
+    def links(self):
+        self._finish()
+        if self.base:
+            return [urljoin(self.base, x) for x in self.hrefs]
+        return self.hrefs
+
+
+class _AnchorParser(HTMLParser):
+
+    def __init__(self, extractor):
+        super().__init__(convert_charrefs=True)
+        self.extractor = extractor
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value is not None:
+                    self.extractor.hrefs.append(value.strip())
+                    break
+        elif tag == 'base' and self.extractor.base is None:
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.extractor.base = urljoin(self.extractor.url, value.strip())
+                    break
+
+
+class StreamingLinkExtractor(LinkExtractor):
+    """Tokenizes with the standard library's html.parser and only looks at
+    anchor and base start tags; no tree is ever built."""
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.parser = _AnchorParser(self)
+
+    def feed(self, text):
+        self.parser.feed(text)
+
+    def _finish(self):
+        self.parser.close()
+
+
+class Html5libLinkExtractor(LinkExtractor):
+    """The original full html5lib/BeautifulSoup parse, for pages the
+    streaming tokenizer gets wrong. Buffers the whole document."""
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.buffer = []
+
+    def feed(self, text):
+        self.buffer.append(text)
+
+    def _finish(self):
+        soup = BeautifulSoup(''.join(self.buffer), features="html5lib")
+
+        base = soup.find('base', href=True)
+        if base:
+            self.base = urljoin(self.url, base['href'].strip())
+
+        self.hrefs = [x.get('href').strip() for x in soup.find_all('a', href=True)]
+
+
+extractors = {
+    'streaming': StreamingLinkExtractor,
+    'html5lib': Html5libLinkExtractor
+}
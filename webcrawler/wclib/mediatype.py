@@ -0,0 +1,112 @@
+import functools
+import re
+
+from collections import namedtuple
+
+
+MediaType = namedtuple('MediaType', ['type', 'subtype', 'params'])
+
+# RFC 9110 token, and a parameter value as token or quoted-string
+token = r"[!#$%&'*+.^_`|~0-9A-Za-z-]+"
+media_type_pattern = re.compile(r'\s*(' + token + r')/(' + token + r')\s*')
+parameter_pattern = re.compile(r';\s*(' + token + r')\s*=\s*(' + token + r'|"(?:[^"\\]|\\.)*")\s*')
+quoted_pair = re.compile(r'\\(.)')
+
+# Markup an HTML document starts with, after any byte order mark and whitespace
+html_signatures = (b'<!doctype html', b'<html', b'<head', b'<body', b'<title', b'<script', b'<iframe', b'<h1', b'<div',
+                   b'<font', b'<table', b'<a', b'<style', b'<b', b'<br', b'<p', b'<!--')
+
+
+def parse_media_type(header):
+    """Split a Content-Type header into a MediaType, with the type, subtype
+    and parameter names lowercased and quoted parameter values unquoted.
+    Returns None if there is no header or it is not a media type. Parameters
+    that cannot be parsed are skipped."""
+    if not header:
+        return None
+
+    match = media_type_pattern.match(header)
+    if not match:
+        return None
+
+    params = {}
+    position = match.end()
+    while position < len(header):
+        parameter = parameter_pattern.match(header, position)
+        if not parameter:
+            # Skip to the next parameter
+            position = header.find(';', position + 1)
+            if position < 0:
+                break
+            continue
+
+        value = parameter.group(2)
+        if value.startswith('"'):
+            value = quoted_pair.sub(r'\1', value[1:-1])
+        params.setdefault(parameter.group(1).lower(), value)
+        position = parameter.end()
+
+    return MediaType(match.group(1).lower(), match.group(2).lower(), params)
+
+
+def sniff_html(data):
+    """Whether the first bytes of a body look like HTML, going by the
+    signatures of the WHATWG MIME sniffing standard."""
+    data = data.lstrip(b'\xef\xbb\xbf').lstrip()[:16].lower()
+    for signature in html_signatures:
+        if data.startswith(signature) and (signature == b'<!--' or data[len(signature):len(signature) + 1] in (b' ', b'>', b'')):
+            return True
+    return False
+
+
+class MediaTypeClassifier:
+    """Decides from a response's Content-Type header whether its body is
+    worth reading. Media types are allowed or denied by exact type, e.g.
+    text/html, or by family, e.g. text/* or */*; when several rules match
+    the most specific one wins, and a deny over an allow of the same rank.
+    Anything no rule allows is skipped.
+
+    With sniffing on, bodies without a usable header or of one of the
+    sniff_types are read as far as their first chunk, which sniff_html()
+    then judges. Headers are parsed and classified once, then remembered."""
+
+    parse = 'parse'
+    skip = 'skip'
+    sniff = 'sniff'
+
+    def __init__(self, allow=('text/html', 'application/xhtml+xml'), deny=(), sniff=False, sniff_types=('application/octet-stream', 'text/plain'), cache_size=1024):
+        self.rules = {}
+        for verdict, patterns in ((self.parse, allow), (self.skip, deny)):
+            for pattern in patterns:
+                self.rules[pattern.strip().lower()] = verdict
+        self.sniffing = sniff
+        self.sniff_types = frozenset(x.strip().lower() for x in sniff_types)
+
+        self.classify = functools.lru_cache(maxsize=cache_size)(self._classify)
+
+    def _rule(self, media_type):
+        for pattern in (media_type.type + '/' + media_type.subtype, media_type.type + '/*', '*/*'):
+            if pattern in self.rules:
+                return self.rules[pattern]
+        return self.skip
+
+    def _classify(self, header):
+        """Return (verdict, MediaType or None) for a raw Content-Type
+        header, the verdict being one of parse, skip or sniff."""
+        media_type = parse_media_type(header)
+        if media_type is None:
+            return (self.sniff if self.sniffing else self.skip, None)
+
+        if self.sniffing and media_type.type + '/' + media_type.subtype in self.sniff_types:
+            return (self.sniff, media_type)
+        return (self._rule(media_type), media_type)
+
+    def wants_body(self, header):
+        return self.classify(header)[0] != self.skip
+
+    def needs_sniffing(self, header):
+        return self.classify(header)[0] == self.sniff
+
+    def charset(self, header):
+        media_type = self.classify(header)[1]
+        return media_type.params.get('charset') if media_type else None
@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, _escape(v)) for k, v in items) + '}'
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """Process wide counters and histograms, rendered in the Prometheus text
+    exposition format. Recording is a dict lookup and an add under a lock,
+    cheap enough to leave on everywhere."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=default_buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Context manager observing the time spent in its block."""
+        return _Timer(self, name, labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append('# TYPE %s counter' % name)
+                    seen.add(name)
+                lines.append('%s%s %s' % (name, _labels(labels), repr(value)))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append('# TYPE %s histogram' % name)
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels, ('le', repr(bound))), cumulative))
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, ('le', '+Inf')), histogram.count))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), repr(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, _labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(host, port):
+    """Serve /metrics (any path, really) from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='webcrawler-metrics', daemon=True).start()
+    return server
+
+
+def write_textfile(path, interval):
+    """Rewrite path every interval seconds for node_exporter's textfile
+    collector; written to a temp file and renamed so readers never see half
+    a file."""
+    def write():
+        while True:
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as out:
+                out.write(metrics.render())
+            os.replace(tmp, path)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=write, name='webcrawler-metrics-textfile', daemon=True)
+    thread.start()
+    return thread
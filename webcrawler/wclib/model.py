@@ -1,15 +1,169 @@
+import datetime
+import logging
+import time
+
 from peewee import *
-from playhouse.shortcuts import model_to_dict, dict_to_model
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.pool import PooledDatabase, PooledMySQLDatabase
+from playhouse.shortcuts import model_to_dict, dict_to_model, ReconnectMixin
+
+from .sqlitedb import CrawlerSqliteDatabase
+
 
+logger = logging.getLogger('webcrawler')
 
 database = Proxy()
 
+
+class CrawlerDatabase(ReconnectMixin, PooledMySQLDatabase):
+    """Pooled MySQL connections that survive the server going away. A query
+    failing outside a transaction because the connection dropped is retried
+    on a fresh one, waiting for the server to come back up to
+    reconnect_attempts times, backing off from reconnect_delay seconds.
+    Failures inside a transaction are left to the caller, as whatever the
+    transaction wrote before is lost."""
+
+    reconnect_errors = ReconnectMixin.reconnect_errors + (
+        (OperationalError, '2003'),  # Can't connect, e.g. while the server restarts.
+    )
+
+    def __init__(self, database, reconnect_attempts=10, reconnect_delay=1.0, **kwargs):
+        super().__init__(database, **kwargs)
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+
+    def _reconnect(self, func, *args, **kwargs):
+        delay = self.reconnect_delay
+        for attempt in range(self.reconnect_attempts):
+            try:
+                return super()._reconnect(func, *args, **kwargs)
+            except (OperationalError, InterfaceError) as error:
+                if self.in_transaction() or not any(x in str(error).lower() for x in self._reconnect_errors.get(type(error), [])):
+                    raise
+                logger.error("Lost the database connection (%s), retrying in %s seconds.", error, str(delay))
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+                if not self.is_closed():
+                    self.close()
+
+        return super()._reconnect(func, *args, **kwargs)
+
+
 def init(config):
-    database.initialize(MySQLDatabase(config.dbname, **config.dbconfig))
+    if config.dbtype == 'sqlite':
+        dbconfig = {k: v for k, v in config.dbconfig.items() if k not in CrawlerSqliteDatabase.writer_settings}
+        database.initialize(CrawlerSqliteDatabase(config.dbname, **dbconfig))
+    else:
+        database.initialize(CrawlerDatabase(config.dbname, **config.dbconfig))
 
 # Kludge... Get rid of...
 def init2(dbname, dbconfig):
-    database.initialize(MySQLDatabase(dbname, **dbconfig))
+    database.initialize(CrawlerDatabase(dbname, **dbconfig))
+
+def create_schema():
+    # For a SQLite database the crawler sets up itself; MySQL gets data/ddl-schema.sql and data/ddl-upgrade.sql
+    if database.table_exists(FoundURL._meta.table_name):
+        # Columns added since the file was created, before their indexes are
+        existing = [x.name for x in database.get_columns(FoundURL._meta.table_name)]
+        migrator = SqliteMigrator(database)
+        migrate(*[migrator.add_column(FoundURL._meta.table_name, x.column_name, x) for x in FoundURL._meta.sorted_fields if x.column_name not in existing])
+
+    database.create_tables([Scan, FoundURL, Backlink, PageLink, ScanBlacklist, ScanError, ScanRoot, ScanWorker], safe=True)
+
+def release():
+    # Close every connection this process holds, pooled ones included, e.g. before forking workers
+    if isinstance(database.obj, PooledDatabase):
+        database.close_all()
+    else:
+        database.close()
+
+def database_now():
+    # The database server's clock, the one workers on different machines all agree on
+    now = database.execute_sql('SELECT CURRENT_TIMESTAMP').fetchone()[0]
+    if isinstance(now, str):
+        # SQLite has no datetime type of its own
+        now = datetime.datetime.strptime(now, '%Y-%m-%d %H:%M:%S')
+    return now
+
+
+# peewee builds a query's SQL anew on every execution. The statements run for
+# nearly every URL are built once per database and then executed with fresh
+# parameters.
+_statements = {}
+
+def _statement(name, build):
+    key = (name, database.obj)
+    if key not in _statements:
+        _statements[key] = build()
+    return _statements[key]
+
+def get_found_url(scan_id, url_hash):
+    sql = _statement('get_found_url', lambda: FoundURL.select().where((FoundURL.scan_id == 0) & (FoundURL.url_hash == '')).sql()[0])
+    for found_url in FoundURL.raw(sql, scan_id, url_hash):
+        return found_url
+    return None
+
+def get_or_create_found_url(scan_id, url_hash):
+    # Same as FoundURL.get_or_create(), with the lookup that nearly always suffices cached
+    found_url = get_found_url(scan_id, url_hash)
+    if found_url is not None:
+        return (found_url, False)
+
+    try:
+        # A single INSERT needs no transaction of its own, only a savepoint inside someone else's
+        if not database.in_transaction():
+            return (FoundURL.create(scan_id=scan_id, url_hash=url_hash), True)
+        with database.atomic():
+            return (FoundURL.create(scan_id=scan_id, url_hash=url_hash), True)
+    except IntegrityError:
+        # Another worker created it in the meantime
+        found_url = get_found_url(scan_id, url_hash)
+        if found_url is None:
+            raise
+        return (found_url, False)
+
+def save_found_url(found_url):
+    # Same as found_url.save() for a row that already exists, with the UPDATE cached
+    fields = [x for x in FoundURL._meta.sorted_fields if x is not FoundURL.url_id]
+    sql = _statement('save_found_url', lambda: FoundURL.update({x: None for x in fields}).where(FoundURL.url_id == 0).sql()[0])
+    params = [x.db_value(found_url.__data__.get(x.name)) for x in fields]
+    params.append(found_url.url_id)
+    database.execute_sql(sql, params)
+    found_url._dirty.clear()
+
+def link_redirect(found_url, redirect):
+    # found_url redirects to redirect, so it ends up wherever redirect does, and so does every
+    # URL that so far ended at found_url. final_url_id is only set on URLs that redirect; a chain
+    # that loops ends at the URL closing the loop.
+    target = redirect.final_url_id or redirect.url_id
+    if redirect.url_id == found_url.url_id or target == found_url.url_id:
+        target = found_url.url_id
+
+    found_url.final_url_id = target
+    sql = _statement('link_redirect', lambda: FoundURL.update(final_url_id=0).where((FoundURL.scan_id == 0) & (FoundURL.final_url_id == 0)).sql()[0])
+    database.execute_sql(sql, (target, found_url.scan_id_id, found_url.url_id))
+
+def record_depth(url_ids, depth):
+    # The URLs have been let onto the page queue at depth, or reached by a shorter way than before
+    return (FoundURL
+            .update(depth=depth)
+            .where(FoundURL.url_id.in_(url_ids) & (FoundURL.depth.is_null() | (FoundURL.depth > depth)))
+            .execute())
+
+def upsert_found_urls(rows):
+    # INSERT ... ON DUPLICATE KEY UPDATE on (scan_id, url_hash). Existing rows are left
+    # alone apart from picking up a root_stem if they do not have one yet.
+    if isinstance(database.obj, SqliteDatabase):
+        return (FoundURL
+                .insert_many(rows)
+                .on_conflict(conflict_target=[FoundURL.scan_id, FoundURL.url_hash],
+                             update={FoundURL.root_stem: fn.COALESCE(FoundURL.root_stem, EXCLUDED.root_stem)})
+                .execute())
+
+    return (FoundURL
+            .insert_many(rows)
+            .on_conflict(update={FoundURL.root_stem: fn.COALESCE(FoundURL.root_stem, fn.VALUES(FoundURL.root_stem))})
+            .execute())
 
 
 class UnknownField(object):
@@ -42,18 +196,23 @@ class FoundURL(BaseModel):
     is_crawled = IntegerField(null=True)
     is_blacklisted = IntegerField(null=True)
     next_url_id = ForeignKeyField(column_name='next_url_id', field='url_id', model='self', null=True)
+    final_url_id = IntegerField(null=True)
+    depth = IntegerField(null=True)
     status_code = CharField(null=True)
     content_type = CharField(null=True)
     page_title = TextField(null=True)
     created_timestamp = DateTimeField(null=True)
     crawled_timestamp = DateTimeField(null=True)
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    content_digest = CharField(null=True)
 
     class Meta:
         table_name = 'FoundURLs'
         indexes = (
-            (('scan', 'root_stem'), False),
-            (('scan', 'url_hash'), False),
-            (('scan', 'url_hash'), True),
+            (('scan_id', 'root_stem'), False),
+            (('scan_id', 'url_hash'), True),
+            (('scan_id', 'final_url_id'), False),
         )
 
 class Backlink(BaseModel):
@@ -107,3 +266,16 @@ class ScanRoot(BaseModel):
             (('scan_id', 'fqdn', 'port'), True),
         )
         primary_key = False
+
+class ScanWorker(BaseModel):
+    scan_id = ForeignKeyField(column_name='scan_id', field='scan_id', model=Scan)
+    worker_id = CharField()
+    shards = TextField(null=True)
+    heartbeat_timestamp = DateTimeField(null=True)
+
+    class Meta:
+        table_name = 'ScanWorkers'
+        indexes = (
+            (('scan_id', 'worker_id'), True),
+        )
+        primary_key = False
@@ -1,21 +1,50 @@
 import pika
 
+from .metrics import metrics
+
 class MessageQueue:
 
     mq_conn = None
     queues = {}
 
+    # Consumers run until interrupted; queue_consume() only returns if the broker cancelled them
+    drains = False
+
     def __init__(self, config):
         self.config = config
+
+        # Shard queues of the sharded queues, and our consumer tag on each shard we consume
+        self.shards = {}
+        self.consumers = {}
+
+        # Arguments each queue was declared with, which every later declaration has to repeat
+        self.arguments = {}
+
         if self.mq_conn is None:
             credentials = pika.PlainCredentials(config.mqueue['user'], config.mqueue['password'])
             parameters = pika.ConnectionParameters(config.mqueue['host'], config.mqueue['port'], config.mqueue['vhost'], credentials, heartbeat=600, blocked_connection_timeout=300)
             self.mq_conn = pika.BlockingConnection(parameters)
 
-    def create_queue(self, queue_name, durable=True):
+    def create_queue(self, queue_name, durable=True, shards=0, priorities=0):
         self.config.logger.debug('Creating and connecting to queue %s and durable is %s.', queue_name, str(durable))
         self.queues[queue_name] = self.mq_conn.channel()
-        self.queues[queue_name].queue_declare(queue=queue_name, durable=durable)
+
+        # A priority queue hands out its highest priority messages first. RabbitMQ refuses to redeclare
+        # an existing queue with other arguments, so one created without priorities has to be deleted first.
+        self.arguments[queue_name] = {'x-max-priority': priorities} if priorities else None
+
+        if not shards:
+            self.queues[queue_name].queue_declare(queue=queue_name, durable=durable, arguments=self.arguments[queue_name])
+            return self.queues[queue_name]
+
+        # A sharded queue is a consistent hash exchange (the rabbitmq_consistent_hash_exchange plugin) spreading
+        # messages over the shard queues by the hash of their routing key. Equal weights give equal shares.
+        exchange = queue_name + '_shards'
+        self.queues[queue_name].exchange_declare(exchange=exchange, exchange_type='x-consistent-hash', durable=durable)
+        self.shards[queue_name] = ['%s_%d' % (queue_name, x) for x in range(shards)]
+        for shard in self.shards[queue_name]:
+            self.queues[queue_name].queue_declare(queue=shard, durable=durable, arguments=self.arguments[queue_name])
+            self.queues[queue_name].queue_bind(queue=shard, exchange=exchange, routing_key='1')
 
         return self.queues[queue_name]
 
@@ -30,21 +59,214 @@ class MessageQueue:
         del self.queues[queue_name]
 
     def queue_length(self, queue_name, durable=True):
-        state = self.queues[queue_name].queue_declare(queue=queue_name, durable=durable)
-        return state.method.message_count
+        return sum(self.queues[queue_name].queue_declare(queue=x, durable=durable, arguments=self.arguments.get(queue_name)).method.message_count
+                   for x in self.shards.get(queue_name, [queue_name]))
+
+    def queue_purge(self, queue_name):
+        # Drops the messages not delivered to any consumer yet, returning how many
+        return sum(self.queues[queue_name].queue_purge(queue=x).method.message_count for x in self.shards.get(queue_name, [queue_name]))
 
-    def queue_push(self, queue_name, payload):
+    def route(self, queue_name, key=None):
+        # Exchange and routing key to publish to; messages for a sharded queue are routed by key
+        if queue_name in self.shards:
+            return (queue_name + '_shards', key or '')
+        return ('', queue_name)
+
+    def queue_push(self, queue_name, payload, key=None, priority=None):
         #self.config.logger.debug("Pushing message '%s' onto queue '%s'.", payload, queue_name)
-        self.queues[queue_name].basic_publish(exchange='', routing_key=queue_name, body=payload, properties=pika.BasicProperties(delivery_mode=2))
+        exchange, routing_key = self.route(queue_name, key)
+        self.queues[queue_name].basic_publish(exchange=exchange, routing_key=routing_key, body=payload, properties=pika.BasicProperties(delivery_mode=2, priority=priority))
+        metrics.inc('webcrawler_messages_published_total', queue=queue_name)
+
+    def queue_consume(self, queue_name, callback, prefetch_count=1, ack_batch_size=1, ack_batch_delay=0.1, before_ack=None, shards=None):
+        self.config.logger.debug("Starting consumer '%s' for queue '%s' with prefetch %s.", callback.__name__, queue_name, str(prefetch_count))
+
+        # Never hold back more acks than the broker is willing to have outstanding
+        self.acker = BatchAcker(self, self.queues[queue_name], min(ack_batch_size, prefetch_count), ack_batch_delay, before_ack)
 
-    def queue_consume(self, queue_name, callback):
-        self.config.logger.debug("Starting consumer '%s' for queue '%s'.", callback.__name__, queue_name)
-        self.queues[queue_name].basic_qos(prefetch_count=1)
-        self.queues[queue_name].basic_consume(queue_name, callback)
-        self.queues[queue_name].start_consuming()
+        def on_message(ch, method, properties, body):
+            metrics.inc('webcrawler_messages_consumed_total', queue=queue_name)
+            self.acker.received(method.delivery_tag)
+            callback(ch, method, properties, body)
+
+        self.on_message = on_message
+        self.stopped = False
+        # RabbitMQ applies prefetch per consumer unless told otherwise, and each shard held is a consumer
+        self.queues[queue_name].basic_qos(prefetch_count=prefetch_count, global_qos=True)
+        if queue_name not in self.shards:
+            self.queues[queue_name].basic_consume(queue_name, on_message)
+            self.queues[queue_name].start_consuming()
+            return
+
+        self.consume_shards(queue_name, shards or [])
+        while True:
+            # start_consuming() returns at once with no consumers on the channel
+            self.queues[queue_name].start_consuming()
+            if self.consumers or self.stopped:
+                return
+
+            # No shards of our own for now, which only a rebalance timer can change
+            if not self.wait_for_shards():
+                return
+
+    def wait_for_shards(self):
+        """Runs the connection's timers and heartbeats for a while, for a
+        consumer left without shards. Returns False to stop waiting."""
+        self.mq_conn.process_data_events(time_limit=1)
+        return True
+
+    def consume_shards(self, queue_name, shards):
+        """Consume exactly the given shards of a sharded queue from now on.
+        Messages of a shard given up that pika has not handed to us yet go
+        back to the broker."""
+        channel = self.queues[queue_name]
+        wanted = set(self.shards[queue_name][x] for x in shards)
+        for shard in set(self.consumers) - wanted:
+            self.config.logger.debug("Stopping consumer for shard '%s'.", shard)
+            channel.basic_cancel(self.consumers.pop(shard))
+        for shard in sorted(wanted - set(self.consumers)):
+            self.config.logger.debug("Starting consumer for shard '%s'.", shard)
+            self.consumers[shard] = channel.basic_consume(shard, self.on_message)
+
+    def queue_ack(self, delivery_tag):
+        self.acker.done(delivery_tag)
+
+    def call_later(self, delay, callback):
+        # Runs callback from the connection's I/O loop, e.g. while consuming
+        return self.mq_conn.call_later(delay, callback)
+
+    def remove_timeout(self, timer):
+        self.mq_conn.remove_timeout(timer)
+
+    def call_threadsafe(self, callback):
+        # The only pika call that may be made from another thread
+        self.mq_conn.add_callback_threadsafe(callback)
 
     def queue_stop_consuming(self, queue_name):
         self.config.logger.debug("Stopping consumer for queue '%s'.", queue_name)
+        self.stopped = True
         self.queues[queue_name].stop_consuming()
-    
 
+    def buffered_publisher(self):
+        return BufferedPublisher(self, self.config.mqueue['publish_batch_size'], self.config.mqueue['publish_batch_delay'])
+
+
+class BatchAcker:
+    """Acknowledges deliveries with basic_ack(multiple=True) once max_messages
+    have been processed or max_delay seconds after the first unacked one.
+    Deliveries may finish out of order (e.g. with the async fetcher), so only
+    the tags below the oldest one still being worked on are ever acked; a
+    crash can cause redeliveries, but never loses a message. before_ack is
+    called right before anything is acked."""
+
+    def __init__(self, mq, channel, max_messages=1, max_delay=0.1, before_ack=None):
+        self.mq = mq
+        self.channel = channel
+        self.max_messages = max(max_messages, 1)
+        self.max_delay = max_delay
+        self.before_ack = before_ack
+
+        self.outstanding = set()
+        self.highest_done = 0
+        self.last_acked = 0
+        self.unacked = 0
+        self.timer = None
+
+    def received(self, delivery_tag):
+        self.outstanding.add(delivery_tag)
+
+    def done(self, delivery_tag):
+        self.outstanding.discard(delivery_tag)
+
+        if self.max_messages == 1:
+            if self.before_ack:
+                self.before_ack()
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+            return
+
+        self.highest_done = max(self.highest_done, delivery_tag)
+        self.unacked += 1
+
+        if self.unacked >= self.max_messages:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.mq.call_later(self.max_delay, self._flush_on_timer)
+
+    def _flush_on_timer(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.mq.remove_timeout(self.timer)
+            self.timer = None
+
+        # Everything below the oldest delivery still in progress is done
+        watermark = self.highest_done
+        if self.outstanding:
+            watermark = min(min(self.outstanding) - 1, watermark)
+
+        if watermark > self.last_acked:
+            if self.before_ack:
+                self.before_ack()
+            self.channel.basic_ack(delivery_tag=watermark, multiple=True)
+            self.last_acked = watermark
+            self.unacked = 0
+
+        # Completed deliveries stuck behind a slow one get another chance later
+        if self.highest_done > self.last_acked and self.timer is None:
+            self.timer = self.mq.call_later(self.max_delay, self._flush_on_timer)
+
+
+class BufferedPublisher:
+    """Accumulates messages and publishes them in batches, either once
+    max_messages are waiting or max_delay seconds after the first one was
+    buffered. A BlockingChannel in confirm mode waits for the broker after
+    every single publish, so the batch is published on a transactional
+    channel instead: tx_commit() returns once the broker has taken
+    responsibility for the whole batch, in one round trip."""
+
+    def __init__(self, mq, max_messages=100, max_delay=0.25):
+        self.mq = mq
+        self.logger = mq.config.logger
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+
+        self.buffer = []
+        self.timer = None
+
+        self.channel = mq.mq_conn.channel()
+        self.channel.tx_select()
+
+    def push(self, queue_name, payload, key=None, priority=None):
+        self.buffer.append((queue_name, payload, key, priority))
+
+        if len(self.buffer) >= self.max_messages:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.mq.call_later(self.max_delay, self._flush_on_timer)
+
+    def _flush_on_timer(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.mq.remove_timeout(self.timer)
+            self.timer = None
+
+        if not self.buffer:
+            return
+
+        self.logger.debug("Publishing a batch of %s messages.", str(len(self.buffer)))
+        with metrics.timer('webcrawler_publish_batch_seconds'):
+            for queue_name, payload, key, priority in self.buffer:
+                exchange, routing_key = self.mq.route(queue_name, key)
+                self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=payload, properties=pika.BasicProperties(delivery_mode=2, priority=priority))
+                metrics.inc('webcrawler_messages_published_total', queue=queue_name)
+            self.channel.tx_commit()
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.channel.close()
@@ -13,9 +13,38 @@ class Options:
         parser.add_argument("-d", "--dbprofile", default="db-default", help="Specify the configuration section to read database configuration. [optional, default=db-default]")
         parser.add_argument("-p", "--processes", default=8, help="Specify the number of concurrent worker sub-processes. [optional, default=8]")
         parser.add_argument("-s", "--scan", required=True, help="Unique identifer of a new or existing scan job to run/continue running")
-        parser.add_argument("-r", "--role", required=True, choices=['page', 'link'], help="Assign role to this invocation, either 'page' crawler or 'link' parser.")
+        parser.add_argument("-r", "--role", choices=['page', 'link', 'pipeline'], help="Assign role to this invocation, either 'page' crawler, 'link' parser or 'pipeline', which crawls pages and stores their links in one pass. Required unless the frontier is local, which runs page and link workers together. [optional]")
+        parser.add_argument("-b", "--frontier", choices=['rabbitmq', 'local'], help="Where queued URLs are kept, overrides backend in [frontier]. 'local' needs no broker and resumes from its spool directory after a restart. [optional, default=rabbitmq]")
+        parser.add_argument("-f", "--fetch-mode", default="sync", choices=['sync', 'async'], help="Fetch pages one at a time per process or concurrently on an event loop (page and pipeline roles only). [optional, default=sync]")
+        parser.add_argument("-x", "--link-extractor", choices=['streaming', 'html5lib'], help="Parser used to pull links out of pages, overrides link_extractor in [fetch]. [optional, default=streaming]")
+        parser.add_argument("--shards", help="Page queue shards this node's page and pipeline workers may consume, e.g. 0-7,12, when [mqueue] shards is set. The live workers of all nodes split them between themselves. [optional, default=all]")
+        parser.add_argument("--prefetch", type=int, help="Number of unacknowledged messages each worker may hold, overrides prefetch_count in [mqueue]. [optional, default=1, or the fetch concurrency in async mode]")
+        parser.add_argument("-n", "--incremental", action='store_const', const=True, help="Re-crawl an existing scan, asking servers whether pages changed and reusing stored links for those that did not. Starts a new pass when the page queue is empty. [optional]")
+        parser.add_argument("-R", "--resume", action='store_const', const=True, help="Rebuild the page queue from the database before crawling, for when the broker lost messages or the queue was purged: whatever it holds is dropped and every URL of the scan still to be crawled is queued again. [optional]")
         parser.add_argument("-l", "--loglevel", default="ERROR", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Logging level - DEBUG|INFO|WARNING|ERROR|CRITICAL [optional, default=ERROR]")
         parser.add_argument("-w", "--writelog", nargs="?", const="webcrawler.log", help="Write log to a specified file [optional, default=webcrawler.log]")
         parser.add_argument("-q", "--quiet", action='store_const', const=True, help="Silence console logging [optional]")
 
         return parser.parse_args()
+
+
+class ExportOptions:
+
+    def __init__(self):
+        self.params = self._init_params()
+
+    def _init_params(self):
+        parser = argparse.ArgumentParser(description="WebCrawler edge export - Writes out a scan's links as Target, Root Stem, Content-Type, Status Code, Source edges.")
+
+        parser.add_argument("-i", "--inifile", default="webcrawler.ini", help="Specify the configuration file containing database options and other parameters. [optional, default=webcrawler.ini]")
+        parser.add_argument("-d", "--dbprofile", default="db-default", help="Specify the configuration section to read database configuration. [optional, default=db-default]")
+        parser.add_argument("-s", "--scan", required=True, help="Unique identifer of the scan to export")
+        parser.add_argument("-t", "--format", default="csv", choices=['csv', 'tsv', 'parquet'], help="Output format; parquet needs pyarrow. [optional, default=csv]")
+        parser.add_argument("-o", "--output", help="File to write the edges to, - for standard output. [optional, default=<scan>-edges.<format>]")
+        parser.add_argument("-c", "--chunk-size", type=int, default=10000, help="Number of URLs read from the database at a time. [optional, default=10000]")
+        parser.add_argument("-r", "--repair-redirects", action='store_const', const=True, help="Before exporting, fill in the final target of redirects missing one or with a stale one; this writes to the database. [optional]")
+        parser.add_argument("-l", "--loglevel", default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Logging level - DEBUG|INFO|WARNING|ERROR|CRITICAL [optional, default=INFO]")
+        parser.add_argument("-w", "--writelog", nargs="?", const="webcrawler.log", help="Write log to a specified file [optional, default=webcrawler.log]")
+        parser.add_argument("-q", "--quiet", action='store_const', const=True, help="Silence console logging [optional]")
+
+        return parser.parse_args()
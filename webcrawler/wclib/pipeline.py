@@ -0,0 +1,127 @@
+import concurrent.futures
+import heapq
+import itertools
+import queue
+import threading
+import time
+import traceback
+
+from functools import partial
+
+from .metrics import metrics
+
+
+class PagePipeline:
+    """Takes a pipeline worker's pages through fetch, parse and persist
+    stages, each on threads of its own and handing over through queues, so a
+    page's links are stored by the process that found them instead of going
+    through the link queue.
+
+    The consumer's thread only talks to the frontier. Deliveries go to the
+    persist stage, which owns the database connection and the crawler's
+    caches: it looks each URL up, hands it to the fetch stage and, once parsed,
+    logs the page and its links. Acks and pushes it makes are bounced back to
+    the consumer's thread.
+
+    Every item in the pipeline is one unacknowledged delivery, so with each
+    queue as deep as the prefetch count no stage ever waits to hand one on."""
+
+    def __init__(self, crawler, prefetch_count, threads):
+        self.crawler = crawler
+        self.logger = crawler.logger
+
+        self.persist_queue = queue.Queue(prefetch_count)
+        self.fetch_queue = queue.Queue(prefetch_count)
+        self.parse_queue = queue.Queue(prefetch_count)
+
+        # URLs politeness holds back, only ever touched by the persist stage
+        self.timers = []
+        self.sequence = itertools.count()
+
+        self.threads = [threading.Thread(target=self._persist, name='webcrawler-persist', daemon=True),
+                        threading.Thread(target=self._parse, name='webcrawler-parse', daemon=True)]
+
+        # In async mode the AsyncFetcher's event loop is the fetch stage
+        if not crawler.fetcher:
+            self.threads += [threading.Thread(target=self._fetch, name='webcrawler-fetch-%d' % (x + 1), daemon=True) for x in range(threads)]
+
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, callback):
+        """Run callback on the persist stage."""
+        self.persist_queue.put(callback)
+
+    def call_later(self, delay, callback):
+        """Run callback on the persist stage after delay seconds; only to be
+        called from the persist stage."""
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), callback))
+
+    def fetch(self, delivery_tag, url, url_record):
+        if self.crawler.fetcher:
+            self.crawler.fetcher.submit(url, partial(self._fetched, delivery_tag, url, url_record), self.crawler.conditional_headers(url_record))
+        else:
+            self.fetch_queue.put((delivery_tag, url, url_record))
+
+    def _fetched(self, delivery_tag, url, url_record, future):
+        self.parse_queue.put((delivery_tag, url, url_record, future))
+
+    def _fetch(self):
+        session = self.crawler.new_session()
+        while True:
+            item = self.fetch_queue.get()
+            if item is None:
+                return
+
+            delivery_tag, url, url_record = item
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(self.crawler.fetch_page(url, url_record, session))
+            except Exception as error:
+                future.set_exception(error)
+            self._fetched(delivery_tag, url, url_record, future)
+
+    def _parse(self):
+        while True:
+            item = self.parse_queue.get()
+            if item is None:
+                return
+
+            delivery_tag, url, url_record, future = item
+            result = self.crawler.finish_page(url, url_record, future)
+            self.submit(partial(self.crawler._pipeline_page_done, delivery_tag, result))
+
+    def _persist(self):
+        while True:
+            if self.timers and self.timers[0][0] <= time.monotonic():
+                callback = heapq.heappop(self.timers)[2]
+            else:
+                try:
+                    callback = self.persist_queue.get(timeout=self.timers[0][0] - time.monotonic() if self.timers else None)
+                except queue.Empty:
+                    continue
+
+            if callback is None:
+                return
+
+            try:
+                callback()
+            except Exception as error:
+                # Same as an error in a consumer callback: the worker goes down and its deliveries are redelivered
+                metrics.inc('webcrawler_errors_total', stage='persist', type=type(error).__name__)
+                self.logger.error("Pipeline persist stage failed: %s", error)
+                self.logger.error(traceback.format_exc())
+                self.crawler.mq.call_threadsafe(partial(self._reraise, error))
+                return
+
+    def _reraise(self, error):
+        raise error
+
+    def close(self):
+        self.logger.debug('Shutting down the page pipeline.')
+        self.persist_queue.put(None)
+        self.parse_queue.put(None)
+        for thread in self.threads[2:]:
+            self.fetch_queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,197 @@
+import time
+import threading
+import email.utils
+import requests
+import concurrent.futures
+
+from collections import OrderedDict
+from urllib.robotparser import RobotFileParser
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def wait_time(self, now):
+        """Take a token if one is available and return 0, else return how
+        long until the next one is."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+def parse_retry_after(value, now=None):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - (now or time.time()), 0)
+
+
+class HostScheduler:
+    """Per hostname politeness for page workers: a token bucket limiting
+    the request rate to each host (slowed further by a robots.txt
+    Crawl-delay), robots.txt Disallow rules treated as one more blacklist,
+    and back-off after 429/503 responses honoring Retry-After.
+
+    The scheduler never sleeps itself; wait_time() tells the caller how long
+    to set a URL aside so it can get on with URLs for other hosts. Neither
+    does it wait for robots.txt: that is fetched on threads of its own, and
+    until it is in a host's URLs are set aside for robots_poll seconds at a
+    time. An expired robots.txt keeps being used while it is fetched again."""
+
+    backoff_codes = (429, 503)
+    robots_poll = 0.1
+
+    def __init__(self, config):
+        self.logger = config.logger
+
+        # robots.txt is fetched off the consumer's thread, each fetch thread with a session of its own
+        self.headers = config.sessionconfig['headers']
+        self.sessions = threading.local()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='webcrawler-robots')
+
+        self.rate = config.politeconfig['requests_per_second']
+        self.burst = config.politeconfig['burst']
+        self.use_robots = config.politeconfig['robots']
+        self.robots_agent = config.politeconfig['robots_user_agent']
+        self.robots_ttl = config.politeconfig['robots_ttl']
+        self.max_backoff = config.politeconfig['max_backoff']
+        self.max_retries = config.politeconfig['max_retries']
+        self.timeout = config.fetchconfig['timeout']
+
+        self.buckets = {}
+        self.robots = {}
+        self.robots_pending = {}
+        self.blocked_until = {}
+        self.failures = {}
+        self.retries = OrderedDict()
+
+    def _bucket(self, host):
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    def _fetch_robots(self, site):
+        # Runs on a fetch thread, so touches nothing but its own session
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+            session.headers.update(self.headers)
+
+        rp = RobotFileParser(site + '/robots.txt')
+        try:
+            r = session.get(site + '/robots.txt', verify=False, timeout=self.timeout)
+            if r.status_code in (401, 403):
+                rp.disallow_all = True
+            elif r.status_code >= 400:
+                rp.allow_all = True
+            else:
+                rp.parse(r.text.splitlines())
+        except Exception as error:
+            self.logger.info("Could not fetch robots.txt for %s, assuming everything is allowed: %s", site, error)
+            rp.allow_all = True
+        return rp
+
+    def _robots(self, url):
+        """The robots.txt rules for url's site, or None while they are
+        not known yet."""
+        site = url.scheme + '://' + url.netloc
+        cached = self.robots.get(site)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        pending = self.robots_pending.get(site)
+        if pending is None:
+            self.robots_pending[site] = self.executor.submit(self._fetch_robots, site)
+            return cached[1] if cached is not None else None
+        if not pending.done():
+            return cached[1] if cached is not None else None
+
+        del self.robots_pending[site]
+        rp = pending.result()
+
+        # A Crawl-delay slows this host's bucket down below the configured rate
+        delay = rp.crawl_delay(self.robots_agent)
+        if delay:
+            self._bucket(url.hostname).set_rate(min(self.rate, 1 / float(delay)))
+
+        self.robots[site] = (time.monotonic() + self.robots_ttl, rp)
+        return rp
+
+    def is_allowed(self, url):
+        # wait_time() holds on to a host's URLs until its robots.txt is in
+        if not self.use_robots:
+            return True
+        rp = self._robots(url)
+        return rp is None or rp.can_fetch(self.robots_agent, url.geturl())
+
+    def wait_time(self, url):
+        """Return 0 and use up a token if url's host may be fetched now,
+        else the number of seconds to hold on to it."""
+        now = time.monotonic()
+
+        blocked = self.blocked_until.get(url.hostname)
+        if blocked is not None:
+            if blocked > now:
+                return blocked - now
+            del self.blocked_until[url.hostname]
+
+        if self.use_robots and self._robots(url) is None:
+            # Make sure robots.txt, and any Crawl-delay, is applied before the first request
+            return self.robots_poll
+
+        return self._bucket(url.hostname).wait_time(now)
+
+    def should_retry(self, url, status_code, retry_after):
+        """Record the outcome of a fetch. Returns True if the host asked us
+        to back off and the URL should be tried again later instead of
+        being logged."""
+        if status_code not in self.backoff_codes:
+            self.failures.pop(url.hostname, None)
+            self.retries.pop(url.geturl(), None)
+            return False
+
+        # Exponential back-off unless the server told us how long to wait
+        failures = self.failures.get(url.hostname, 0) + 1
+        self.failures[url.hostname] = failures
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = 2 ** failures
+        delay = min(delay, self.max_backoff)
+
+        self.blocked_until[url.hostname] = time.monotonic() + delay
+        self.logger.info("Host %s answered %s, backing off for %s seconds.", url.hostname, str(status_code), str(delay))
+
+        attempts = self.retries.pop(url.geturl(), 0) + 1
+        if attempts > self.max_retries:
+            return False
+
+        # Only remember a bounded number of URLs being retried
+        self.retries[url.geturl()] = attempts
+        if len(self.retries) > 10000:
+            self.retries.popitem(last=False)
+
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,80 @@
+import time
+
+from urllib.parse import urlparse
+
+from . import model as dm
+
+
+class FrontierRebuilder:
+    """Puts every URL of a scan that is still to be crawled back on the page
+    queue, for when the frontier lost what it held. The database is what
+    counts: whatever the page queue holds is purged first, so nothing ends
+    up queued twice, then the uncrawled and not blacklisted URLs are read
+    in chunks of chunk_size, each picking up after the url_id the last one
+    stopped at, and republished at the depth they were queued at.
+
+    URLs a [budget] kept off the queue have no depth and stay off it. With
+    no limits set there is nothing to keep off, and URLs queued before depths
+    were recorded go back on at depth 0. In incremental mode the URLs crawled
+    before the current pass started are due again too."""
+
+    def __init__(self, crawler, chunk_size=10000):
+        self.crawler = crawler
+        self.config = crawler.config
+        self.logger = crawler.logger
+        self.scan = crawler.scan
+        self.chunk_size = chunk_size
+
+    def _due(self):
+        due = (dm.FoundURL.is_crawled == False)
+        if self.config.options.incremental and self.scan.start_timestamp:
+            due = due | dm.FoundURL.crawled_timestamp.is_null() | (dm.FoundURL.crawled_timestamp < self.scan.start_timestamp)
+
+        query = (dm.FoundURL.scan_id == self.scan.scan_id) & due & (dm.FoundURL.is_blacklisted == False)
+        budget = self.config.budgetconfig
+        if budget['max_depth'] or budget['max_pages_per_root_stem'] or budget['max_pages_per_host']:
+            query = query & dm.FoundURL.depth.is_null(False)
+        return query
+
+    def rebuild(self):
+        page_queue = self.config.mqueue['queues']['page']
+        purged = self.crawler.mq.queue_purge(page_queue)
+        if purged:
+            self.logger.info("Purged %s messages from queue %s, to be replaced from the database.", str(purged), page_queue)
+
+        last_id = (dm.FoundURL.select(dm.FoundURL.url_id).where(dm.FoundURL.scan_id == self.scan.scan_id).order_by(dm.FoundURL.url_id.desc()).limit(1).scalar()) or 0
+        self.logger.info("Rebuilding queue %s from the URLs of scan %s, up to url_id %s.", page_queue, self.scan.name, str(last_id))
+
+        # Batched publishing where the frontier offers it
+        self.crawler.publisher = self.crawler.mq.buffered_publisher()
+
+        due = self._due()
+        start = time.monotonic()
+        republished = 0
+        url_id = 0
+        try:
+            while True:
+                query = (dm.FoundURL
+                         .select(dm.FoundURL.url_id, dm.FoundURL.url_text, dm.FoundURL.depth)
+                         .where(due & (dm.FoundURL.url_id > url_id))
+                         .order_by(dm.FoundURL.url_id)
+                         .limit(self.chunk_size)
+                         .tuples())
+                rows = list(query)
+                if not rows:
+                    break
+
+                for url_id, url_text, depth in rows:
+                    if url_text:
+                        self.crawler.push_page(urlparse(url_text), depth or 0)
+                        republished += 1
+
+                elapsed = time.monotonic() - start
+                self.logger.info("Republished %s URLs, up to url_id %s of %s (%.0f URLs/s).", str(republished), str(url_id), str(last_id), republished / elapsed if elapsed else 0)
+        finally:
+            if self.crawler.publisher:
+                self.crawler.publisher.close()
+            self.crawler.publisher = None
+
+        self.logger.info("Rebuilt queue %s with %s URLs in %.1f seconds.", page_queue, str(republished), time.monotonic() - start)
+        return republished
@@ -0,0 +1,106 @@
+import math
+
+from collections import OrderedDict
+
+from . import model as dm
+from .metrics import metrics
+
+
+class BloomFilter:
+    """Compact, fixed size set membership test for url hashes. Since the keys
+    are already SHA-256 hex digests, the bit positions are derived from slices
+    of the digest itself (double hashing) rather than by hashing again."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, url_hash):
+        h1 = int(url_hash[0:16], 16)
+        h2 = int(url_hash[16:32], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, url_hash):
+        for pos in self._positions(url_hash):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, url_hash):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(url_hash))
+
+
+class SeenURLCache:
+    """Per worker memory of url hashes we have already resolved against
+    FoundURLs. The LRU maps url_hash to (url_id, is_crawled) and is
+    authoritative for anything it holds. The optional Bloom filter is loaded
+    once at startup with the hashes of URLs already crawled in the scan and
+    can only answer "probably crawled", which is good enough to decide how
+    to look a URL up but never to skip it."""
+
+    def __init__(self, config):
+        self.logger = config.logger
+        self.max_size = config.cacheconfig['lru_size']
+        self.entries = OrderedDict()
+        self.bloom = None
+
+        self.hits = 0
+        self.misses = 0
+        self.bloom_hits = 0
+
+        if config.cacheconfig['bloom']:
+            self.bloom = self._load_bloom(config.scan, config.cacheconfig['bloom_error_rate'], config.options.incremental)
+
+    def _load_bloom(self, scan, error_rate, incremental):
+        crawled = dm.FoundURL.select(dm.FoundURL.url_hash).where((dm.FoundURL.scan_id == scan.scan_id) & (dm.FoundURL.is_crawled == 1))
+
+        # During an incremental pass only what has been crawled in this pass counts
+        if incremental and scan.start_timestamp:
+            crawled = crawled.where(dm.FoundURL.crawled_timestamp >= scan.start_timestamp)
+
+        bloom = BloomFilter(crawled.count(), error_rate)
+        for (url_hash,) in crawled.tuples().iterator():
+            bloom.add(url_hash)
+
+        self.logger.info("Loaded crawled URL bloom filter for scan %s (%s bits, %s hashes).", scan.name, str(bloom.size), str(bloom.hashes))
+        return bloom
+
+    def get(self, url_hash):
+        """Return (url_id, is_crawled) if the hash is in the LRU, else None."""
+        entry = self.entries.get(url_hash)
+        if entry is None:
+            self.misses += 1
+            metrics.inc('webcrawler_seen_misses_total')
+            return None
+
+        self.hits += 1
+        metrics.inc('webcrawler_seen_hits_total')
+        self.entries.move_to_end(url_hash)
+        return entry
+
+    def is_crawled(self, url_hash):
+        # Only what the LRU holds is certain
+        entry = self.get(url_hash)
+        return entry is not None and entry[1]
+
+    def probably_crawled(self, url_hash):
+        # A false positive is a URL we have not crawled yet, so the database has the last word
+        if self.bloom is not None and url_hash in self.bloom:
+            self.bloom_hits += 1
+            metrics.inc('webcrawler_seen_bloom_hits_total')
+            return True
+        return False
+
+    def add(self, url_hash, url_id, is_crawled):
+        self.entries[url_hash] = (url_id, bool(is_crawled))
+        self.entries.move_to_end(url_hash)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def reset(self):
+        # Forget everything, e.g. once a new incremental pass has made it out of date
+        self.entries.clear()
+        self.bloom = None
+
+    def stats(self):
+        return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'bloom_hits': self.bloom_hits }
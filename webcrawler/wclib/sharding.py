@@ -0,0 +1,82 @@
+import datetime
+import hashlib
+import os
+import socket
+
+from . import model as dm
+from .metrics import metrics
+
+
+def parse_shards(spec, count):
+    """Shard ids listed in spec, e.g. '0-3,8', all of them if spec is
+    empty. Raises ValueError for anything outside range(count)."""
+    if not spec:
+        return list(range(count))
+
+    shards = set()
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 0 or last >= count or first > last:
+            raise ValueError("shards %s are not within 0-%d" % (part.strip(), count - 1))
+        shards.update(range(first, last + 1))
+    return sorted(shards)
+
+
+def format_shards(shards):
+    return ','.join(str(x) for x in sorted(shards))
+
+
+def _score(shard, worker_id):
+    return int(hashlib.sha1(('%d:%s' % (shard, worker_id)).encode()).hexdigest()[:16], 16)
+
+
+class ShardAssigner:
+    """Splits the shards of a scan's page queue between the page workers
+    consuming it, on whatever nodes they run. Every worker keeps a heartbeat
+    in ScanWorkers together with the shards it may take, and each shard goes
+    to the live worker scoring highest for it (rendezvous hashing). When a
+    worker joins or goes quiet only the shards it gains or held move, and
+    every worker works out the same assignment without talking to the
+    others; each picks up the change at its next heartbeat."""
+
+    def __init__(self, config, eligible):
+        self.logger = config.logger
+        self.scan_id = config.scan.scan_id
+        self.interval = config.mqueue['rebalance_interval']
+        self.eligible = eligible
+        self.worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.shards = []
+
+    def heartbeat(self, now):
+        shards = format_shards(self.eligible)
+        if not dm.ScanWorker.update(shards=shards, heartbeat_timestamp=now).where((dm.ScanWorker.scan_id == self.scan_id) & (dm.ScanWorker.worker_id == self.worker_id)).execute():
+            dm.ScanWorker.insert(scan_id=self.scan_id, worker_id=self.worker_id, shards=shards, heartbeat_timestamp=now).execute()
+
+    def live_workers(self, now):
+        # Workers that missed three heartbeats are taken for gone
+        cutoff = now - datetime.timedelta(seconds=3 * self.interval)
+        query = (dm.ScanWorker
+                 .select(dm.ScanWorker.worker_id, dm.ScanWorker.shards)
+                 .where((dm.ScanWorker.scan_id == self.scan_id) & (dm.ScanWorker.heartbeat_timestamp >= cutoff))
+                 .tuples())
+        return {worker_id: set(int(x) for x in shards.split(',') if x) for worker_id, shards in query}
+
+    def assign(self):
+        """Heartbeat and return the shards this worker is to consume now."""
+        # Heartbeats are stamped and compared by the database's clock, whatever the workers' clocks say
+        now = dm.database_now()
+        self.heartbeat(now)
+        workers = self.live_workers(now)
+        workers[self.worker_id] = set(self.eligible)
+
+        shards = [x for x in self.eligible if max((w for w in workers if x in workers[w]), key=lambda w: _score(x, w)) == self.worker_id]
+        if shards != self.shards:
+            self.logger.info("Worker %s now consumes shards %s, with %s workers live.", self.worker_id, format_shards(shards) or 'none', str(len(workers)))
+            metrics.inc('webcrawler_shard_rebalances_total')
+            self.shards = shards
+        return shards
+
+    def leave(self):
+        dm.ScanWorker.delete().where((dm.ScanWorker.scan_id == self.scan_id) & (dm.ScanWorker.worker_id == self.worker_id)).execute()
@@ -0,0 +1,264 @@
+import collections
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from multiprocessing import Event, Process
+from multiprocessing.connection import Client, Listener
+
+from peewee import SqliteDatabase
+
+
+logger = logging.getLogger('webcrawler')
+
+
+class WriterCursor:
+    """What a statement run by the SqliteWriter returned, standing in for
+    the sqlite3 cursor peewee expects."""
+
+    def __init__(self, description, rows, lastrowid, rowcount):
+        self.description = description
+        self.rows = collections.deque(rows)
+        self.lastrowid = lastrowid
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.rows.popleft() if self.rows else None
+
+    def fetchmany(self, size=1):
+        return [self.rows.popleft() for _ in range(min(size, len(self.rows)))]
+
+    def fetchall(self):
+        rows = list(self.rows)
+        self.rows.clear()
+        return rows
+
+    def __iter__(self):
+        while self.rows:
+            yield self.rows.popleft()
+
+    def close(self):
+        pass
+
+
+class CrawlerSqliteDatabase(SqliteDatabase):
+    """SQLite in WAL mode, for scans run on a single machine. Every process
+    reads through a connection of its own; once writer_address is set, the
+    writes and whole transactions go to the SqliteWriter listening there
+    instead, so workers never compete for the database's write lock."""
+
+    # Database settings that are for the SqliteWriter, not for the connections
+    writer_settings = ('use_writer', 'writer_batch_size')
+
+    def __init__(self, database, writer_address=None, **kwargs):
+        super().__init__(database, lock_type='immediate', **kwargs)
+        self.writer_address = writer_address
+        self.clients = threading.local()
+
+    def _request(self, *request):
+        # One connection to the writer per thread, and none carried over from before a fork
+        client = getattr(self.clients, 'client', None)
+        if client is None or client[0] != os.getpid():
+            client = self.clients.client = (os.getpid(), Client(self.writer_address))
+
+        client[1].send(request)
+        result = client[1].recv()
+        if result[0] == 'error':
+            raise result[1](result[2])
+        return WriterCursor(*result[1:])
+
+    def execute_sql(self, sql, params=None):
+        if self.writer_address and (self.in_transaction() or not sql.lstrip()[:6].upper() == 'SELECT'):
+            self._log_query(sql, params)
+            return self._request('execute', sql, params)
+        return super().execute_sql(sql, params)
+
+    def begin(self, lock_type=None):
+        if self.writer_address:
+            return self._request('begin')
+        return super().begin(lock_type)
+
+    def commit(self):
+        if self.writer_address:
+            return self._request('commit')
+        return super().commit()
+
+    def rollback(self):
+        if self.writer_address:
+            return self._request('rollback')
+        return super().rollback()
+
+
+class SqliteWriter:
+    """Process doing all the writing to a CrawlerSqliteDatabase on behalf of
+    the workers, which talk to it over a Unix socket.
+
+    Statements sent outside a transaction are batched: whatever has queued
+    up, up to writer_batch_size statements from any number of workers, runs
+    in one transaction and each worker gets its answer once it is committed.
+    A statement that fails is rolled back on its own. A worker's transaction
+    runs by itself, with everybody else's statements waiting until it
+    commits or rolls back."""
+
+    def __init__(self, path, dbconfig):
+        self.path = path
+        self.pragmas = dbconfig['pragmas']
+        self.timeout = dbconfig['timeout']
+        self.batch_size = dbconfig['writer_batch_size']
+
+        self.process = None
+        self.socket_dir = None
+        self.address = None
+
+    def start(self):
+        self.socket_dir = tempfile.mkdtemp(prefix='webcrawler-')
+        self.address = os.path.join(self.socket_dir, 'dbwriter')
+
+        ready = Event()
+        self.process = Process(target=self._run, args=(ready,), name='webcrawler-dbwriter')
+        self.process.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        connection = Client(self.address)
+        connection.send(('stop',))
+        connection.close()
+        self.process.join()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    def _run(self, ready):
+        self.db = SqliteDatabase(self.path, pragmas=self.pragmas, timeout=self.timeout)
+        self.requests = queue.Queue()
+        self.pending = collections.deque()
+
+        self.listener = Listener(self.address, family='AF_UNIX')
+        threading.Thread(target=self._accept, name='webcrawler-dbwriter-accept', daemon=True).start()
+        ready.set()
+
+        logger.debug('Database writer for %s started.', self.path)
+        while True:
+            client, request = self._next_request()
+            if request[0] == 'stop':
+                break
+            if request[0] == 'begin':
+                self._run_transaction(client)
+                continue
+
+            # Anything else that has queued up goes in the same transaction, up to the next one a worker starts
+            batch = [(client, request)]
+            while len(batch) < self.batch_size:
+                try:
+                    client, request = self._next_request(block=False)
+                except queue.Empty:
+                    break
+                if request[0] in ('begin', 'stop'):
+                    self.pending.appendleft((client, request))
+                    break
+                batch.append((client, request))
+            self._run_batch(batch)
+
+        self.db.close()
+        self.listener.close()
+        logger.debug('Database writer for %s stopped.', self.path)
+
+    def _accept(self):
+        while True:
+            threading.Thread(target=self._receive, args=(self.listener.accept(),), daemon=True).start()
+
+    def _receive(self, client):
+        while True:
+            try:
+                self.requests.put((client, client.recv()))
+            except (EOFError, OSError):
+                # Undoes whatever the worker left unfinished
+                self.requests.put((client, ('close',)))
+                return
+
+    def _next_request(self, block=True):
+        if self.pending:
+            return self.pending.popleft()
+        return self.requests.get(block)
+
+    def _execute(self, request):
+        if request[0] != 'execute':
+            return ('ok', None, [], None, -1)
+        cursor = self.db.execute_sql(request[1], request[2])
+        return ('ok', cursor.description, cursor.fetchall(), cursor.lastrowid, cursor.rowcount)
+
+    def _reply(self, client, result):
+        try:
+            client.send(result)
+        except OSError:
+            pass
+
+    def _error(self, error):
+        return ('error', type(error), str(error))
+
+    def _run_batch(self, batch):
+        results = []
+        try:
+            self.db.execute_sql('BEGIN IMMEDIATE')
+            for client, request in batch:
+                if len(batch) == 1:
+                    try:
+                        results.append(self._execute(request))
+                    except Exception as error:
+                        results.append(self._error(error))
+                    continue
+
+                self.db.execute_sql('SAVEPOINT statement')
+                try:
+                    results.append(self._execute(request))
+                except Exception as error:
+                    self.db.execute_sql('ROLLBACK TO SAVEPOINT statement')
+                    results.append(self._error(error))
+                self.db.execute_sql('RELEASE SAVEPOINT statement')
+            self.db.execute_sql('COMMIT')
+        except Exception as error:
+            logger.error('Database writer could not commit a batch of %s statements: %s', str(len(batch)), error)
+            if self.db.connection().in_transaction:
+                self.db.execute_sql('ROLLBACK')
+            results = [self._error(error)] * len(batch)
+
+        for (client, request), result in zip(batch, results):
+            if request[0] != 'close':
+                self._reply(client, result)
+
+    def _run_transaction(self, client):
+        deferred = []
+        try:
+            self.db.execute_sql('BEGIN IMMEDIATE')
+        except Exception as error:
+            self._reply(client, self._error(error))
+            return
+        self._reply(client, ('ok', None, [], None, -1))
+
+        while True:
+            other, request = self._next_request()
+            if other is not client:
+                deferred.append((other, request))
+                continue
+
+            if request[0] == 'close':
+                self.db.execute_sql('ROLLBACK')
+                break
+
+            try:
+                if request[0] in ('commit', 'rollback'):
+                    self.db.execute_sql(request[0].upper())
+                    result = ('ok', None, [], None, -1)
+                else:
+                    result = self._execute(request)
+            except Exception as error:
+                result = self._error(error)
+            self._reply(client, result)
+
+            if request[0] in ('commit', 'rollback') and not self.db.connection().in_transaction:
+                break
+
+        # The others carry on in the order they asked
+        self.pending.extendleft(reversed(deferred))
@@ -0,0 +1,157 @@
+import collections
+import socket
+import ssl
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from .metrics import metrics
+
+
+class DNSCache:
+    """Remembers what socket.getaddrinfo() answered for ttl seconds, for
+    everything in the process that resolves through it once install() has
+    been called: requests, aiohttp's threaded resolver and robots.txt fetches
+    alike. getaddrinfo() does not tell us the records' own TTLs, so ttl should
+    stay short enough to respect the usual ones. Failures are not cached."""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.resolve = socket.getaddrinfo
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                metrics.inc('webcrawler_dns_lookups_total', result='hit')
+                return entry[1]
+
+        start = time.perf_counter()
+        try:
+            addresses = self.resolve(host, port, family, type, proto, flags)
+        except OSError:
+            metrics.inc('webcrawler_dns_lookups_total', result='error')
+            raise
+        metrics.observe('webcrawler_dns_seconds', time.perf_counter() - start)
+        metrics.inc('webcrawler_dns_lookups_total', result='miss')
+
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return addresses
+
+    def install(self):
+        socket.getaddrinfo = self.getaddrinfo
+        return self
+
+
+class ResumableSSLSocket(ssl.SSLSocket):
+
+    def _real_close(self):
+        # TLS 1.3 servers send their session tickets after the handshake, so by now there may be a better one
+        self.context.remember(self)
+        super()._real_close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """Client context that offers each server the TLS session it last gave
+    us, so that new connections to a host we have talked to before can skip
+    the full handshake. Certificates are not checked, as everywhere else in
+    the crawler."""
+
+    sslsocket_class = ResumableSSLSocket
+
+    def __new__(cls, max_sessions=10000):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, max_sessions=10000):
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        self.sessions_lock = threading.Lock()
+
+    def _key(self, sock):
+        try:
+            return (sock.server_hostname, sock.getpeername()[:2])
+        except OSError:
+            return None
+
+    def remember(self, ssl_sock):
+        key = self._key(ssl_sock)
+        session = ssl_sock.session if ssl_sock._sslobj is not None else None
+        if key is None or session is None:
+            return
+
+        with self.sessions_lock:
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True, server_hostname=None, session=None):
+        key = (server_hostname, sock.getpeername()[:2])
+        with self.sessions_lock:
+            session = session or self.sessions.get(key)
+
+        ssl_sock = super().wrap_socket(sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect,
+                                       suppress_ragged_eofs=suppress_ragged_eofs, server_hostname=server_hostname, session=session)
+        metrics.inc('webcrawler_tls_handshakes_total', resumed=str(ssl_sock.session_reused).lower())
+        self.remember(ssl_sock)
+        return ssl_sock
+
+
+class TimedHTTPConnection(HTTPConnection):
+
+    url_scheme = 'http'
+
+    def connect(self):
+        # DNS, TCP and, for HTTPS, the TLS handshake; reused connections never get here
+        start = time.perf_counter()
+        super().connect()
+        metrics.observe('webcrawler_connect_seconds', time.perf_counter() - start, scheme=self.url_scheme)
+        metrics.inc('webcrawler_connections_total', scheme=self.url_scheme)
+
+
+class TimedHTTPSConnection(TimedHTTPConnection, HTTPSConnection):
+
+    url_scheme = 'https'
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class CrawlerHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter keeping pool_connections hosts' connection pools of up to
+    pool_maxsize connections each, retrying failed connects (but never a
+    request the server may have seen) and timing every new connection. With
+    an ssl_context, HTTPS connections are made with it instead of one the
+    pool creates for itself."""
+
+    def __init__(self, pool_connections, pool_maxsize, retries=0, retry_backoff=0, ssl_context=None):
+        self.ssl_context = ssl_context
+        super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                         max_retries=Retry(total=retries, read=False, redirect=False, backoff_factor=retry_backoff))
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        if self.ssl_context is not None:
+            pool_kwargs['ssl_context'] = self.ssl_context
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
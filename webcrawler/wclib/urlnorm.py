@@ -0,0 +1,114 @@
+import hashlib
+import re
+
+from urllib.parse import urljoin, urlsplit, urlunsplit, quote
+
+
+default_ports = { 'http': 80, 'https': 443 }
+
+percent_encoded = re.compile('%([0-9A-Fa-f]{2})')
+
+# RFC 3986 unreserved characters never need to be percent-encoded
+unreserved = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+path_safe = "/%:@!$&'()*+,;=-._~"
+query_safe = "/?%:@!$&'()*+,;=-._~"
+
+
+def _normalize_escape(match):
+    char = chr(int(match.group(1), 16))
+    if char in unreserved:
+        return char
+    return '%' + match.group(1).upper()
+
+
+def normalize_percent_encoding(text, safe):
+    # Escape anything that is not allowed raw, then tidy up existing escapes
+    text = quote(text, safe=safe)
+    if '%' in text:
+        text = percent_encoded.sub(_normalize_escape, text)
+    return text
+
+
+def remove_dot_segments(path):
+    # RFC 3986 section 5.2.4
+    if '.' not in path:
+        return path
+
+    output = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if len(output) > 1:
+                output.pop()
+        elif segment != '.':
+            output.append(segment)
+
+    if path.endswith(('/.', '/..')):
+        output.append('')
+
+    return '/'.join(output) or '/'
+
+
+class URLNormalizer:
+    """Turns an href found on a page (or any URL string) into the one
+    canonical spelling we store and hash: resolved against the parent or
+    <base> URL per RFC 3986, lowercase scheme and host, no default port, no
+    fragment, dot segments removed and percent-encoding normalized.
+    Optionally query parameters are dropped by name and/or sorted."""
+
+    def __init__(self, sort_query=False, drop_params=()):
+        self.sort_query = sort_query
+        self.drop_params = frozenset(drop_params)
+
+    def _normalize_query(self, query):
+        if not query:
+            return query
+
+        query = normalize_percent_encoding(query, query_safe)
+        if not self.sort_query and not self.drop_params:
+            return query
+
+        params = [x for x in query.split('&') if x and x.split('=', 1)[0] not in self.drop_params]
+        if self.sort_query:
+            params.sort()
+        return '&'.join(params)
+
+    def normalize(self, href, base=None):
+        """Return (canonical url, sha256 hex digest of it), or (None, None)
+        when href can't be turned into an absolute URL or has a bad port."""
+        if base:
+            href = urljoin(base, href)
+
+        parts = urlsplit(href.strip())
+        scheme = parts.scheme.lower()
+        if not scheme or not parts.netloc:
+            return (None, None)
+
+        host = parts.hostname or ''
+        try:
+            host = host.encode('idna').decode('ascii')
+        except UnicodeError:
+            pass
+        if ':' in host:
+            host = '[' + host + ']'
+
+        # A port that is not a number, or out of range, makes for no URL at all
+        try:
+            port = parts.port
+        except ValueError:
+            return (None, None)
+
+        netloc = host
+        if port and port != default_ports.get(scheme):
+            netloc += ':' + str(port)
+        if parts.username is not None:
+            userinfo = parts.username
+            if parts.password is not None:
+                userinfo += ':' + parts.password
+            netloc = userinfo + '@' + netloc
+
+        path = normalize_percent_encoding(remove_dot_segments(parts.path), path_safe) or '/'
+
+        canonical = urlunsplit((scheme, netloc, path, self._normalize_query(parts.query), ''))
+
+        return (canonical, hashlib.sha256(canonical.encode()).hexdigest())